@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import sqlite3
+import sys
+import threading
+from multiprocess_manager.batch_runner import BatchRunner, default_settings, ee_datasets, dataset_name
+from stitch.tileexport import TileExporter
+
+# 命令行参数与设置项的对应关系，未指定的参数使用清单中的设置或默认设置
+setting_args = ('service_account', 'json_file', 'project_id', 'max_download_fail', 'max_download_try', 'enable_gpu', 'stream_to_geotiff',
+                'pyramid_levels', 'worker_pool_size', 'job_memory_limit', 'job_time_limit', 'max_ee_requests', 'max_stitch_jobs', 'memory_budget',
+                'min_free_disk', 'metrics_port', 'trace_sample_rate', 'trace_format')
+task_args = ('taskname', 'dataset', 'wkt', 'adcode', 'start_date', 'end_date', 'scale', 'bands', 'priority', 'regionname')
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='无界面运行Nevasa下载任务（计算 → 下载 → 拼接），可重复运行以继续未完成的任务')
+    task = parser.add_argument_group('单个任务')
+    task.add_argument('--taskname', help='任务名，默认由数据集、区域和日期生成')
+    task.add_argument('--dataset', help=f'EE数据集ID或数据集名称，可选：{", ".join(ee_datasets)}')
+    task.add_argument('--wkt', help='下载区域WKT')
+    task.add_argument('--wkt-file', help='保存下载区域WKT的文件')
+    task.add_argument('--adcode', help='行政区划代码')
+    task.add_argument('--start-date', help='开始日期，YYYY-MM-DD')
+    task.add_argument('--end-date', help='结束日期，YYYY-MM-DD')
+    task.add_argument('--scale', type=int, help='下载层级')
+    task.add_argument('--bands', help='波段，多个波段以逗号分隔')
+    task.add_argument('--priority', type=int, help='任务优先级')
+    task.add_argument('--regionname', help='区域名称，写入拼接结果的说明')
+    task.add_argument('--no-shp', action='store_true', help='不导出矢量边界')
+    batch = parser.add_argument_group('批量任务')
+    batch.add_argument('--manifest', help='任务清单JSON：{"settings": {...}, "defaults": {...}, "tasks": [{...}, ...]}，或任务列表')
+    batch.add_argument('--parallel', type=int, default=None, help='同时执行的任务数，默认2')
+    export = parser.add_argument_group('导出瓦片')
+    export.add_argument('--export-tiles', help='由已下载的.nev直接导出瓦片：.mbtiles、.pmtiles，其余视为XYZ目录；需同时指定--nev和--dataset')
+    export.add_argument('--nev', help='任务的.nev文件')
+    export.add_argument('--tile-format', choices=('png', 'webp'), default='png', help='瓦片编码格式')
+    export.add_argument('--min-zoom', type=int, help='导出的最低层级，默认只导出下载层级')
+    output = parser.add_argument_group('输出')
+    output.add_argument('--output', default=None, help='下载目录，每个任务在其中建立同名子目录，默认为当前目录')
+    output.add_argument('--status', default=None, help='任务状态JSON，默认为下载目录下的batch_status.json')
+    settings = parser.add_argument_group('设置')
+    settings.add_argument('--service-account', help='谷歌服务账户')
+    settings.add_argument('--json-file', help='谷歌JSON-KEY路径')
+    settings.add_argument('--project-id', help='谷歌Project_id')
+    settings.add_argument('--proxy', action='append', default=None, help='代理地址，可重复指定多个')
+    settings.add_argument('--max-download-fail', type=int, help='允许的最大切片下载失败数量')
+    settings.add_argument('--max-download-try', type=int, help='每个阶段的最大尝试次数')
+    settings.add_argument('--enable-gpu', action='store_true', default=None, help='使用GPU进行图像处理')
+    settings.add_argument('--stream-to-geotiff', action='store_true', default=None, help='流式拼接，瓦片直接写入分块GeoTIFF')
+    settings.add_argument('--pyramid-levels', type=int, help='拼接后额外输出的低层级数')
+    settings.add_argument('--worker-pool-size', type=int, help='常驻工作进程数量，为0时每个任务阶段启动独立进程')
+    settings.add_argument('--job-memory-limit', type=int, help='单个任务阶段的内存上限（MB）')
+    settings.add_argument('--job-time-limit', type=int, help='单个任务阶段的运行时间上限（秒）')
+    settings.add_argument('--max-ee-requests', type=int, help='所有任务同时进行的EE请求数上限')
+    settings.add_argument('--max-stitch-jobs', type=int, help='同时进行的拼接任务数上限')
+    settings.add_argument('--memory-budget', type=int, help='任务进程内存预算（MB）')
+    settings.add_argument('--min-free-disk', type=int, help='拼接准入时磁盘需保留的空间（MB）')
+    settings.add_argument('--metrics-port', type=int, help='本机Prometheus指标接口端口，为0时不启用')
+    settings.add_argument('--trace-sample-rate', type=float, help='热路径计时的瓦片抽样比例（0~1），结果写入各任务目录下的trace')
+    settings.add_argument('--trace-format', choices=('chrome', 'otlp'), help='计时文件格式：Chrome trace JSON或OTLP/JSON')
+    return parser.parse_args(argv)
+
+
+def format_proxies(proxies):
+    # 清单中的代理可以是地址列表或{代理编号: 地址}，统一为下载阶段使用的{代理编号: {'http': url, 'https': url}}
+    if isinstance(proxies, str):
+        proxies = [proxies]
+    if isinstance(proxies, list):
+        proxies = {str(i): proxy for i, proxy in enumerate(proxies, start=1)}
+    return {key: proxy if isinstance(proxy, dict) else {'http': proxy, 'https': proxy} for key, proxy in proxies.items()}
+
+
+def load_batch(args):
+    manifest = {}
+    if args.manifest is not None:
+        with open(args.manifest, 'r', encoding='utf-8') as f:
+            manifest = json.load(f)
+        if isinstance(manifest, list):
+            manifest = {'tasks': manifest}
+    settings = dict(default_settings)
+    settings.update(manifest.get('settings', {}))
+    for key in setting_args:
+        if getattr(args, key) is not None:
+            settings[key] = getattr(args, key)
+    if args.proxy is not None:
+        settings['proxies'] = args.proxy
+    settings['proxies'] = format_proxies(settings['proxies'] or {})
+    output = args.output or manifest.get('output') or '.'
+    defaults = dict(manifest.get('defaults', {}))
+    defaults.setdefault('output', output)
+    tasks = [dict(defaults, **task) for task in manifest.get('tasks', [])]
+    if args.dataset is not None:
+        task = dict(defaults)
+        task.update({key: getattr(args, key) for key in task_args if getattr(args, key) is not None})
+        if args.wkt_file is not None:
+            with open(args.wkt_file, 'r', encoding='utf-8') as f:
+                task['wkt'] = f.read().strip()
+        if args.no_shp:
+            task['is_export_shp'] = False
+        tasks.append(task)
+    parallel = args.parallel or manifest.get('parallel', 2)
+    status = args.status or manifest.get('status') or os.path.join(output, 'batch_status.json')
+    return tasks, settings, parallel, status
+
+
+def export_tiles(args):
+    # 导出不访问网络，不需要谷歌账户和代理；--bands与下载时相同，以逗号分隔
+    stop_event = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stop_event.set())
+    try:
+        if args.nev is None or args.dataset is None:
+            raise ValueError('导出瓦片需要指定--nev和--dataset')
+        exporter = TileExporter(args.nev, args.export_tiles, dataset_name(args.dataset), args.tile_format, args.min_zoom, args.bands or None,
+                                stop_event)
+        exported = exporter.export()
+    except (OSError, ValueError, sqlite3.Error) as e:
+        print(e, file=sys.stderr)
+        return 2
+    print(f'已导出{exported}个瓦片：{args.export_tiles}')
+    return 1 if stop_event.is_set() else 0
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.export_tiles is not None:
+        return export_tiles(args)
+    try:
+        tasks, settings, parallel, status = load_batch(args)
+        if not tasks:
+            raise ValueError('未指定任务，请使用--dataset或--manifest')
+        if not settings['service_account'] or not settings['json_file']:
+            raise ValueError('未指定谷歌服务账户或JSON-KEY')
+        if not settings['proxies']:
+            raise ValueError('未指定代理')
+        runner = BatchRunner(tasks, settings, status, parallel)
+    except (OSError, ValueError) as e:
+        print(e, file=sys.stderr)
+        return 2
+    main_pid = os.getpid()
+
+    def on_terminate(signum, frame):
+        # 工作进程继承该处理函数时按默认方式退出
+        if os.getpid() != main_pid:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+            return
+        runner.stop()
+
+    signal.signal(signal.SIGTERM, on_terminate)
+    return 0 if runner.run() else 1
+
+
+if __name__ == '__main__':
+    multiprocessing.freeze_support()
+    sys.exit(main())
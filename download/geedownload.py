@@ -22,8 +22,52 @@ from shapely.validation import make_valid
 from shapely.wkt import dumps, loads
 from dbutils.pooled_db import PooledDB
 from urllib3 import Retry
-from threading import Condition
+from threading import Condition, Lock, Semaphore
 from map_engine import map_engine
+from download import telemetry
+from progress import TileProgress, StageMetrics, Tracer
+from query import TileQuery, LegacyTables
+
+ee_session = None
+
+
+def initialize_ee(ee_initialize, proxies=None):
+    # 常驻工作进程中复用已认证的EE会话，凭据或代理变化时才重新认证
+    global ee_session
+    if proxies is not None and proxies.get('http') is not None:
+        os.environ['https_proxy'] = proxies['http']
+    session = (tuple(ee_initialize), os.environ.get('https_proxy'))
+    if ee_session != session:
+        credentials = ee.ServiceAccountCredentials(ee_initialize[0], ee_initialize[1])
+        ee.Initialize(credentials=credentials, project=ee_initialize[2])
+        ee_session = session
+
+
+class RequestLimiter:
+    """
+    限制同时进行的EE请求数，上限由get_limit()读取（调度器写入共享进度块），运行中可调整，上限为空时不限制
+    """
+    def __init__(self, get_limit):
+        self.get_limit = get_limit
+        self.active = 0
+        self.condition = Condition()
+
+    def __enter__(self):
+        with self.condition:
+            while True:
+                limit = self.get_limit()
+                if not limit or self.active < limit:
+                    break
+                # 上限调高时不会收到通知，定时重新读取
+                self.condition.wait(1)
+            self.active = self.active + 1
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        with self.condition:
+            self.active = self.active - 1
+            # 唤醒全部等待线程重新读取上限，上限调高后可同时放行多个请求
+            self.condition.notify_all()
 
 
 class GeeImageCalculate:
@@ -58,11 +102,17 @@ class GeeImageCalculate:
         self.final_download_tiles = []
         self.progress_info = calculate_progress_info
         self.queue = queue
+        self.queue_lock = Lock()
+        self.last_queued = None
         self.process_done = calculate_process_done
 
     def write_to_queue(self):
-        data = (self.progress_info, self.process_done, self.taskname)
-        self.queue.put_nowait(data)
+        # 计数和状态位已写入共享内存，队列只发送进程状态和非计数信息，且仅在内容变化时发送
+        with self.queue_lock:
+            data = (self.progress_info.extras(), dict(self.process_done), self.taskname)
+            if data != self.last_queued:
+                self.last_queued = data
+                self.queue.put_nowait(data)
 
     def database_conn(self):
         if os.path.exists(os.path.join(self.savepath, f'{self.taskname}.nev')):
@@ -242,8 +292,7 @@ class GeeImageCalculate:
     def worker(self):
         os.environ['https_proxy'] = self.proxies['http']
         self.insert_task_info()
-        credentials = ee.ServiceAccountCredentials(self.ee_initialize[0], self.ee_initialize[1])
-        ee.Initialize(credentials=credentials, project=self.ee_initialize[2])
+        initialize_ee(self.ee_initialize)
         self.download_size_test()
         if not self.is_rectangle:
             self.tile_calculate_task()
@@ -448,13 +497,27 @@ class GeeImageDownload:
         self.objective = objective
         self.pool_count = multiprocessing.cpu_count()
         self.progress_info = progress_info
+        self.queue_lock = Lock()
+        self.last_queued = None
         self.condition = Condition()
         self.bands = []
         self.signal = signal
+        # 同时提交到线程池的瓦片数上限，停止时只需等待这些瓦片完成
+        self.max_in_flight = 80
+        self.in_flight = Semaphore(self.max_in_flight)
+        self.telemetry = None
+        self.request_limiter = RequestLimiter(lambda: self.progress_info.get('ee_request_limit'))
+        self.metrics = StageMetrics()
+        self.tracer = Tracer(os.path.join(os.path.dirname(self.savepath), 'trace'), f'{self.taskname}_download')
 
     def write_to_queue(self):
-        data = (self.progress_info, self.process_done, self.taskname)
-        self.queue.put(data)
+        # 计数和状态位已写入共享内存，队列只发送进程状态和非计数信息，且仅在内容变化时发送
+        with self.queue_lock:
+            self.progress_info['metrics'] = self.metrics.snapshot()
+            data = (self.progress_info.extras(), dict(self.process_done), self.taskname)
+            if data != self.last_queued:
+                self.last_queued = data
+                self.queue.put(data)
 
     def get_ee_object(self):
         if self.bands is None:
@@ -471,27 +534,10 @@ class GeeImageDownload:
                 self.ee_object = {'default': ee.Image('USGS/GMTED2010_FULL')}
         return self.ee_object
 
-    def download_info(self):
-        conn = self.database_session.connection()
-        cur = conn.cursor()
-        cur.execute('create table if not exists download_info(table_name text primary key, total int, success int, fail int, start_time float,end_time float)')
-        try:
-            cur.execute(
-                "insert into download_info(table_name,total,success,fail) select name,0,0,0 FROM sqlite_master WHERE type='table' and name like 'tiles_%' and name not like '%rs%'")
-            conn.commit()
-        except Exception as e:
-            pass
-        table = cur.execute("select name FROM sqlite_master WHERE type='table' and name like 'tiles_%'")
-        for table_name in table.fetchall():
-            cur.execute(f"update download_info set total = (select count(1) from {table_name[0]}) where table_name='{table_name[0]}'")
-        conn.commit()
-        conn.close()
-
     def get_download_progress(self):
         conn = self.database_session.connection()
         cur = conn.cursor()
-        download_progress_all_res = cur.execute('select sum(total),sum(success),sum(fail),min(start_time),max(end_time) from download_info')
-        total, success, fail, all_st_time, all_ed_time = download_progress_all_res.fetchone()
+        total, success, fail, all_st_time, all_ed_time = TileProgress.download_summary(cur)
         if (success + fail) / total != 1:
             all_ed_time = None
         self.progress_info['download_total'] = total
@@ -503,57 +549,45 @@ class GeeImageDownload:
         conn.close()
 
     def reshape_table(self):
+        # 以分区列part_id代替按分区拆表：每splite_size行瓦片划为一个分区，同一x(或y)值的瓦片总落在同一分区，part_id为0表示不分区
         conn = self.database_session.connection()
         cur = conn.cursor()
-        table_sql = "SELECT name FROM sqlite_master WHERE type='table' and name like 'tiles_%' and name not like 'tiles_%_part_%' and name<>'tiles_10' and name not like '%rs%'"
-        try:
-            cur.execute(f'create table if not exists "tiles_10_rs" as select * from "tiles_10" where 1=2')
-        except Exception as e:
-            pass
+        # 升级前创建的.nev先合并分区表并初始化进度计数
+        LegacyTables.upgrade(cur)
+        conn.commit()
+        table_sql = "SELECT name FROM sqlite_master WHERE type='table' and name like 'tiles_%' and name not like '%rs%'"
         table_name_result = cur.execute(table_sql)
         table_names = table_name_result.fetchall()
+        TileProgress.create_table(cur)
         for rows in table_names:
             table_name = rows[0]
-            counts = cur.execute(f"select count(*) from {table_name}")
-            num = counts.fetchone()[0] // self.splite_size
-            if num > 0:
-                x = cur.execute(f"select x from {table_name} order by x")
-                x_all = x.fetchall()
-                if x_all[-1][0] - x_all[0][0] > num * 2:
-                    for i in range(num + 1):
-                        x_splite_start = x_all[i * self.splite_size][0]
-                        try:
-                            x_splite_end = x_all[(i + 1) * self.splite_size][0]
-                        except:
-                            x_splite_end = x_all[-1][0] + 1
-                        cur.execute(f'drop table if exists "{table_name}_part_{i + 1}"')
-                        create_sql = f'create table "{table_name}_part_{i + 1}" as select * from "{table_name}" where x < {x_splite_end} and x >= {x_splite_start}'
-                        create_sql2 = f'create table if not exists "{table_name}_part_{i + 1}_rs" as select * from "{table_name}" where 1=2'
-                        cur.execute(create_sql)
-                        cur.execute(create_sql2)
-                else:
-                    y = cur.execute(f"select y from {table_name} order by y")
-                    y_all = y.fetchall()
-                    for i in range(num + 1):
-                        y_splite_start = y_all[i * self.splite_size][0]
-                        try:
-                            y_splite_end = y_all[(i + 1) * self.splite_size][0]
-                        except:
-                            y_splite_end = y_all[-1][0] + 1
-                        cur.execute(f'drop table if exists "{table_name}_part_{i + 1}"')
-                        create_sql = f'create table "{table_name}_part_{i + 1}" as select * from "{table_name}" where y < {y_splite_end} and y >= {y_splite_start}'
-                        create_sql2 = f'create table if not exists "{table_name}_part_{i + 1}_rs" as select * from "{table_name}" where 1=2'
-                        cur.execute(create_sql)
-                        cur.execute(create_sql2)
-                cur.execute(f'drop table "{table_name}"')
-            else:
-                cur.execute(f'create table if not exists "{table_name}_rs" as select * from "{table_name}" where 1=2')
+            columns = [column[1] for column in cur.execute(f'pragma table_info("{table_name}")').fetchall()]
+            if 'part_id' not in columns:
+                cur.execute(f'alter table "{table_name}" add column part_id integer not null default 0')
+            # 分区索引在分区编号提交后才创建，索引不存在即说明分区编号尚未完成（含中途中断的情况）
+            index_res = cur.execute("select count(1) from sqlite_master where type='index' and name = ?", (f'{table_name}_part_index',))
+            if index_res.fetchone()[0] == 0:
+                counts = cur.execute(f'select count(*), max(x) - min(x) from "{table_name}"')
+                count, x_span = counts.fetchone()
+                num = count // self.splite_size
+                if num > 0 and table_name != 'tiles_10':
+                    axis = 'x' if x_span > num * 2 else 'y'
+                    # count(*) over (order by x) 统计小于等于当前x的行数，一次SQL完成全部分区编号
+                    cur.execute(f'update "{table_name}" set part_id = p.part_id from (select rowid as rid, (count(*) over (order by {axis}) - 1) / '
+                                f'{self.splite_size} + 1 as part_id from "{table_name}") as p where "{table_name}".rowid = p.rid')
+                # 进度计数与分区编号同一事务写入，此后只做增量更新
+                TileProgress.init_total(cur, table_name)
+                conn.commit()
+            cur.execute(f'create index if not exists "{table_name}_part_index" on "{table_name}" (part_id, x, y)')
+            cur.execute(f'create table if not exists "{table_name}_rs" as select * from "{table_name}" where 1=2')
+            cur.execute(f'create index if not exists "{table_name}_rs_part_index" on "{table_name}_rs" (part_id, x, y, z)')
+            conn.commit()
         conn.close()
 
     def get_cropping_size(self, table_name):
         conn = self.database_session.connection()
         cur = conn.cursor()
-        result = cur.execute(f'select width,height from {table_name} limit 1')
+        result = TileQuery.execute(cur, 'tile_size', table_name)
         rs = result.fetchall()
         self.cropping_size_width = rs[0][0] + 2
         self.cropping_size_height = rs[0][1] + 2
@@ -580,25 +614,22 @@ class GeeImageDownload:
             for rows in table_names:
                 table_name = rows[0]
                 self.get_cropping_size(table_name)
-                cur.execute(
-                    f"update download_info set start_time= case when start_time is null then {time.time()} else start_time end where table_name = '{table_name}'")
+                TileProgress.set_start_time(cur, table_name, time.time())
                 conn.commit()
-                sql = (
-                    f'select x,y,z,bands,geometry,width,height from "{table_name}" where (x,y,z,bands) in (select x,y,z,bands from "{table_name}_rs" where status = -1) '
-                    f'or (x,y,z,bands) not in (select x,y,z,bands from "{table_name}_rs")')
-                download_paramete_result = cur.execute(sql)
+                # is_retry标记此前下载失败的瓦片，写入结果时据此修正失败计数
+                download_paramete_result = TileQuery.execute(cur, 'download_parameter', table_name)
                 while True:
                     row = download_paramete_result.fetchone()
                     if not row:
-                        cur.execute(
-                            f"update download_info set start_time= case when end_time is null then {time.time()} else end_time end where table_name = '{table_name}'")
+                        TileProgress.set_end_time(cur, table_name, time.time())
                         conn.commit()
                         break
-                    x, y, z, bands, geometry, width, height = row
-                    yield x, y, z, bands, width, height, geometry, table_name
+                    x, y, z, bands, geometry, width, height, part_id, is_retry = row
+                    yield x, y, z, bands, width, height, geometry, table_name, part_id, bool(is_retry)
         except Exception as e:
             return None
-        conn.close()
+        finally:
+            conn.close()
 
     def get_proxies(self):
         random_value = random.choice(list(self.all_proxies.values()))
@@ -620,34 +651,41 @@ class GeeImageDownload:
             creator=sqlite3,  # 使用sqlite3作为数据库连接
             maxconnections=30,  # 最多30个连接
             database=self.savepath,
-            check_same_thread=False
+            check_same_thread=False,
+            cached_statements=TileQuery.cached_statements
         )
         self.database_session = engine
         return self.database_session
 
-    def listening(self):  # 监听来自主进程的终止信号，如果有，安全关闭进程
-        while True:
-            if self.signal.is_set() or self.download_complete or self.exception is not None:
-                if self.signal.is_set() or self.exception is not None:
-                    for f in self.futures:
-                        f.cancel()
-                break
-            time.sleep(1)
+    def is_stopping(self):
+        return self.signal.is_set() or self.exception is not None
+
+    def submit_downloads(self, executor):
+        # 按在途上限逐个提交瓦片，收到停止信号或写入异常后不再取新的瓦片
+        download_parameters = self.get_download_parameter()
+        try:
+            for download_parameter in download_parameters:
+                while not self.in_flight.acquire(timeout=1):
+                    if self.is_stopping():
+                        return
+                if self.is_stopping():
+                    self.in_flight.release()
+                    return
+                executor.submit(self.download, download_parameter).add_done_callback(lambda future: self.in_flight.release())
+        finally:
+            download_parameters.close()
 
     def multiworker(self):
         self.download_count = 0
         self.create_network_session()
         os.environ['https_proxy'] = self.proxies['http']
-        credentials = ee.ServiceAccountCredentials(self.ee_initialize[0], self.ee_initialize[1])
-        ee.Initialize(credentials=credentials, project=self.ee_initialize[2])
+        initialize_ee(self.ee_initialize)
         self.database_conn_pool()
+        self.telemetry = telemetry.DownloadTelemetry(self.taskname, os.path.join(os.path.dirname(self.savepath), 'telemetry'))
         self.reshape_table()
-        self.download_info()
         self.get_bands()
         self.get_ee_object()
         self.get_download_progress()
-        listening_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-        listening_thread.submit(self.listening)
         to_sqlite_results = []
         to_sqlite_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         to_sqlite_result = to_sqlite_thread.submit(self.to_sqlite)
@@ -655,33 +693,53 @@ class GeeImageDownload:
         self.progress_info['this_st_time'] = time.time()
         self.write_to_queue()
         with concurrent.futures.ThreadPoolExecutor(max_workers=40) as executor:
-            # 同时提交多个任务给线程池执行下载任务
-            self.futures = [executor.submit(self.download, download_parameter) for download_parameter in self.get_download_parameter()]
+            self.submit_downloads(executor)
+        # 在途瓦片均已完成，写入线程取完结果队列后提交并结束
+        self.download_complete = True
         if self.exception is not None:
             raise self.exception
-        self.download_complete = True
         concurrent.futures.wait(to_sqlite_results)
+        if self.signal.is_set():
+            # 停止时已下载的瓦片全部写入数据库，告知主进程可以安全结束
+            self.process_done['is_drained'] = True
+            self.write_to_queue()
+            return
         self.progress_info['is_task_complete'] = True
         self.write_to_queue()
 
     def download(self, parameter: tuple):
+        # 已提交但尚未开始的瓦片在停止时跳过，续传时重新下载
+        if self.is_stopping():
+            return
         with self.condition:
-            while self.download_results.qsize() > 10000:
-                self.condition.wait()
+            while self.download_results.qsize() > 10000 and not self.is_stopping():
+                self.condition.wait(1)
         st = time.time()
-        x, y, z, bands, no_buffer_width, no_buffer_height, geometry, table_name = parameter
+        x, y, z, bands, no_buffer_width, no_buffer_height, geometry, table_name, part_id, is_retry = parameter
+        # 按瓦片抽样记录各步骤耗时，未抽中时trace为None，各span不做任何记录
+        trace = self.tracer.sample()
         region = GeeImageCalculate.wkt_to_eegeometry(geometry)
         try:
-            if bands is not None:
-                if self.objective == 'Global Multi-resolution Terrain':
-                    image = geemap.ee_to_numpy(ee_object=self.ee_object['default'], bands=[bands,], scale=self.scale, region=region)  # 从接口获取numpy数组形式图像
-                elif self.objective == 'CFSV2':
-                    image = geemap.ee_to_numpy(ee_object=self.ee_object[bands], scale=self.scale, region=region)
-            else:
-                if self.objective == 'Dynamic World':
-                    image = geemap.ee_to_numpy(ee_object=self.ee_object['default'], scale=self.scale, region=region)
-                if self.objective == 'JRC Monthly Water History':
-                    image = geemap.ee_to_numpy(ee_object=self.ee_object['default'], scale=self.scale, region=region)
+            # 全局调度器分配给本任务的EE并发请求数
+            slot_wait = self.tracer.now() if trace is not None else None
+            with self.request_limiter:
+                self.tracer.add_span('ee_slot_wait', trace, slot_wait)
+                if self.is_stopping():
+                    return
+                # 请求耗时不包含等待并发名额的时间
+                st = time.time()
+                # ee_to_numpy在请求内完成NPY解码，解码耗时计入ee_request
+                with self.tracer.span('ee_request', trace, x=x, y=y, z=z, bands=bands):
+                    if bands is not None:
+                        if self.objective == 'Global Multi-resolution Terrain':
+                            image = geemap.ee_to_numpy(ee_object=self.ee_object['default'], bands=[bands,], scale=self.scale, region=region)  # 从接口获取numpy数组形式图像
+                        elif self.objective == 'CFSV2':
+                            image = geemap.ee_to_numpy(ee_object=self.ee_object[bands], scale=self.scale, region=region)
+                    else:
+                        if self.objective == 'Dynamic World':
+                            image = geemap.ee_to_numpy(ee_object=self.ee_object['default'], scale=self.scale, region=region)
+                        if self.objective == 'JRC Monthly Water History':
+                            image = geemap.ee_to_numpy(ee_object=self.ee_object['default'], scale=self.scale, region=region)
             # 获取图像的高度和宽度
             height, width = image.shape[:2]
             if self.cropping_size_height < height and self.cropping_size_width < width:
@@ -693,27 +751,37 @@ class GeeImageDownload:
                 crop_x2 = crop_x1 + self.cropping_size_width  # 右边界
                 crop_y2 = crop_y1 + self.cropping_size_height  # 下边界
                 # 裁剪图像
-                image = image[crop_y1:crop_y2, crop_x1:crop_x2]
+                with self.tracer.span('crop', trace):
+                    image = image[crop_y1:crop_y2, crop_x1:crop_x2]
             # success, image = cv2.imencode('.tif', image)  # 将裁剪后的图像重新编码为 .tif 格式
             if str(image.dtype) in ('float16', 'float32', 'float64') and self.bands is None:
-                image = self.normalize8(image)
+                with self.tracer.span('normalize', trace):
+                    image = self.normalize8(image)
             if image.shape[-1] == 3:
-                image[:, :, [0, 1, 2]] = image[:, :, [2, 1, 0]]
-            finial_image = image.tobytes()  # 返回字节流数据
+                with self.tracer.span('bgr_swap', trace):
+                    image[:, :, [0, 1, 2]] = image[:, :, [2, 1, 0]]
+            with self.tracer.span('to_bytes', trace):
+                finial_image = image.tobytes()  # 返回字节流数据
             dtype = str(image.dtype)
             shape = str(image.shape)
             bands = bands
             status = 1
             error = None
+            error_class = None
         except Exception as e:
             finial_image = None
             dtype = None
             shape = None
-            bands = None
             status = -1
             error = str(e)
-        cost = time.time() - st
-        self.download_results.put((table_name, x, y, z, finial_image, dtype, shape, bands, status, no_buffer_width, no_buffer_height, error, cost))
+            error_class = type(e).__name__
+        ed = time.time()
+        cost = ed - st
+        self.telemetry.record(table_name, part_id, x, y, z, bands, self.proxies.get('http'), st, ed, 0 if finial_image is None else len(finial_image),
+                              bool(is_retry), status, error_class, error)
+        # 抽中的瓦片附带入队时间，写入线程取出时记录在结果队列中的等待时间
+        self.download_results.put((table_name, x, y, z, finial_image, dtype, shape, bands, status, no_buffer_width, no_buffer_height, error, cost, part_id, is_retry,
+                                   trace, self.tracer.now() if trace is not None else None))
         self.download_count = self.download_count + 1
 
     @staticmethod
@@ -730,6 +798,12 @@ class GeeImageDownload:
         while True:
             try:
                 # 如果队列中已无值，且下载已完成，结束数据库写入
+                if self.download_results.empty() and self.download_complete and self.signal.is_set():
+                    # 停止时只提交已写入的结果，索引与去重在续传完成时进行
+                    conn.commit()
+                    self.telemetry.close()
+                    self.tracer.close()
+                    break
                 if self.download_results.empty() and self.download_complete:
                     all_tables = cur.execute("SELECT name FROM sqlite_master WHERE type='table' and name like 'tiles_%' and name like '%rs%'")
                     for row in all_tables.fetchall():
@@ -758,8 +832,14 @@ class GeeImageDownload:
                                f'HAVING count(*)>1)))')
                         cur.execute(sql)
                     conn.commit()
+                    self.telemetry.close()
+                    self.tracer.close()
                     break
                 download_result = []
+                # 重试成功的瓦片，写入时删除其失败记录
+                retried_result = []
+                # 按(part_id, z, bands)汇总本批次的成功/失败计数增量
+                progress_counters = {}
                 table_name_last = None
                 download_success = 0
                 download_fail = 0
@@ -772,31 +852,55 @@ class GeeImageDownload:
                         break
                     table_name = download[0]
                     if table_name == table_name_last or table_name_last is None:
+                        self.tracer.add_span('queue_wait', download[15], download[16], x=download[1], y=download[2], z=download[3])
                         download_result.append({'x': download[1], 'y': download[2], 'z': download[3], 'image': download[4], 'dtype': download[5],
                                                 'shape': download[6], 'bands': download[7], 'status': download[8], 'width': download[9], 'height': download[10],
-                                                'error': download[11], 'cost': download[12]})
+                                                'error': download[11], 'cost': download[12], 'part_id': download[13]})
+                        counter = progress_counters.setdefault((download[13], download[3], download[7]), [0, 0])
+                        self.metrics.observe('tile_cost_seconds', download[12])
                         if download[8] == 1:
                             download_success = download_success + 1
+                            counter[0] += 1
+                            # 重试成功的瓦片从失败计数中移除
+                            if download[14]:
+                                counter[1] -= 1
+                                retried_result.append({'part_id': download[13], 'x': download[1], 'y': download[2], 'z': download[3], 'bands': download[7]})
                         else:
                             download_fail = download_fail + 1
+                            if not download[14]:
+                                counter[1] += 1
                         table_name_last = table_name
                     elif table_name_last != table_name and table_name_last is not None:
                         self.download_results.put(download)
                         break
                 if len(download_result) != 0:
+                    # 写入按批次进行，每个批次都记录
+                    trace = self.tracer.trace()
                     # 构造SQL批量插入语句
-                    insert_sql = (f'INSERT INTO "{table_name_last}_rs" (x,y,z,image,dtype,shape,bands,status,width,height,error,cost) '
-                                  f'VALUES(:x,:y,:z,:image,:dtype,:shape,:bands,:status,:width,:height,:error,:cost)')
-                    cur.executemany(insert_sql, download_result)
-                    cur.execute(f'update download_info set success = success + {download_success} where table_name = "{table_name_last}"')
-                    # conn.execute(text(f'update download_info set fail = fail + {download_fail} where table_name = "{table_name_last}"'))
-                    conn.commit()
-                    self.progress_info['download_success'] = self.progress_info['download_success'] + download_success
-                    self.progress_info['download_fail'] = self.progress_info['download_fail'] + download_fail
+                    with self.tracer.span('sqlite_insert', trace, tiles=len(download_result)):
+                        TileQuery.executemany(cur, 'insert_result', f'{table_name_last}_rs', download_result)
+                        TileQuery.executemany(cur, 'delete_failed', f'{table_name_last}_rs', retried_result)
+                        TileProgress.add_download_results(cur, table_name_last, progress_counters)
+                    commit_time = time.time()
+                    with self.tracer.span('sqlite_commit', trace):
+                        conn.commit()
+                    self.metrics.observe('sqlite_commit_seconds', time.time() - commit_time)
+                    # 每个下载进程只使用一个代理，按批次累计该代理的成功、失败数
+                    self.metrics.add('proxy_requests', download_success, proxy=self.proxies.get('http'), status='success')
+                    self.metrics.add('proxy_requests', download_fail, proxy=self.proxies.get('http'), status='fail')
+                    self.metrics.set('inflight_requests', self.request_limiter.active)
+                    self.metrics.set('result_queue_depth', self.download_results.qsize())
+                    self.telemetry.flush()
+                    self.progress_info.add('download_success', download_success)
+                    self.progress_info.add('download_fail', download_fail)
                     self.write_to_queue()
             except Exception as e:
                 print(e)
                 self.exception = e
+                # 写入出错后下载随之停止，关闭遥测与追踪文件（Parquet写入文件尾）后结束写入
+                self.telemetry.close()
+                self.tracer.close()
+                break
         conn.close()
 
 
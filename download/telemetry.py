@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import os
+import time
+import pyarrow as pa
+import pyarrow.parquet as pq
+from threading import Lock
+
+
+class DownloadTelemetry:
+    """
+    下载遥测：每个瓦片的下载记录（瓦片编号、代理、起止时间、字节数、是否为续传时的重试、错误类型）按批次写入独立的Parquet文件，
+    与.nev中的瓦片数据分离，便于跨任务分析吞吐、长尾耗时和失败分布
+    """
+    schema = pa.schema([
+        ('taskname', pa.string()),
+        ('table_name', pa.string()),
+        ('part_id', pa.int32()),
+        ('x', pa.int64()),
+        ('y', pa.int64()),
+        ('z', pa.int32()),
+        ('bands', pa.string()),
+        ('proxy', pa.string()),
+        ('start_time', pa.float64()),
+        ('end_time', pa.float64()),
+        ('cost', pa.float64()),
+        ('bytes', pa.int64()),
+        # 该瓦片此前是否下载失败，.nev中不保存尝试次数
+        ('is_retry', pa.bool_()),
+        ('status', pa.int8()),
+        ('error_class', pa.string()),
+        ('error', pa.string()),
+    ])
+
+    def __init__(self, taskname: str, telemetry_path: str, batch_size=5000):
+        self.taskname = taskname
+        self.batch_size = batch_size
+        self.records = []
+        self.lock = Lock()
+        self.writer = None
+        os.makedirs(telemetry_path, exist_ok=True)
+        # 每次运行（含续传）单独生成一个文件，避免覆盖此前的记录
+        self.telemetry_file = os.path.join(telemetry_path, f'{taskname}_{int(time.time())}.parquet')
+
+    def record(self, table_name, part_id, x, y, z, bands, proxy, start_time, end_time, size, is_retry, status, error_class, error):
+        with self.lock:
+            self.records.append((self.taskname, table_name, part_id, x, y, z, bands, proxy, start_time, end_time, end_time - start_time, size, is_retry,
+                                 status, error_class, error))
+
+    def flush(self, force=False):
+        with self.lock:
+            if len(self.records) == 0 or (not force and len(self.records) < self.batch_size):
+                return
+            records = self.records
+            self.records = []
+        columns = list(zip(*records))
+        batch = pa.RecordBatch.from_arrays([pa.array(column, type=field.type) for column, field in zip(columns, self.schema)], schema=self.schema)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.telemetry_file, self.schema, compression='zstd')
+        self.writer.write_batch(batch)
+
+    def close(self):
+        self.flush(force=True)
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
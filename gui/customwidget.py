@@ -244,7 +244,7 @@ class TaskListgWidget(QWidget):
             try:
                 if self.main_instance.subprocess.progress_info_dict[f'{self.task_name}']['target'] == 'TileDownload':
                     if len(self.speed_calculate_list) >= 24:
-                        remaining_time = self.main_instance.exists_task.loc[self.main_instance.exists_task['taskname'] == self.task_name, 'remaining_time'][0]
+                        remaining_time = self.main_instance.exists_task.loc[self.main_instance.exists_task['taskname'] == self.task_name, 'remaining_time'].iloc[0]
                         if remaining_time is not None:
                             formatted_time = self.format_time(remaining_time)
                         else:
@@ -257,8 +257,18 @@ class TaskListgWidget(QWidget):
     def when_task_executing(self):
         try:
             if self.this_start_time is None:
-                self.this_start_time = self.main_instance.exists_task.loc[self.main_instance.exists_task['taskname'] == self.task_name, 'this_start_time'][0]
-            info_dict = self.main_instance.subprocess.progress_info_dict[self.task_name]
+                self.this_start_time = self.main_instance.exists_task.loc[self.main_instance.exists_task['taskname'] == self.task_name, 'this_start_time'].iloc[0]
+            queue_position = self.main_instance.subprocess.queue_position(self.task_name)
+            if queue_position is not None:
+                # 等待全局调度器准入
+                position, target, reason = queue_position
+                cost = time.time() - self.this_start_time
+                self.cost_time_label.setText(f'用时：{self.format_time(cost)}')
+                queue_label = self.stitch_progress_label if target == 'TileStitch' else self.download_progress_label
+                queue_label.setText(f'排队中（第{position}位）' if reason is None else f'排队中（第{position}位，{reason}）')
+                return
+            # 进度显示自行读取共享内存快照，状态转换由任务调度线程处理
+            info_dict = self.main_instance.orchestrator.read_progress(self.task_name)
             target = info_dict['target']
             e = self.main_instance.subprocess.process_done_dict[self.task_name][f'{target}_exception']
             if e is not None:
@@ -275,7 +285,7 @@ class TaskListgWidget(QWidget):
                 self.delete_task_button.setEnabled(True)
                 self.pause_button.setIcon(QIcon("resources/icon/start.png"))
                 self.task_timer.stop()  # 关闭进度显示定时器
-                self.main_instance.close_task_timer(self.task_name)  # 关闭任务定时器
+                self.main_instance.stop_task(self.task_name)  # 停止任务状态转换
                 # 切换dataframe中任务执行状态
                 self.main_instance.exists_task.loc[self.main_instance.exists_task['taskname'] == f'{self.task_name}', 'is_executing'] = False
                 self.is_task_executing = False  # 切换自身任务执行状态
@@ -471,7 +481,7 @@ class TaskListgWidget(QWidget):
             self.is_task_closed.start(100)  # 启用定时器
             self.stitch_progress_label.setText('')
             self.pause_button.setIcon(QIcon("resources/icon/start.png"))
-            self.main_instance.close_task_timer(self.task_name)  # 关闭任务定时器
+            self.main_instance.stop_task(self.task_name)  # 停止任务状态转换
             self.is_task_executing = False  # 切换自身任务执行状态
             self.main_instance.exists_task.loc[self.main_instance.exists_task['taskname'] == f'{self.task_name}', 'remaining_time'] = None
             self.main_instance.exists_task.loc[self.main_instance.exists_task['taskname'] == f'{self.task_name}', 'speed_calculate_list'] = None
@@ -482,7 +492,7 @@ class TaskListgWidget(QWidget):
             # self.stitch_progress_bar.setFloatValue(0)
             self.remaining_time_label.setVisible(False)
         elif not self.is_task_executing:
-            rs = self.main_instance.task_execute(self.main_instance.task_path / f'{self.task_name}.xml')
+            rs = self.main_instance.task_execute(self.task_name)
             if rs:
                 self.download_progress_label.setText('正在启动后台进程')
                 self.cost_time_label.show()
@@ -654,13 +664,17 @@ class ConfirmDeleteDialog(QDialog):
 
     def confirm_delete(self):
         try:
-            self.main_instance.main_instance.close_task_timer(self.main_instance.task_name)
+            self.main_instance.main_instance.stop_task(self.main_instance.task_name)
         except:
             pass
         try:
             self.main_instance.main_instance.subprocess.closeone(self.main_instance.task_name)
         except:
             pass
+        try:
+            self.main_instance.main_instance.task_store.delete(self.main_instance.task_name)
+        except:
+            pass
         if self.checkbox.isChecked():
             try:
                 shutil.rmtree(self.main_instance.path)
@@ -668,10 +682,6 @@ class ConfirmDeleteDialog(QDialog):
                 self.main_instance.main_instance.show_msg_box('部分文件被占用，请关闭程序后手动删除')
             except Exception as e:
                 print(e)
-        try:
-            os.remove(self.main_instance.main_instance.task_path / f'{self.main_instance.task_name}.xml')
-        except:
-            pass
         try:
             self.main_instance.main_instance.exists_task = (self.main_instance.main_instance.exists_task
                                                             )[self.main_instance.main_instance.exists_task['taskname'] != f'{self.main_instance.task_name}']
@@ -3,7 +3,6 @@
 # Date: 2025/2/13
 
 import os
-import signal
 import socket
 import threading
 import traceback
@@ -18,6 +17,7 @@ import tempfile
 import uuid
 import webbrowser
 import geojson
+import json
 import geopandas
 import numpy
 import requests
@@ -39,7 +39,8 @@ from gui import customwidget
 from shapely.wkt import loads, dumps
 from BlurWindow.blurWindow import GlobalBlur
 from map_engine import map_engine
-from multiprocess_manager import auth_proxy_testing as ts, multiprocess_manager
+from progress import Tracer
+from multiprocess_manager import auth_proxy_testing as ts, metrics_server, multiprocess_manager, task_orchestrator, task_store
 from PySide6.QtNetwork import QNetworkProxy
 from PySide6.QtWebEngineCore import QWebEngineSettings
 from PySide6.QtWebEngineWidgets import QWebEngineView
@@ -55,6 +56,7 @@ class Nevasa:
     export_html_signal = Signal(str)
     datasource_connect_signal = Signal(str)
     active_window_signal = Signal(str)
+    task_event_signal = Signal(str, str, str)
 
     def __init__(self):
         self.os_system = platform.system()
@@ -72,6 +74,18 @@ class Nevasa:
             'max_proxy_server': 1,  # 最大代理服务器数量
             'max_download_fail': 0,  # 允许的最大切片下载失败数量
             'enable_gpu': False,  # 使用GPU进行图像处理（可通过GUI设置）
+            'stream_to_geotiff': False,  # 流式拼接，瓦片直接写入分块GeoTIFF，不生成整幅临时文件（可通过settings.xml设置）
+            'pyramid_levels': 0,  # 拼接后额外输出的低层级数，由下载层级降采样生成（可通过settings.xml设置）
+            'worker_pool_size': 2,  # 常驻工作进程数量，为0时每个任务阶段启动独立进程（可通过settings.xml设置）
+            'job_memory_limit': 0,  # 单个任务阶段的内存上限（MB），为0时不限制（可通过settings.xml设置）
+            'job_time_limit': 0,  # 单个任务阶段的运行时间上限（秒），为0时不限制（可通过settings.xml设置）
+            'max_ee_requests': 40,  # 所有任务同时进行的EE请求数上限（可通过settings.xml设置）
+            'max_stitch_jobs': 1,  # 同时进行的拼接任务数上限（可通过settings.xml设置）
+            'memory_budget': 0,  # 任务进程内存预算（MB），超过后新的任务阶段排队，为0时取物理内存的80%（可通过settings.xml设置）
+            'min_free_disk': 1024,  # 拼接准入时磁盘需保留的空间（MB）（可通过settings.xml设置）
+            'metrics_port': 0,  # 本机Prometheus指标接口端口，为0时不启用（可通过settings.xml设置）
+            'trace_sample_rate': 0,  # 热路径计时的瓦片抽样比例（0~1），为0时不记录，结果写入各任务目录下的trace（可通过settings.xml设置）
+            'trace_format': 'chrome',  # 计时文件格式，chrome或otlp（可通过settings.xml设置）
             'project_id': None,  # 谷歌Projrct_id（可通过GUI设置）
             'json_file': None,  # 谷歌JSON-KEY路径（可通过GUI设置）
             'service_account': None,  # 谷歌服务账户（可通过GUI设置）
@@ -89,18 +103,24 @@ class Nevasa:
             'loading_html_timeout_ms': 25000,  # 数据集加载超时时间
         }
         self.map, self.test = map_engine.GeeMapHtml(), ts.AuthAndKeyTest()
-        self.task_download_times, self.dataset_info = {}, {}
+        self.dataset_info = {}
         self.exists_task, self.exists_dataset = pd.DataFrame(), pd.DataFrame()
         self.task_path, self.setting_path, = self.path / "downloadtask", self.path / "setting"
         self.dataset_path = self.path / "dataset"
         self.log_path, self.numbacache_path = self.path / "log.txt", self.path / "numba_cache"
+        # Numba CPU裁剪内核的编译缓存，需在拼接子进程启动前设置
+        os.environ['NUMBA_CACHE_DIR'] = str(self.numbacache_path)
+        # 任务定义、各阶段完成状态与进度保存在任务登记库中
+        self.task_store = task_store.TaskStore(self.task_path / 'tasks.db')
         self.get_all_settings()
+        self.import_task_xml()
         self.get_all_tasks()
         self.get_all_datasets()
         self.color = 'white' if self.settings['transparent_window'] else 'black'
         self.connection = sqlite3.connect(database='resources/data/data.nev', check_same_thread=False)
-        self.execute_task_timer, self.polygon_from_js, self.test_result_dict = {}, {}, {}
+        self.polygon_from_js, self.test_result_dict = {}, {}
         self.subprocess, self.transform, self.export_html_exception, self.webengine_loaded_geometry = None, None, None, None
+        self.orchestrator, self.metrics_server = None, None
         self.is_eeinitialization_done, self.is_reinitialization_ee, self.no_proxy_notifaction = False, False, False
         self.end_listening_js, self.dataset_html_loaded, self.base_map_change_attention = False, False, False
         self.current_loading_dataset, self.current_loading_visualize, self.current_loading_datasource = None, None, None
@@ -140,6 +160,7 @@ class Nevasa:
         self.export_html_signal.connect(self.load_dataset_html)
         self.datasource_connect_signal.connect(self.customregion_connect_test_result)
         self.active_window_signal.connect(self.mainwindow.show_main_gui)
+        self.task_event_signal.connect(self.on_task_event)
         initialization_ee_thread = threading.Thread(target=self.initialization_ee, daemon=True)
         initialization_ee_thread.start()
         initialization_spatialdata_thread = threading.Thread(target=self.initialization_spatialdata, daemon=True)
@@ -178,8 +199,23 @@ class Nevasa:
 
     def initialization_multiprocessmanager(self):
         try:
-            self.subprocess = multiprocess_manager.MultiprocessManager(self.settings['max_download_fail'], self.task_path)
+            # 工作进程启动时继承计时设置
+            Tracer.configure(self.settings['trace_sample_rate'], self.settings['trace_format'])
+            self.subprocess = multiprocess_manager.MultiprocessManager(self.settings['max_download_fail'], self.task_path,
+                                                                       self.settings['worker_pool_size'], self.settings['job_memory_limit'],
+                                                                       self.settings['job_time_limit'], self.settings['max_ee_requests'],
+                                                                       self.settings['max_stitch_jobs'], self.settings['memory_budget'],
+                                                                       self.settings['min_free_disk'])
+            # 阶段结束时由调度线程立即转入下一阶段，事件经信号转到界面线程处理
+            self.orchestrator = task_orchestrator.TaskOrchestrator(self.subprocess, self.task_store, self.settings['max_download_try'],
+                                                                   stop_on_exception=True,
+                                                                   on_event=lambda taskname, event, data: self.task_event_signal.emit(
+                                                                       taskname, event, '' if data is None else str(data)))
+            if self.settings['metrics_port']:
+                self.metrics_server = metrics_server.MetricsServer(self.subprocess, self.settings['metrics_port'],
+                                                                   manager_lock=self.orchestrator.lock).start()
             print('multiprocessmanager done')
+            self.warm_up_workers()
         except Exception as e:
             print('multiprocessmanage exception', e)
 
@@ -239,6 +275,7 @@ class Nevasa:
                 ee.Initialize(credentials=credentials, project=self.settings['project_id'])
                 self.is_eeinitialization_done = True
                 print('eeinitialization done')
+                self.warm_up_workers()
                 self.ee_initialization_signal.emit("completed")
             else:
                 self.ee_initialization_signal.emit("no available google auth")
@@ -247,6 +284,15 @@ class Nevasa:
             print('eeinitialization exception', e)
             self.ee_initialization_signal.emit("fail")
 
+    def warm_up_workers(self):
+        # 谷歌认证与进程管理器均就绪后，常驻工作进程提前完成EE认证
+        try:
+            if self.subprocess is not None and self.is_eeinitialization_done:
+                ee_initialize = (self.settings['service_account'], self.settings['json_file'], self.settings['project_id'])
+                self.subprocess.warm_up(self.settings['proxies'], ee_initialize)
+        except Exception as e:
+            print('warm up workers exception', e)
+
     def ee_initialization_result(self, message):
         if message == 'fail':
             self.view_toolbutton.setEnabled(False)
@@ -1014,14 +1060,16 @@ class Nevasa:
         else:
             self.newtask_timer = QTimer()
             self.newtask_timer.timeout.connect(lambda: self.newtask_updateprogress(taskname))
-            if os.path.isfile(self.task_path / f'{taskname}.xml'):
+            if self.task_store.get_task(taskname) is not None:
                 msg_box = QMessageBox()
                 self.set_messagebox_stylesheet(msg_box)
                 msg_box.setIcon(QMessageBox.Icon.Question)
                 msg_box.setText("该任务已存在，是否覆盖？")
                 msg_box.setStandardButtons(QMessageBox.StandardButton.Yes | QMessageBox.StandardButton.No)
                 if msg_box.exec() == QMessageBox.StandardButton.Yes:
+                    self.stop_task(taskname)
                     self.subprocess.closeone(taskname)
+                    self.task_store.delete(taskname)
                     try:
                         last_task_downloadpath = self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'downloadpath'].values
                         shutil.rmtree(last_task_downloadpath[0])
@@ -1030,29 +1078,32 @@ class Nevasa:
                         pass
                     self.exists_task = self.exists_task[self.exists_task['taskname'] != f'{taskname}']
                     self.write_settings('last_save_path', downloadpath)
-                    with open(self.task_path / f'{taskname}.xml', 'w', encoding='utf-8') as f:
-                        f.write(task_df.to_xml())
-                    self.exists_task = (
-                        self.exists_task.copy() if task_df.empty else task_df.copy() if self.exists_task.empty else pd.concat([self.exists_task, task_df]))
+                    self.add_task(task_df)
                     self.download_dataset_button.setEnabled(False)
                     self.newtaskwidget.show()
                     self.progress_value = 0
                     self.newtask_timer.start(10)
-                    self.task_execute(self.task_path / f'{taskname}.xml')
+                    self.task_execute(taskname)
                 else:
                     self.newtask_timer.deleteLater()
             else:
                 self.write_settings('last_save_path', downloadpath)
-                with open(self.task_path / f'{taskname}.xml', 'w', encoding='utf-8') as f:
-                    f.write(task_df.to_xml())
-                self.exists_task = (
-                    self.exists_task.copy() if task_df.empty else task_df.copy() if self.exists_task.empty else pd.concat([self.exists_task, task_df]))
+                self.add_task(task_df)
                 self.sort_downloadtasks()
                 self.download_dataset_button.setEnabled(False)
                 self.newtaskwidget.show()
                 self.progress_value = 0
                 self.newtask_timer.start(10)
-                self.task_execute(self.task_path / f'{taskname}.xml')
+                self.task_execute(taskname)
+
+    def add_task(self, task_df):
+        # 任务定义写入任务登记库，并加入任务列表
+        task = json.loads(task_df.to_json(orient='records'))[0]
+        taskname = task.pop('taskname')
+        self.task_store.add_task(taskname, **task)
+        self.task_store.save_done(taskname, {stage: False for stage in task_orchestrator.stage_names}, state='created')
+        task_frame = self.task_frame([self.task_store.get_task(taskname)])
+        self.exists_task = task_frame if self.exists_task.empty else pd.concat([self.exists_task, task_frame], ignore_index=True)
 
     @Slot()
     def on_view_data_button_clicked(self):
@@ -1205,10 +1256,10 @@ class Nevasa:
             self.export_html_signal.emit('1fail')
             self.export_html_exception = e
 
-    def task_execute(self, taskfile):
-        error = None
-        task_parameter = pd.read_xml(taskfile)
-        taskname = task_parameter.loc[0, 'taskname']
+    def task_execute(self, taskname):
+        task_parameter = self.task_store.get_task(taskname)
+        if task_parameter is None:
+            return False
         self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_executing'] = True
         self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_download_failed'] = False
         self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_complete'] = False
@@ -1216,158 +1267,97 @@ class Nevasa:
         self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'this_start_time'] = None
         self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'speed_calculate_list'] = None
         while True:
-            if self.subprocess is not None:
+            if self.orchestrator is not None:
                 break
             time.sleep(0.01)
-        downloadpath = task_parameter.loc[0, 'downloadpath']
-        ee_object = task_parameter.loc[0, 'data_source_lv3']
-        downloadpolygon = task_parameter.loc[0, 'datasetregion']
-        datarangetype = task_parameter.loc[0, 'datarangetype']
+        downloadpath = task_parameter['downloadpath']
+        ee_object = task_parameter['data_source_lv3']
+        downloadpolygon = task_parameter['datasetregion']
+        datarangetype = task_parameter['datarangetype']
         ee_initialize = (self.settings['service_account'], self.settings['json_file'], self.settings['project_id'])
-        start_date = task_parameter.loc[0, 'start_date']
-        end_date = task_parameter.loc[0, 'end_date']
-        scale = task_parameter.loc[0, 'data_scale']
-        bands = task_parameter.loc[0, 'bands']
-        if isinstance(bands, float) and numpy.isnan(bands):
+        start_date = task_parameter['start_date']
+        end_date = task_parameter['end_date']
+        scale = task_parameter['data_scale']
+        bands = task_parameter['bands']
+        if not bands:
             bands = None
         else:
             try:
                 bands = tuple(map(str, bands.split(',')))
             except:
                 bands = (bands,)
-        picked_sn = task_parameter.loc[0, 'picked_sn']
-        picked_sh = task_parameter.loc[0, 'picked_sh']
-        picked_xn = task_parameter.loc[0, 'picked_xn']
-        is_export_shp = task_parameter.loc[0, 'is_export_shp']
+        picked_sn = task_parameter['picked_sn']
+        # 未选择的市、县以NaN表示
+        picked_sh = numpy.nan if task_parameter['picked_sh'] is None else task_parameter['picked_sh']
+        picked_xn = numpy.nan if task_parameter['picked_xn'] is None else task_parameter['picked_xn']
+        is_export_shp = bool(task_parameter['is_export_shp'])
+        # 任务优先级（可选字段），用于全局调度的排队顺序和EE请求数分配
         try:
-            adcode_picked_region_draw = tuple(map(int, task_parameter.loc[0, 'adcode_picked_region_draw'].split(',')))
+            priority = max(int(task_parameter['priority']), 1)
         except:
-            adcode_picked_region_draw = (task_parameter.loc[0, 'adcode_picked_region_draw'],)
+            priority = 1
+        try:
+            adcode_picked_region_draw = tuple(map(int, task_parameter['adcode_picked_region_draw'].split(',')))
+        except:
+            adcode_picked_region_draw = (task_parameter['adcode_picked_region_draw'],)
         regionname = self.get_regionname(datarangetype, picked_sn, picked_sh, picked_xn, adcode_picked_region_draw)
-        self.subprocess.process_done_dict[taskname] = {}
-        self.subprocess.process_done_dict[taskname]['CalculateTiles'] = task_parameter.loc[0, 'is_CalculateTiles_done']
-        self.subprocess.process_done_dict[taskname]['TileDownload'] = task_parameter.loc[0, 'is_TileDownload_done']
-        self.subprocess.process_done_dict[taskname]['TileStitch'] = task_parameter.loc[0, 'is_TileStitch_done']
-        self.task_download_times[taskname] = 0
-        self.execute_task_timer[taskname] = QTimer()
-        self.execute_task_timer[taskname].timeout.connect(
-            lambda: self.task_timer(taskfile, taskname, ee_object, downloadpath, ee_initialize, start_date,
-                                    end_date, bands, scale, downloadpolygon, regionname, is_export_shp))
-        self.execute_task_timer[taskname].start(500)
+        done = {stage: bool(task_parameter[f'is_{stage}_done']) for stage in task_orchestrator.stage_names}
+        kernel_func = self.get_cuda_kernel_func() if self.settings['enable_gpu'] else None
+        self.orchestrator.add_task({'taskname': taskname, 'ee_object': ee_object, 'downloadpath': downloadpath, 'region': downloadpolygon,
+                                    'regionname': regionname, 'start_date': start_date, 'end_date': end_date, 'scale': scale, 'bands': bands,
+                                    'is_export_shp': is_export_shp, 'priority': priority, 'proxies': self.settings['proxies'],
+                                    'ee_initialize': ee_initialize, 'datainfo_url': self.get_datainfo_url(ee_object),
+                                    'enable_gpu': self.settings['enable_gpu'], 'kernel_func': kernel_func,
+                                    'stream_to_geotiff': self.settings['stream_to_geotiff'], 'pyramid_levels': self.settings['pyramid_levels'],
+                                    'done': done})
         return True
 
-    def task_timer(self, taskfile, taskname, ee_object, downloadpath, ee_initialize, start_date, end_date, bands, scale, downloadpolygon, regionname,
-                   is_export_shp):
+    @Slot(str, str, str)
+    def on_task_event(self, taskname, event, data):
+        # 任务调度线程的状态转换事件，在界面线程中更新任务列表
         try:
-            status = self.subprocess.is_task_inprogress(taskname)
-            try:
-                while True:
-                    try:
-                        data = self.subprocess.queue_dict[taskname].get_nowait()
-                        self.subprocess.progress_info_dict[taskname].update(data[0])
-                        self.subprocess.process_done_dict[taskname].update(data[1])
-                    except:
-                        break
-            except Exception as e:
-                pass
-            try:
-                if self.subprocess.process_done_dict[taskname]['process_ended']:
-                    self.subprocess.close_queue(taskname)
-                    os.kill(self.subprocess.process_dict[taskname][0], signal.SIGTERM)
-            except Exception as e:
-                pass
-            if not status:
-                self.subprocess.create_queue(taskname)
-                is_calculatetiles_done = self.subprocess.process_done_dict[taskname]['CalculateTiles']
-                is_tiledownload_done = self.subprocess.process_done_dict[taskname]['TileDownload']
-                is_tilestitch_done = self.subprocess.process_done_dict[taskname]['TileStitch']
-                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_CalculateTiles_done'] = is_calculatetiles_done
-                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_TileDownload_done'] = is_tiledownload_done
-                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_TileStitch_done'] = is_tilestitch_done
-                if not is_calculatetiles_done and not is_tiledownload_done and not is_tilestitch_done:
-                    target = 'CalculateTiles'
-                    savepath = downloadpath
-                    self.subprocess.new_process((taskname, target, self.settings['proxies'], ee_object, savepath, downloadpolygon,
-                                                 ee_initialize, start_date, end_date, scale, bands))
-                elif is_calculatetiles_done and not is_tiledownload_done and not is_tilestitch_done:
-                    self.task_download_times[f'{taskname}'] = self.task_download_times[f'{taskname}'] + 1
-                    if self.task_download_times[f'{taskname}'] > 3:
-                        notification.notify(message=f'任务： {taskname}，下载失败，请检查网络或代理设置', app_icon='resources/icon/Nevasa.ico', timeout=5)
-                        self.close_task_timer(taskname)
-                        self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_executing'] = False
-                        self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_complete'] = False
-                        self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_download_failed'] = True
-                        self.update_taskscrollarea()
-                        self.stackwidget.setCurrentIndex(1)
-                        # self.show_msg_box(f'任务： {taskname}，下载失败，请检查网络或代理设置')
-                    else:
-                        target = 'TileDownload'
-                        savepath = downloadpath + f'/{taskname}.nev'
-                        with open(taskfile, 'r', encoding='utf-8') as file:
-                            xml_str = file.read()
-                        task_info = xmltodict.parse(xml_str)
-                        task_info['data']['row']['is_CalculateTiles_done'] = True
-                        xml_str = xmltodict.unparse(task_info, pretty=True)
-                        with open(taskfile, 'w', encoding='utf-8') as f:
-                            f.write(xml_str)
-                        self.subprocess.new_process(
-                            (taskname, target, savepath, ee_object, start_date, end_date, self.settings['proxies'], ee_initialize, scale))
-                elif is_calculatetiles_done and is_tiledownload_done and not is_tilestitch_done:
-                    target = 'TileStitch'
-                    sqlitename = f'{taskname}.nev'
-                    if self.settings['enable_gpu']:
-                        try:
-                            e = self.subprocess.process_done_dict[taskname][f'gpu_exception']
-                            if 'Error when trying to use GPU' in e:
-                                self.settings['enable_gpu'] = False
-                        except:
-                            pass
-                    with open(taskfile, 'r', encoding='utf-8') as file:
-                        xml_str = file.read()
-                    task_info = xmltodict.parse(xml_str)
-                    task_info['data']['row']['is_TileDownload_done'] = True
-                    task_info['data']['row']['downloadprogress'] = 100
-                    xml_str = xmltodict.unparse(task_info, pretty=True)
-                    with open(taskfile, 'w', encoding='utf-8') as f:
-                        f.write(xml_str)
-                    datainfo_url = self.get_datainfo_url(ee_object)
-                    if self.settings['enable_gpu']:
-                        kernel_func = self.get_cuda_kernel_func()
-                    else:
-                        kernel_func = None
-                    self.subprocess.new_process(
-                        (taskname, target, downloadpath, sqlitename, ee_object, downloadpolygon, scale, regionname, start_date, end_date,
-                         datainfo_url, is_export_shp, self.settings['enable_gpu'], kernel_func))
-                elif is_calculatetiles_done and is_tiledownload_done and is_tilestitch_done:
-                    finishtime = time.time()
-                    with open(taskfile, 'r', encoding='utf-8') as file:
-                        xml_str = file.read()
-                    task_info = xmltodict.parse(xml_str)
-                    task_info['data']['row']['is_TileStitch_done'] = True
-                    task_info['data']['row']['finishtime'] = finishtime
-                    task_info['data']['row']['stitchprogress'] = 100
-                    task_info['data']['row']['cropprogress'] = 100
-                    xml_str = xmltodict.unparse(task_info, pretty=True)
-                    with open(taskfile, 'w', encoding='utf-8') as f:
-                        f.write(xml_str)
-                    self.close_task_timer(taskname)
-                    self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_executing'] = False
-                    self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'finishtime'] = finishtime
-                    self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_complete'] = True
-                    index = self.stackwidget.currentIndex()
-                    self.replace_widget(self.taskscrollarea, self.task_scrollarea)
-                    self.all_tasks_radio.click()
-                    self.stackwidget.setCurrentIndex(index)
-                    self.subprocess.clear_dict(taskname)
-                    notification.notify(message=f'任务： {taskname}已经完成', app_icon='resources/icon/Nevasa.ico', timeout=5)
+            if event == 'stage_done':
+                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', f'is_{data}_done'] = True
+                if data == 'TileDownload':
+                    self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'downloadprogress'] = 100
+            elif event == 'gpu_unavailable':
+                self.settings['enable_gpu'] = False
+            elif event == 'task_error':
+                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_executing'] = False
+            elif event == 'task_failed':
+                if data == 'TileDownload':
+                    message = f'任务： {taskname}，下载失败，请检查网络或代理设置'
+                else:
+                    message = f'任务： {taskname}执行失败'
+                notification.notify(message=message, app_icon='resources/icon/Nevasa.ico', timeout=5)
+                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_executing'] = False
+                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_complete'] = False
+                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_download_failed'] = True
+                self.update_taskscrollarea()
+                self.stackwidget.setCurrentIndex(1)
+            elif event == 'task_complete':
+                finishtime = self.task_store.get(taskname)['finishtime']
+                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_TileStitch_done'] = True
+                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'stitchprogress'] = 100
+                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'cropprogress'] = 100
+                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_executing'] = False
+                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'finishtime'] = finishtime
+                self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_complete'] = True
+                index = self.stackwidget.currentIndex()
+                self.replace_widget(self.taskscrollarea, self.task_scrollarea)
+                self.all_tasks_radio.click()
+                self.stackwidget.setCurrentIndex(index)
+                notification.notify(message=f'任务： {taskname}已经完成', app_icon='resources/icon/Nevasa.ico', timeout=5)
         except Exception as e:
             traceback.print_exc()
 
-    def close_task_timer(self, taskname):
-        self.execute_task_timer[f'{taskname}'].stop()
-        self.execute_task_timer[f'{taskname}'].deleteLater()
+    def stop_task(self, taskname):
+        # 停止任务的状态转换，执行中的阶段由调用方通过closeone结束
+        try:
+            self.orchestrator.remove_task(taskname)
+        except Exception as e:
+            pass
         self.exists_task.loc[self.exists_task['taskname'] == f'{taskname}', 'is_executing'] = False
-        del self.execute_task_timer[f'{taskname}']
 
     @Slot()
     def on_delete_dataset_button_clicked(self):
@@ -3541,6 +3531,18 @@ class Nevasa:
                 get_setting(key='max_download_fail', function=int)
                 get_setting(key='transparent_window', function=lambda value: True if value.lower() == 'true' else False)
                 get_setting(key='enable_gpu', function=lambda value: True if value.lower() == 'true' else False)
+                get_setting(key='stream_to_geotiff', function=lambda value: True if value.lower() == 'true' else False)
+                get_setting(key='pyramid_levels', function=int)
+                get_setting(key='worker_pool_size', function=int)
+                get_setting(key='job_memory_limit', function=int)
+                get_setting(key='job_time_limit', function=int)
+                get_setting(key='max_ee_requests', function=int)
+                get_setting(key='max_stitch_jobs', function=int)
+                get_setting(key='memory_budget', function=int)
+                get_setting(key='min_free_disk', function=int)
+                get_setting(key='metrics_port', function=int)
+                get_setting(key='trace_sample_rate', function=float)
+                get_setting(key='trace_format')
                 get_setting(key='max_display_task', function=int)
                 get_setting(key='max_display_dataset', function=int)
                 get_setting(key='map_opacity', function=int)
@@ -3618,50 +3620,51 @@ class Nevasa:
         return new_id
 
     def get_all_tasks(self):
-        self.exists_task = pd.DataFrame(columns=['index', 'datasetname', 'createtime', 'data_source_lv1', 'data_source_lv2', 'data_source_lv3',
-                                                 'base_map', 'datarangetype', 'picked_sn', 'picked_sh', 'picked_xn', 'data_scale', 'start_date',
-                                                 'end_date', 'downloadpath', 'taskname', 'finishtime', 'downloadprogress', 'stitchprogress', 'cropprogress'
-                                                                                                                                             'is_CalculateTiles_done',
-                                                 'is_TileDownload_done', 'is_TileStitch_done', 'speed_calculate_list', 'is_complete',
-                                                 'is_executing', 'is_download_failed', 'remaining_time', 'this_start_time', 'bands', 'datasetregion'])
+        # 按创建时间索引读取最近的N个任务，一次构建任务列表
         try:
-            task_file = self.task_path
-            xml_files_with_time = [(file.name, file.stat().st_ctime) for file in task_file.iterdir() if file.is_file() and file.suffix == '.xml']
-            # 按创建时间排序，降序排序，即最近创建的文件在前
-            xml_files_with_time.sort(key=lambda x: x[1], reverse=True)
-            # 获取创建时间最近的 N 个文件
-            latest_xml_files = [file[0] for file in xml_files_with_time[:self.settings['max_display_task']]]
-            for task_xml in latest_xml_files:
-                try:
-                    task = pd.read_xml(task_file / task_xml)
-                    if task.loc[0, 'is_CalculateTiles_done'] and task.loc[0, 'is_TileDownload_done'] and task.loc[0, 'is_TileStitch_done']:
-                        task['is_complete'] = True
-                    else:
-                        task['is_complete'] = False
-                    task['is_executing'], task['is_download_failed'] = False, False
-                    task['remaining_time'], task['this_start_time'], task['speed_calculate_list'] = None, None, None
-                    self.exists_task = (
-                        self.exists_task.copy() if task.empty else task.copy() if self.exists_task.empty else pd.concat([self.exists_task, task]))
-                except Exception as e:
-                    pass
-            self.sort_downloadtasks()
+            rows = self.task_store.list_tasks(self.settings['max_display_task'])
         except Exception as e:
-            pass
+            rows = []
+        self.exists_task = self.task_frame(rows)
+        self.sort_downloadtasks()
+
+    @staticmethod
+    def task_frame(rows):
+        # 由任务登记库的记录构建任务列表，附加界面运行时使用的列
+        tasks = pd.DataFrame(rows, columns=['taskname', *task_store.TaskStore.task_columns, *task_store.TaskStore.columns])
+        for key in ('is_CalculateTiles_done', 'is_TileDownload_done', 'is_TileStitch_done', 'is_export_shp'):
+            tasks[key] = tasks[key].fillna(0).astype(bool)
+        tasks['is_complete'] = tasks['is_CalculateTiles_done'] & tasks['is_TileDownload_done'] & tasks['is_TileStitch_done']
+        tasks['is_executing'], tasks['is_download_failed'] = False, False
+        tasks['remaining_time'], tasks['this_start_time'], tasks['speed_calculate_list'] = None, None, None
+        return tasks
+
+    def import_task_xml(self):
+        # 将旧版本的任务XML登记到任务登记库，登记后的文件改名为.xml.imported，之后启动时不再扫描解析
+        try:
+            xml_files = [file for file in self.task_path.iterdir() if file.is_file() and file.suffix == '.xml']
+        except Exception as e:
+            return
+        for file in xml_files:
+            try:
+                task = json.loads(pd.read_xml(file).to_json(orient='records'))[0]
+                taskname = task.pop('taskname')
+                task['createtime'] = task.get('createtime') or file.stat().st_ctime
+                self.task_store.add_task(taskname, **task)
+                # 任务状态库中已有的完成状态与进度优先
+                if self.task_store.get(taskname) is None:
+                    self.task_store.save(taskname, **{key: task.get(key) for key in ('is_CalculateTiles_done', 'is_TileDownload_done',
+                                                                                     'is_TileStitch_done', 'downloadprogress', 'stitchprogress',
+                                                                                     'cropprogress', 'finishtime')})
+                file.rename(file.with_name(f'{file.name}.imported'))
+            except Exception as e:
+                pass
 
     def sort_downloadtasks(self, tasks=None):
         def sort(tasks):
-            tasks["sort_key"] = tasks.apply(
-                lambda row: (
-                    0 if row["is_executing"]
-                    else 1 if (not row["is_executing"] and not row["is_complete"])
-                    else 2
-                ),
-                axis=1  # 正确位置
-            )
-            tasks = tasks.sort_values(
-                by=["sort_key", "createtime"],
-                ascending=[True, False]
-            ).drop(columns=["sort_key"])
+            # 正在执行的任务在前，其次为未完成的任务，已完成的任务在后，同类按创建时间降序
+            sort_key = numpy.where(tasks['is_executing'].astype(bool), 0, numpy.where(tasks['is_complete'].astype(bool), 2, 1))
+            tasks = tasks.assign(sort_key=sort_key).sort_values(by=['sort_key', 'createtime'], ascending=[True, False]).drop(columns=['sort_key'])
             return tasks
 
         if tasks is None:
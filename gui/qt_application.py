@@ -284,6 +284,14 @@ class MainWindow(QMainWindow, main_gui.Nevasa):
             pass
         self.hide()
         self.tray_icon.hide()
+        try:
+            self.orchestrator.shutdown()
+        except:
+            pass
+        try:
+            self.metrics_server.stop()
+        except:
+            pass
         try:
             self.subprocess.closeall()
         except:
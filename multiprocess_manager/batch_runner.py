@@ -0,0 +1,341 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from shapely import make_valid, GeometryCollection, MultiPolygon, Polygon
+from shapely.wkt import loads, dumps
+from multiprocess_manager.metrics_server import MetricsServer
+from multiprocess_manager.multiprocess_manager import MultiprocessManager
+from multiprocess_manager.task_orchestrator import TaskOrchestrator, stage_names
+from multiprocess_manager.task_store import TaskStore
+from progress import Tracer
+
+# 与界面默认设置一致
+default_settings = {
+    'service_account': None,  # 谷歌服务账户
+    'json_file': None,  # 谷歌JSON-KEY路径
+    'project_id': None,  # 谷歌Projrct_id
+    'proxies': {},  # 代理，{代理编号: {'http': url, 'https': url}}
+    'max_download_fail': 0,  # 允许的最大切片下载失败数量
+    'max_download_try': 3,  # 每个阶段的最大尝试次数
+    'enable_gpu': False,  # 使用GPU进行图像处理
+    'stream_to_geotiff': False,  # 流式拼接，瓦片直接写入分块GeoTIFF
+    'pyramid_levels': 0,  # 拼接后额外输出的低层级数
+    'worker_pool_size': 2,  # 常驻工作进程数量，为0时每个任务阶段启动独立进程
+    'job_memory_limit': 0,  # 单个任务阶段的内存上限（MB），为0时不限制
+    'job_time_limit': 0,  # 单个任务阶段的运行时间上限（秒），为0时不限制
+    'max_ee_requests': 40,  # 所有任务同时进行的EE请求数上限
+    'max_stitch_jobs': 1,  # 同时进行的拼接任务数上限
+    'memory_budget': 0,  # 任务进程内存预算（MB），为0时取物理内存的80%
+    'min_free_disk': 1024,  # 拼接准入时磁盘需保留的空间（MB）
+    'metrics_port': 0,  # 本机Prometheus指标接口端口，为0时不启用
+    'trace_sample_rate': 0,  # 热路径计时的瓦片抽样比例（0~1），为0时不记录，结果写入各任务目录下的trace
+    'trace_format': 'chrome',  # 计时文件格式，chrome或otlp
+}
+# 支持的数据集：EE数据集ID与界面中数据集名称的对应关系，下载、拼接阶段按数据集名称选择处理方式
+ee_datasets = {
+    'GOOGLE/DYNAMICWORLD/V1': 'Dynamic World',
+    'JRC/GSW1_4/MonthlyHistory': 'JRC Monthly Water History',
+    'USGS/GMTED2010_FULL': 'Global Multi-resolution Terrain',
+    'NOAA/CFSV2/FOR6H': 'CFSV2',
+}
+
+
+def dataset_name(dataset):
+    # 任务说明中的数据集可以是EE数据集ID或数据集名称，返回数据集名称，不支持的数据集直接报错
+    if dataset in ee_datasets.values():
+        return dataset
+    for ee_id, name in ee_datasets.items():
+        if dataset.upper() == ee_id.upper():
+            return name
+    raise ValueError(f'不支持的数据集：{dataset}，可选：{", ".join(f"{ee_id}（{name}）" for ee_id, name in ee_datasets.items())}')
+
+
+def format_region(wkt_string):
+    # 与界面中数据集区域的格式化方式一致
+    region = make_valid(loads(wkt_string))
+    if isinstance(region, Polygon):
+        return wkt_string
+    elif isinstance(region, MultiPolygon):
+        if len(region.geoms) == 1:
+            return dumps(region.geoms[0])
+        else:
+            return wkt_string
+    elif isinstance(region, GeometryCollection):
+        polygon_list = []
+        for geom in region.geoms:
+            if isinstance(geom, Polygon):
+                polygon_list.append(geom)
+            elif isinstance(geom, MultiPolygon):
+                for geo in geom.geoms:
+                    polygon_list.append(geo)
+        return dumps(MultiPolygon(polygon_list)) if len(polygon_list) > 1 else dumps(Polygon(polygon_list[0]))
+
+
+class BatchRunner:
+    """
+    无界面批量运行：按任务说明执行计算、下载、拼接阶段，阶段转换由任务调度器（TaskOrchestrator）处理，与界面一致，
+    用于在服务器上无人值守运行多个区域。各阶段完成状态保存在状态文件所在目录的tasks.db中，重新运行时从未完成的阶段继续，
+    下载阶段按.nev中的瓦片状态续传；任务参数变化时从计算阶段重新开始。全部任务的状态汇总写入status_path，供外部程序读取
+    parallel为同时执行的任务数，各阶段仍需经全局调度器按资源预算准入；阶段异常时按max_download_try重试
+    """
+    def __init__(self, tasks, settings, status_path, parallel=2, status_interval=5, resource_path=None):
+        self.settings = dict(default_settings)
+        self.settings.update(settings)
+        self.status_path = Path(status_path)
+        self.parallel = max(parallel, 1)
+        self.status_interval = status_interval
+        self.resource_path = Path(resource_path) if resource_path is not None else Path(__file__).resolve().parents[1] / 'resources/data/data.nev'
+        self.connection = None
+        self.metrics_server = None
+        self.ee_initialize = (self.settings['service_account'], self.settings['json_file'], self.settings['project_id'])
+        self.store = TaskStore(self.status_path.parent / 'tasks.db')
+        self.records = [self.load_task(spec) for spec in tasks]
+        tasknames = [record['taskname'] for record in self.records]
+        duplicates = sorted({taskname for taskname in tasknames if tasknames.count(taskname) > 1})
+        if duplicates:
+            raise ValueError(f'任务名重复：{", ".join(duplicates)}')
+        self.manager = None
+        self.orchestrator = None
+        self.is_stopped = False
+        self.changed_event = threading.Event()
+
+    def catalog(self):
+        if self.connection is None:
+            if not self.resource_path.is_file():
+                raise ValueError(f'找不到资源文件：{self.resource_path}')
+            self.connection = sqlite3.connect(f'file:{self.resource_path}?mode=ro', uri=True)
+        return self.connection
+
+    def get_region(self, adcode):
+        # 按行政区划代码查询边界与完整名称（省、市、县依次拼接）
+        cur = self.catalog().cursor()
+        try:
+            for table in ('st_r_xn', 'st_r_sh', 'st_r_sn'):
+                row = cur.execute(f'select geometry, name from {table} where adcode = ?', (str(adcode),)).fetchone()
+                if row is not None:
+                    break
+            else:
+                raise ValueError(f'找不到行政区划代码：{adcode}')
+            geometry, regionname = row
+            if table != 'st_r_sn':
+                parent = cur.execute(f'select parent from {table} where adcode = ?', (str(adcode),)).fetchone()[0]
+                for parent_table in ('st_r_sh', 'st_r_sn'):
+                    row = cur.execute(f'select name, {"parent" if parent_table == "st_r_sh" else "null"} from {parent_table} where adcode = ?',
+                                      (str(parent),)).fetchone()
+                    if row is not None:
+                        regionname = row[0] + regionname
+                        parent = row[1]
+            return geometry, regionname
+        finally:
+            cur.close()
+
+    def get_datainfo_url(self, ee_object):
+        try:
+            cur = self.catalog().cursor()
+            res = cur.execute('select url from ee_datacatalog where abbreviation = ? limit 1', (ee_object,)).fetchone()[0]
+            if "hl=zh-cn" not in res:
+                res = res + '?hl=zh-cn'
+            cur.close()
+            return res
+        except:
+            return 'https://developers.google.com/earth-engine/datasets'
+
+    def get_cuda_kernel_func(self, name='process_image_kernel'):
+        cur = self.catalog().cursor()
+        kernel_func = cur.execute('select binary from ptx_modules where name=?', (name,)).fetchone()[0]
+        cur.close()
+        return kernel_func
+
+    def load_task(self, spec):
+        # 任务说明：dataset、start_date、end_date、scale、output必填，wkt与adcode二选一，其余可选
+        for key in ('dataset', 'start_date', 'end_date', 'scale', 'output'):
+            if spec.get(key) in (None, ''):
+                raise ValueError(f'任务缺少参数：{key}')
+        if spec.get('wkt') is None and spec.get('adcode') is None:
+            raise ValueError('任务必须指定wkt或adcode')
+        dataset = dataset_name(str(spec['dataset']))
+        if spec.get('wkt') is not None:
+            region = format_region(spec['wkt'])
+            regionname = spec.get('regionname', '用户自定义区域')
+        else:
+            geometry, regionname = self.get_region(spec['adcode'])
+            region = format_region(geometry)
+            regionname = spec.get('regionname', regionname)
+        bands = spec.get('bands')
+        if isinstance(bands, str):
+            bands = tuple(band.strip() for band in bands.split(',') if band.strip()) or None
+        elif bands is not None:
+            bands = tuple(map(str, bands)) or None
+        taskname = spec.get('taskname') or (f"{dataset.replace(' ', '_')}_{spec.get('adcode') or hashlib.sha1(region.encode()).hexdigest()[:8]}_"
+                                            f"{spec['start_date']}_{spec['end_date']}")
+        record = {
+            'taskname': str(taskname),
+            'dataset': dataset,
+            'adcode': spec.get('adcode'),
+            'region': region,
+            'regionname': regionname,
+            'start_date': str(spec['start_date']),
+            'end_date': str(spec['end_date']),
+            'scale': int(spec['scale']),
+            'bands': bands,
+            'priority': max(int(spec.get('priority', 1)), 1),
+            'is_export_shp': bool(spec.get('is_export_shp', True)),
+            'downloadpath': str(Path(spec['output']).resolve() / str(taskname)),
+            'state': 'pending',
+            'stage': None,
+            'done': {stage: False for stage in stage_names},
+            'error': None,
+            'starttime': None,
+            'finishtime': None,
+        }
+        # 参数摘要，续传时参数不一致则从头开始
+        record['spec'] = hashlib.sha1(json.dumps([record['dataset'], record['region'], record['start_date'], record['end_date'], record['scale'],
+                                                  record['bands']]).encode()).hexdigest()
+        self.load_resume(record)
+        return record
+
+    def load_resume(self, record):
+        saved = self.store.get(record['taskname'])
+        if saved is None or saved['spec'] != record['spec']:
+            self.store.delete(record['taskname'])
+            self.store.save(record['taskname'], spec=record['spec'])
+            return
+        done = {stage: bool(saved[f'is_{stage}_done']) for stage in stage_names}
+        # 计算阶段生成的.nev缺失时无法续传
+        if done['CalculateTiles'] and not os.path.isfile(os.path.join(record['downloadpath'], f"{record['taskname']}.nev")):
+            return
+        record['done'] = done
+        record['finishtime'] = saved['finishtime']
+        if all(done.values()):
+            record['state'] = 'complete'
+
+    def orchestrator_task(self, record):
+        kernel_func = None
+        if self.settings['enable_gpu']:
+            try:
+                kernel_func = self.get_cuda_kernel_func()
+            except Exception as e:
+                print(e)
+        return {'taskname': record['taskname'], 'ee_object': record['dataset'], 'downloadpath': record['downloadpath'], 'region': record['region'],
+                'regionname': record['regionname'], 'start_date': record['start_date'], 'end_date': record['end_date'], 'scale': record['scale'],
+                'bands': record['bands'], 'is_export_shp': record['is_export_shp'], 'priority': record['priority'],
+                'proxies': self.settings['proxies'], 'ee_initialize': self.ee_initialize, 'datainfo_url': self.get_datainfo_url(record['dataset']),
+                'enable_gpu': kernel_func is not None, 'kernel_func': kernel_func, 'stream_to_geotiff': self.settings['stream_to_geotiff'],
+                'pyramid_levels': self.settings['pyramid_levels'], 'done': dict(record['done'])}
+
+    def run(self):
+        # 返回True表示全部任务完成
+        for record in self.records:
+            os.makedirs(record['downloadpath'], exist_ok=True)
+        # 工作进程启动时继承计时设置
+        Tracer.configure(self.settings['trace_sample_rate'], self.settings['trace_format'])
+        self.manager = MultiprocessManager(self.settings['max_download_fail'], self.status_path.parent, self.settings['worker_pool_size'],
+                                           self.settings['job_memory_limit'], self.settings['job_time_limit'], self.settings['max_ee_requests'],
+                                           self.settings['max_stitch_jobs'], self.settings['memory_budget'], self.settings['min_free_disk'])
+        self.manager.warm_up(self.settings['proxies'], self.ee_initialize)
+        self.orchestrator = TaskOrchestrator(self.manager, self.store, self.settings['max_download_try'], on_event=self.on_event)
+        if self.settings['metrics_port']:
+            self.metrics_server = MetricsServer(self.manager, self.settings['metrics_port'], manager_lock=self.orchestrator.lock).start()
+        try:
+            while not self.is_stopped:
+                self.changed_event.clear()
+                self.activate()
+                self.write_status()
+                if not any(record['state'] in ('queued', 'running') for record in self.records):
+                    break
+                # 任务状态变化时立即写入状态文件，否则按status_interval刷新进度
+                self.changed_event.wait(self.status_interval)
+        except KeyboardInterrupt:
+            self.is_stopped = True
+        finally:
+            self.close()
+        return all(record['state'] == 'complete' for record in self.records)
+
+    def stop(self):
+        self.is_stopped = True
+        self.changed_event.set()
+
+    def activate(self):
+        # 按优先级、任务顺序启动等待中的任务，直到同时执行的任务数达到parallel
+        active = sum(1 for record in self.records if record['state'] in ('queued', 'running'))
+        pending = sorted((record for record in self.records if record['state'] == 'pending'), key=lambda record: -record['priority'])
+        for record in pending[:max(self.parallel - active, 0)]:
+            record['state'] = 'queued'
+            record['starttime'] = time.time()
+            self.orchestrator.add_task(self.orchestrator_task(record))
+
+    def on_event(self, taskname, event, data):
+        # 在任务调度线程中执行
+        record = next(record for record in self.records if record['taskname'] == taskname)
+        if event == 'stage_started':
+            record['state'], record['stage'], record['error'] = 'running', data, None
+        elif event == 'stage_done':
+            record['done'][data] = True
+        elif event == 'task_complete':
+            record['finishtime'] = self.store.get(taskname)['finishtime']
+            record['state'] = 'complete'
+        elif event == 'task_failed':
+            record['error'] = self.store.get(taskname)['error']
+            record['state'] = 'failed'
+        self.changed_event.set()
+
+    def close(self):
+        # 中断时结束执行中的阶段，已完成的阶段保留在tasks.db中，下次运行时继续
+        self.orchestrator.shutdown()
+        for record in self.records:
+            if record['state'] in ('queued', 'running'):
+                self.manager.closeone(record['taskname'])
+                record['state'] = 'interrupted'
+                self.store.save(record['taskname'], state='interrupted')
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+        self.manager.closeall()
+        self.write_status()
+        self.store.close()
+        if self.connection is not None:
+            self.connection.close()
+
+    def task_status(self, record):
+        status = {key: record[key] for key in ('taskname', 'dataset', 'adcode', 'regionname', 'start_date', 'end_date', 'scale', 'bands', 'priority',
+                                               'downloadpath', 'state', 'stage', 'done', 'error', 'starttime', 'finishtime')}
+        status['attempts'], status['queue'], status['progress'] = None, None, None
+        if self.orchestrator is None:
+            return status
+        # 读取进度会取出进度队列，与调度线程的状态转换互斥
+        with self.orchestrator.lock:
+            task = self.orchestrator.tasks.get(record['taskname'])
+            if task is not None:
+                status['attempts'] = dict(task['attempts'])
+                queue = self.manager.queue_position(record['taskname'])
+                status['queue'] = {'position': queue[0], 'stage': queue[1], 'reason': queue[2]} if queue is not None else None
+                progress = self.orchestrator.read_progress(record['taskname']) or {}
+                status['progress'] = {key: value for key, value in progress.items() if isinstance(value, (bool, int, float, str))}
+        return status
+
+    def write_status(self):
+        summary = {}
+        for record in self.records:
+            summary[record['state']] = summary.get(record['state'], 0) + 1
+        try:
+            latest = self.manager.monitor.latest() if self.manager is not None and self.manager.monitor is not None else None
+            self.write_json(self.status_path, {'updatetime': time.time(), 'summary': summary,
+                                               'resources': latest[1] if latest is not None else None,
+                                               'tasks': [self.task_status(record) for record in self.records]})
+        except OSError as e:
+            print(e)
+
+    @staticmethod
+    def write_json(path, data):
+        # 先写临时文件再替换，读取方不会读到写了一半的文件
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        os.replace(temp_path, path)
@@ -0,0 +1,170 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MetricFamilies:
+    """
+    按Prometheus文本格式（0.0.4）输出指标，同名指标的样本集中在一个# TYPE之后
+    """
+    def __init__(self):
+        self.families = {}
+
+    def add(self, name, kind, description, value, **labels):
+        family = self.families.setdefault(name, (kind, description, []))
+        family[2].append(('', labels, value))
+
+    def add_histogram(self, name, description, histogram, **labels):
+        # histogram为StageMetrics中各区间的数量，输出时转为累计数量
+        family = self.families.setdefault(name, ('histogram', description, []))
+        cumulative = 0
+        for bound, count in zip(list(histogram['buckets']) + ['+Inf'], histogram['counts']):
+            cumulative += count
+            family[2].append(('_bucket', dict(labels, le=str(bound)), cumulative))
+        family[2].append(('_sum', labels, histogram['sum']))
+        family[2].append(('_count', labels, histogram['count']))
+
+    @staticmethod
+    def format_labels(labels):
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+        return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+    def render(self):
+        lines = []
+        for name, (kind, description, samples) in self.families.items():
+            lines.append(f'# HELP {name} {description}')
+            lines.append(f'# TYPE {name} {kind}')
+            for suffix, labels, value in samples:
+                lines.append(f'{name}{suffix}{self.format_labels(labels)} {float(value)!r}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsServer:
+    """
+    本机指标接口：在后台线程中提供HTTP GET /metrics，供Prometheus抓取。指标在抓取时由主进程已有的数据生成：
+    共享内存进度块中的瓦片计数、工作进程按批次随进度队列发送的阶段指标（StageMetrics）、全局调度器的排队情况和后台资源采样，
+    不为单个瓦片增加进程间通信。阶段切换后保留任务上一阶段的指标，任务结束后不再输出
+    manager_lock为任务调度器的锁，管理器的任务字典由调度线程在该锁内增删，抓取时在锁内复制后再生成指标
+    """
+    def __init__(self, manager, port, host='127.0.0.1', manager_lock=None):
+        self.manager = manager
+        self.port = port
+        self.host = host
+        self.manager_lock = manager_lock if manager_lock is not None else threading.RLock()
+        self.stage_cache = {}
+        self.lock = threading.Lock()
+        self.server = None
+        self.thread = None
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                try:
+                    body = server.render().encode('utf-8')
+                except Exception as e:
+                    self.send_error(500, str(e))
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+    def read_task(self, taskname):
+        # 进度字典（含阶段指标）与共享内存进度块的快照，只读，不取进度队列
+        info = dict(self.manager.progress_info_dict.get(taskname) or {})
+        shared_progress = self.manager.shared_progress_dict.get(taskname)
+        if shared_progress is not None:
+            info.update(shared_progress.snapshot())
+        return info
+
+    def read_tasks(self):
+        # 在调度器的锁内复制各任务的进度与进度队列，避免迭代时字典被调度线程修改
+        infos = {}
+        with self.manager_lock:
+            for taskname in list(self.manager.progress_info_dict):
+                try:
+                    infos[taskname] = self.read_task(taskname)
+                except Exception as e:
+                    continue
+            queues = list(self.manager.queue_dict.items())
+        return infos, queues
+
+    def collect_stages(self, infos):
+        # 返回{(任务名, 阶段): 进度}，包含任务此前阶段的最后一次读数
+        with self.lock:
+            for taskname, info in infos.items():
+                if info.get('target') is not None:
+                    self.stage_cache[(taskname, info['target'])] = info
+            for key in [key for key in self.stage_cache if key[0] not in infos]:
+                del self.stage_cache[key]
+            return dict(self.stage_cache)
+
+    def render(self):
+        metrics = MetricFamilies()
+        infos, queues = self.read_tasks()
+        for (taskname, stage), info in self.collect_stages(infos).items():
+            if stage == 'TileDownload':
+                metrics.add('nevasa_tiles_planned', 'gauge', '下载阶段计划下载的瓦片数', info.get('download_total', 0), task=taskname)
+                metrics.add('nevasa_tiles_downloaded_total', 'counter', '本次下载阶段已下载的瓦片数', info.get('download_success', 0), task=taskname)
+                metrics.add('nevasa_tiles_failed_total', 'counter', '本次下载阶段下载失败的瓦片数', info.get('download_fail', 0), task=taskname)
+                if 'ee_request_limit' in info:
+                    metrics.add('nevasa_ee_request_limit', 'gauge', '调度器分配给任务的EE并发请求上限', info['ee_request_limit'], task=taskname)
+            elif stage == 'TileStitch':
+                metrics.add('nevasa_stitch_tiles_planned', 'gauge', '拼接阶段计划拼接的瓦片数', info.get('stitch_total', 0), task=taskname)
+                metrics.add('nevasa_tiles_stitched_total', 'counter', '本次拼接阶段已拼接的瓦片数', info.get('stitched_tiles', 0), task=taskname)
+                metrics.add('nevasa_crop_blocks_total', 'counter', '本次拼接阶段已裁剪的块数', info.get('croped_blocks', 0), task=taskname)
+            stage_metrics = info.get('metrics') or {}
+            for name, histogram in stage_metrics.get('histograms', {}).items():
+                description = '瓦片下载耗时（秒）' if name == 'tile_cost_seconds' else 'SQLite提交耗时（秒）'
+                metrics.add_histogram(f'nevasa_{name}', description, histogram, task=taskname, stage=stage)
+            for (name, labels), value in stage_metrics.get('counters', {}).items():
+                metrics.add(f'nevasa_{name}_total', 'counter', '工作进程按批次累计的计数', value, task=taskname, stage=stage, **dict(labels))
+            for (name, labels), value in stage_metrics.get('gauges', {}).items():
+                metrics.add(f'nevasa_{name}', 'gauge', '工作进程最近一次写入时的瞬时值', value, task=taskname, stage=stage, **dict(labels))
+        for taskname, task_queue in queues:
+            try:
+                metrics.add('nevasa_progress_queue_depth', 'gauge', '主进程尚未读取的进度队列长度', task_queue.qsize(), task=taskname)
+            except (NotImplementedError, OSError, ValueError):
+                pass
+        scheduler = self.manager.scheduler
+        with scheduler.lock:
+            waiting = [stage['target'] for stage in scheduler.waiting.values()]
+            running = [stage['target'] for stage in scheduler.running.values()]
+        for stage in ('CalculateTiles', 'TileDownload', 'TileStitch'):
+            metrics.add('nevasa_scheduler_waiting_stages', 'gauge', '等待全局调度器准入的任务阶段数', waiting.count(stage), stage=stage)
+            metrics.add('nevasa_scheduler_running_stages', 'gauge', '已准入的任务阶段数', running.count(stage), stage=stage)
+        latest = self.manager.monitor.latest() if self.manager.monitor is not None else None
+        if latest is not None:
+            for name, sample in latest[1].items():
+                metrics.add('nevasa_process_cpu_percent', 'gauge', '进程及其子进程的CPU占用（%）', sample['cpu'], process=name)
+                metrics.add('nevasa_process_resident_memory_bytes', 'gauge', '进程及其子进程的常驻内存', sample['rss'] * 1024 * 1024, process=name)
+                metrics.add('nevasa_process_read_bytes_total', 'counter', '进程及其子进程的磁盘读取字节数', sample['read_bytes'], process=name)
+                metrics.add('nevasa_process_write_bytes_total', 'counter', '进程及其子进程的磁盘写入字节数', sample['write_bytes'], process=name)
+                metrics.add('nevasa_process_open_handles', 'gauge', '进程及其子进程打开的句柄数', sample['handles'], process=name)
+        return metrics.render()
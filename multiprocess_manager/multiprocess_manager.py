@@ -4,29 +4,44 @@
 
 import concurrent.futures
 import traceback
-from multiprocessing import Process, Event, Queue
+from multiprocessing import Process, Event, Queue, parent_process
+from multiprocessing.connection import wait
 import os
 import signal
+import sqlite3
 import time
 from plyer import notification
 from download import geedownload
 from stitch import geestitch
+from progress import SharedProgress
+from multiprocess_manager.worker_pool import WorkerPool, JobQueue
+from multiprocess_manager.scheduler import TaskScheduler
+from multiprocess_manager.resource_monitor import ResourceMonitor
 import psutil
-import xmltodict
 
 
 class MultiprocessManager:
-    def __init__(self, max_download_fail, task_path):
+    def __init__(self, max_download_fail, task_path, pool_size=2, memory_limit=0, time_limit=0, max_ee_requests=40, max_stitch_jobs=1,
+                 memory_budget=0, min_free_disk=1024, monitor_interval=2):
         self.max_download_fail = max_download_fail
         self.task_path = task_path
         self.process_dict = {}
-        self.mem_useage = 0
-        self.cpu_usage = 0
-        self.close_time_out = 5
+        # 停止下载、拼接阶段时等待其写入在途结果并确认的时间，超时后强制结束
+        self.drain_time_out = 30
         self.progress_info_dict = {}
         self.process_done_dict = {}
         self.process_singal_dict = {}
         self.queue_dict = {}
+        self.shared_progress_dict = {}
+        self.job_dict = {}
+        # 任务状态库（TaskStore），由任务调度器设置，关闭任务时写入进度
+        self.store = None
+        # 常驻工作进程池，pool_size为0时每个阶段启动独立进程
+        self.pool = WorkerPool(pool_size, pool_worker, (max_download_fail, task_path), memory_limit, time_limit) if pool_size > 0 else None
+        # 后台资源采样，monitor_interval为0时不采样（工作进程内的管理器）
+        self.monitor = ResourceMonitor(self.monitored_processes, monitor_interval).start() if monitor_interval > 0 else None
+        # 跨任务的全局资源调度
+        self.scheduler = TaskScheduler(max_ee_requests, max_stitch_jobs, memory_budget, min_free_disk, self.memory_usage)
 
     def create_queue(self, taskname):
         task_queue = Queue()
@@ -35,19 +50,128 @@ class MultiprocessManager:
     def close_queue(self, taskname):
         queue = self.queue_dict[taskname]
         del self.queue_dict[taskname]
+        # 常驻工作进程的队列在作业之间复用，不关闭
+        job = self.job_dict.get(taskname)
+        if job is not None and queue is job.worker.queue:
+            return
         queue.close()
         queue.join_thread()
 
+    def drain_queue(self, taskname):
+        # 取出队列中的进度数据，工作进程中的作业数据附带作业编号，丢弃其他作业以及已结束作业迟到的数据
+        job = self.job_dict.get(taskname)
+        while True:
+            try:
+                data = self.queue_dict[taskname].get_nowait()
+            except:
+                break
+            if job is not None and (job.finished or tuple(data[2:]) != (taskname, job.job_id)):
+                continue
+            self.progress_info_dict[taskname].update(data[0])
+            self.process_done_dict[taskname].update(data[1])
+
+    def end_process(self, taskname):
+        # 阶段结束：释放全局预算，独立进程直接结束，工作进程中的作业只释放队列
+        self.scheduler.finish(taskname)
+        self.apply_budgets()
+        job = self.job_dict.get(taskname)
+        self.close_queue(taskname)
+        if job is None:
+            os.kill(self.process_dict[taskname][0], signal.SIGTERM)
+
+    def admit(self, taskname, target, savepath=None, priority=1, stream_to_geotiff=False):
+        # 任务阶段启动前申请全局预算，返回False时保持排队，下次定时检查时重新申请
+        disk_bytes = self.estimate_stitch_bytes(savepath, taskname, stream_to_geotiff) if target == 'TileStitch' else 0
+        is_admitted = self.scheduler.admit(taskname, target, savepath, priority, disk_bytes)
+        if is_admitted:
+            self.apply_budgets()
+        return is_admitted
+
+    def release(self, taskname):
+        self.scheduler.release(taskname)
+        self.apply_budgets()
+
+    def queue_position(self, taskname):
+        return self.scheduler.queue_position(taskname)
+
+    def apply_budgets(self):
+        # 将EE请求数分配写入各下载任务的共享进度块，下载线程按该上限并发请求
+        for taskname, share in self.scheduler.ee_shares().items():
+            shared_progress = self.shared_progress_dict.get(taskname)
+            if shared_progress is not None:
+                shared_progress['ee_request_limit'] = share
+
+    def monitored_processes(self):
+        # 资源采样的进程：主进程、各任务阶段所在进程，以及空闲的常驻工作进程
+        processes = {'main': os.getpid()}
+        for taskname, process in list(self.process_dict.items()):
+            if process[0] > 0:
+                processes[taskname] = process[0]
+        if self.pool is not None:
+            pids = set(processes.values())
+            for worker in list(self.pool.workers):
+                if worker.pid not in pids:
+                    processes[f'worker_{worker.pid}'] = worker.pid
+        return processes
+
+    def memory_usage(self):
+        # 各任务进程（含子进程）占用内存之和，单位MB，有后台采样时取最近一次采样
+        latest = self.monitor.latest() if self.monitor is not None else None
+        if latest is not None:
+            return sum(sample['rss'] for name, sample in latest[1].items() if name in self.process_dict)
+        usage = 0
+        for taskname in list(self.process_dict):
+            try:
+                process = psutil.Process(self.process_dict[taskname][0])
+                usage = usage + process.memory_info().rss
+                for child in process.children(recursive=True):
+                    usage = usage + child.memory_info().rss
+            except Exception as e:
+                pass
+        return usage / 1024 / 1024
+
+    @staticmethod
+    def estimate_stitch_bytes(savepath, taskname, stream_to_geotiff=False):
+        # 以已下载瓦片的原始字节数估算拼接占用的磁盘空间：临时文件与GeoTIFF各一份，流式拼接只写GeoTIFF
+        try:
+            conn = sqlite3.connect(f'file:{os.path.join(savepath, f"{taskname}.nev")}?mode=ro', uri=True)
+            try:
+                cur = conn.cursor()
+                tables = cur.execute("select name from sqlite_master where type = 'table' and name like 'tiles_%_rs'").fetchall()
+                total = sum(cur.execute(f'select coalesce(sum(length(image)), 0) from "{table}" where status = 1').fetchone()[0] for table, in tables)
+            finally:
+                conn.close()
+        except sqlite3.Error:
+            return 0
+        return total if stream_to_geotiff else total * 2
+
+    def warm_up(self, proxies, ee_initialize):
+        if self.pool is not None:
+            self.pool.warm_up(proxies, ee_initialize)
+
     def write_to_queue(self, taskname):
         data = (self.progress_info_dict[taskname], self.process_done_dict[taskname], taskname)
         self.queue_dict[taskname].put(data)
 
+    def create_shared_progress(self, taskname):
+        # 子进程通过共享内存更新进度计数，主进程读取快照
+        if taskname in self.shared_progress_dict:
+            self.shared_progress_dict.pop(taskname).unlink()
+        self.shared_progress_dict[taskname] = SharedProgress.create(self.progress_info_dict[taskname])
+        return self.shared_progress_dict[taskname]
+
+    def read_progress(self, taskname):
+        shared_progress = self.shared_progress_dict.get(taskname)
+        if shared_progress is not None:
+            self.progress_info_dict[taskname].update(shared_progress.snapshot())
+
     def new_process(self, args):
         taskname = args[0]
         target = args[1]
         self.process_dict[taskname] = (-1,)
         self.process_done_dict[taskname][f'{target}_exception'] = None
         self.process_done_dict[taskname]['process_ended'] = False
+        self.process_done_dict[taskname]['is_drained'] = False
         if target == 'TileDownload':
             self.progress_info_dict[taskname] = {}
             self.progress_info_dict[taskname]['target'] = target
@@ -61,18 +185,13 @@ class MultiprocessManager:
             self.progress_info_dict[taskname]['is_download_to_mem_complete'] = False
             self.process_singal_dict[taskname] = Event()
             # self.process_lock_dict[taskname] = Lock()
-            self.write_to_queue(taskname)
-            args_new = args + (self.progress_info_dict[taskname], self.process_done_dict[taskname], self.process_singal_dict[taskname],
-                               self.queue_dict[taskname])
-            new_process = Process(target=self.tiledownload, args=args_new)
+            stage = self.tiledownload
         elif target == 'CalculateTiles':
             self.progress_info_dict[taskname] = {}
             self.progress_info_dict[taskname]['target'] = target
             self.progress_info_dict[taskname]['is_task_complete'] = False
             # self.process_lock_dict[taskname] = Lock()
-            self.write_to_queue(taskname)
-            args_new = args + (self.progress_info_dict[taskname], self.process_done_dict[taskname], self.queue_dict[taskname])
-            new_process = Process(target=self.calculatetiles, args=args_new)
+            stage = self.calculatetiles
         else:
             self.progress_info_dict[taskname] = {}
             self.progress_info_dict[taskname]['stitched_tiles'] = 0
@@ -91,10 +210,28 @@ class MultiprocessManager:
             self.progress_info_dict[taskname]['is_update_sqlite_complete'] = False
             self.process_singal_dict[taskname] = Event()
             # self.process_lock_dict[taskname] = Lock()
-            self.write_to_queue(taskname)
-            args_new = args + (self.progress_info_dict[taskname], self.process_done_dict[taskname], self.process_singal_dict[taskname],
-                               self.queue_dict[taskname])
-            new_process = Process(target=self.tilestitch, args=args_new)
+            stage = self.tilestitch
+        shared_progress = self.create_shared_progress(taskname)
+        self.apply_budgets()
+        if self.pool is not None:
+            # 提交到常驻工作进程，停止信号和进度队列使用工作进程自带的
+            worker = self.pool.acquire()
+            if taskname in self.queue_dict:
+                self.close_queue(taskname)
+            self.queue_dict[taskname] = worker.queue
+            self.process_singal_dict[taskname] = worker.stop_signal
+            job = self.pool.submit(worker, target, args, (shared_progress, self.process_done_dict[taskname]), self.progress_info_dict[taskname],
+                                   self.process_done_dict[taskname])
+            self.job_dict[taskname] = job
+            self.process_dict[taskname] = (job.pid, job) + args
+            return
+        self.job_dict.pop(taskname, None)
+        self.write_to_queue(taskname)
+        if target == 'CalculateTiles':
+            args_new = args + (shared_progress, self.process_done_dict[taskname], self.queue_dict[taskname])
+        else:
+            args_new = args + (shared_progress, self.process_done_dict[taskname], self.process_singal_dict[taskname], self.queue_dict[taskname])
+        new_process = Process(target=stage, args=args_new)
         new_process.start()
         self.process_dict[taskname] = (new_process.pid, new_process) + args
 
@@ -125,7 +262,10 @@ class MultiprocessManager:
         try:
             tasks.multiworker()
             download_fail = progress_info['download_fail']
-            if download_fail <= self.max_download_fail:
+            if process_done.get('is_drained'):
+                # 被停止时已下载的瓦片已写入，阶段未完成
+                process_done[target] = False
+            elif download_fail <= self.max_download_fail:
                 process_done[target] = True
             else:
                 print(f'{taskname} max_download_fail')
@@ -150,16 +290,17 @@ class MultiprocessManager:
             tasks.write_to_queue()
 
     def tilestitch(self, taskname: str, target: str, path: str, sqlitename: str, ee_object: str, polygon: str, scale: int, region: str, start_date: str,
-                   end_date: str, datainfo_url: str, is_export_shp: bool, enable_gpu: bool, kernel_func, progress_info: dict, process_done: dict,
-                   stop_signal, queue):
+                   end_date: str, datainfo_url: str, is_export_shp: bool, enable_gpu: bool, kernel_func, stream_to_geotiff: bool, pyramid_levels: int,
+                   progress_info: dict, process_done: dict, stop_signal, queue):
         print(f'{taskname} pid={os.getpid()} tilestitch start')
         tasks = geestitch.GeeImageStitch(taskname, path, sqlitename, ee_object, polygon, scale, region, start_date, end_date, datainfo_url, is_export_shp,
-                                         progress_info, process_done, stop_signal, queue, enable_gpu, kernel_func)
+                                         progress_info, process_done, stop_signal, queue, enable_gpu, kernel_func, stream_to_geotiff,
+                                         pyramid_levels)
         try:
             tasks.multiworker()
-            # 暂停时，等待主进程读取共享字典数据后结束，正常完成任务时，直接结束
-            process_done[target] = True
-            print(f'{taskname} tilestitch done')
+            # 被停止时已拼接的条带与检查点已写入，阶段未完成
+            process_done[target] = not process_done.get('is_drained')
+            print(f'{taskname} tilestitch {"drained" if process_done.get("is_drained") else "done"}')
         except geestitch.GPUUnavailableError as e:
             print("GPU 不可用，切换到 CPU 模式：", e)
             process_done['gpu_exception'] = str(e)
@@ -179,39 +320,37 @@ class MultiprocessManager:
         with concurrent.futures.ThreadPoolExecutor(max_workers=10) as executor:
             # 多线程关闭所有任务
             self.futures = [executor.submit(self.closeone, taskname) for taskname in task_list]
+        if self.pool is not None:
+            self.pool.shutdown()
+        if self.monitor is not None:
+            self.monitor.stop()
+
+    def close_job(self, taskname, job, st_time):
+        # 工作进程中的作业：计算阶段不响应停止信号，直接回收工作进程；下载、拼接阶段发出停止信号后不再取新的瓦片，
+        # 在途结果写入数据库、临时文件落盘后作业自行结束，完成消息即确认，超时后回收工作进程
+        self.pool.cancel(job, force=job.target == 'CalculateTiles')
+        while job.is_alive():
+            remaining = self.drain_time_out - (time.time() - st_time)
+            if remaining <= 0:
+                self.pool.cancel(job, force=True)
+                break
+            try:
+                wait([job.worker.conn, job.worker.process.sentinel], timeout=min(remaining, 1))
+            except OSError:
+                time.sleep(0.1)
 
     def closeone(self, taskname):
         st_time = time.time()
+        self.release(taskname)
         try:
-            task_target = self.process_dict[taskname][2]
-            task_pid = self.process_dict[taskname][0]
-            if self.process_dict[taskname][2] == 'CalculateTiles':
-                os.kill(task_pid, signal.SIGTERM)
-            else:
-                self.process_singal_dict[taskname].set()
-            # 销毁子进程
-            while True:
-                try:
-                    if task_target == 'GeeImageStitch' or time.time() - st_time > self.close_time_out:
-                        # 超时强制结束进程
-                        if time.time() - st_time > self.close_time_out:
-                            os.kill(task_pid, signal.SIGTERM)
-                        # 拼接任务完成进度信息写入后，立即结束进程，不等待磁盘写入
-                        if self.progress_info_dict[taskname]['is_update_sqlite_complete']:
-                            os.kill(task_pid, signal.SIGTERM)
-                    else:
-                        psutil.Process(task_pid)
-                except Exception as e:
-                    print(e)
-                    break
-                time.sleep(0.1)
+            job = self.job_dict.get(taskname)
+            if job is None:
+                self.close_process(taskname, st_time)
+            elif not job.finished:
+                self.close_job(taskname, job, st_time)
             # 拷贝数据，用于写入任务记录
-            while not self.queue_dict[taskname].empty():
-                try:
-                    data = self.queue_dict[taskname].get_nowait()  # 非阻塞方式取出数据
-                    self.progress_info_dict[taskname], self.process_done_dict[taskname] = (data[0], data[1])
-                except:
-                    break
+            self.drain_queue(taskname)
+            self.read_progress(taskname)
             this_progress_info = dict(self.progress_info_dict[taskname])
             self.clear_files_when_close_process(taskname, this_progress_info)
             self.clear_dict(taskname)
@@ -219,7 +358,24 @@ class MultiprocessManager:
         except Exception as e:
             pass
 
+    def close_process(self, taskname, st_time):
+        # 独立进程：计算阶段直接结束；下载、拼接阶段发出停止信号，写入在途结果后进程自行退出，超时后强制结束
+        process, task_target = self.process_dict[taskname][1], self.process_dict[taskname][3]
+        if task_target == 'CalculateTiles':
+            process.terminate()
+        else:
+            self.process_singal_dict[taskname].set()
+        while process.is_alive():
+            if time.time() - st_time > self.drain_time_out:
+                process.terminate()
+                process.join(5)
+                break
+            # 子进程退出前需写完进度队列
+            self.drain_queue(taskname)
+            process.join(0.1)
+
     def clear_dict(self, taskname):
+        self.release(taskname)
         try:
             del self.process_dict[taskname]
         except Exception as e:
@@ -233,16 +389,20 @@ class MultiprocessManager:
         except Exception as e:
             pass
         try:
-            q = self.queue_dict[taskname]
-            del self.queue_dict[taskname]
-            q.close()
-            q.join_thread()
+            self.close_queue(taskname)
+        except Exception as e:
+            pass
+        try:
+            del self.job_dict[taskname]
+        except Exception as e:
+            pass
+        try:
+            self.shared_progress_dict.pop(taskname).unlink()
         except Exception as e:
             pass
 
     def clear_files_when_close_process(self, taskname, this_progress_info):
         try:
-            taskfile = self.task_path / f'{taskname}.xml'
             print(self.process_dict[taskname][3])
             if self.process_dict[taskname][3] == 'CalculateTiles':
                 savepath = self.process_dict[taskname][4]
@@ -253,50 +413,34 @@ class MultiprocessManager:
                 stitched = this_progress_info['stitched_tiles']
                 crop_total = this_progress_info['crop_total']
                 croped = this_progress_info['croped_blocks']
-                with open(taskfile, 'r', encoding='utf-8') as file:
-                    xml_str = file.read()
-                task_info = xmltodict.parse(xml_str)
-                task_info['data']['row']['stitchprogress'] = f"{stitched / stitch_total * 100:.2f}"
-                task_info['data']['row']['cropprogress'] = f"{croped / crop_total * 100:.2f}"
-                xml_str = xmltodict.unparse(task_info, pretty=True)
-                with open(taskfile, 'w', encoding='utf-8') as f:
-                    f.write(xml_str)
+                self.store.save(taskname, stitchprogress=round(stitched / stitch_total * 100, 2), cropprogress=round(croped / crop_total * 100, 2))
             elif self.process_dict[taskname][3] == 'TileDownload':
                 try:
                     download_total = this_progress_info['download_total']
                     download_success = this_progress_info['download_success']
                     download_fail = this_progress_info['download_fail']
-                    download_progress = f"{(download_success + download_fail) / download_total * 100:.2f}"
-                    with open(taskfile, 'r', encoding='utf-8') as file:
-                        xml_str = file.read()
-                    task_info = xmltodict.parse(xml_str)
-                    task_info['data']['row']['downloadprogress'] = download_progress
-                    xml_str = xmltodict.unparse(task_info, pretty=True)
-                    with open(taskfile, 'w', encoding='utf-8') as f:
-                        f.write(xml_str)
+                    self.store.save(taskname, downloadprogress=round((download_success + download_fail) / download_total * 100, 2))
                 except Exception as e:
                     print(e)
         except Exception as e:
             pass
 
+    def resource_usage(self, name='total'):
+        # 最近一次资源采样中主进程、某个任务或全部进程（total）的占用，尚未采样时返回None
+        latest = self.monitor.latest() if self.monitor is not None else None
+        if latest is None:
+            return None
+        return latest[1].get(name)
+
     def total_mem(self):
-        for process in self.process_dict:
-            self.mem_useage = self.mem_useage + psutil.Process(self.process_dict[process][2]).memory_info().rss
-        self.mem_useage = (self.mem_useage + psutil.Process().memory_info().rss) / 1024 / 1024
-        return self.mem_useage
+        # 全部进程占用内存之和（MB），取自后台采样
+        usage = self.resource_usage()
+        return usage['rss'] if usage is not None else None
 
     def total_cpu(self):
-        try:
-            for process in self.process_dict:
-                self.cpu_usage = self.cpu_usage + psutil.Process(self.process_dict[process][2]).cpu_percent(interval=0.5)
-            self.cpu_usage = (self.cpu_usage + psutil.Process().cpu_percent(interval=0.5))
-            return self.cpu_usage
-        except psutil.ZombieProcess:
-            return None
-        except psutil.NoSuchProcess:
-            return None
-        except psutil.AccessDenied:
-            return None
+        # 全部进程CPU占用之和（%），取自后台采样
+        usage = self.resource_usage()
+        return usage['cpu'] if usage is not None else None
 
     def is_task_inprogress(self, taskname):
         try:
@@ -309,6 +453,50 @@ class MultiprocessManager:
         return self.progress_info_dict[f'{taskname}']
 
 
+
+def pool_worker(max_download_fail, task_path, conn, stop_signal, queue):
+    # 常驻工作进程入口：按控制管道接收(作业编号, 阶段, 参数, 共享进度块, 完成状态)，None表示退出
+    manager = MultiprocessManager(max_download_fail, task_path, pool_size=0, monitor_interval=0)
+    parent = parent_process()
+    print(f'pid={os.getpid()} pool worker start')
+    while True:
+        try:
+            # 主进程异常退出时，工作进程随之退出
+            if not conn.poll(1):
+                if parent is not None and not parent.is_alive():
+                    break
+                continue
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        job_id, target, args = job[:3]
+        result = None
+        try:
+            if target == 'Initialize':
+                geedownload.initialize_ee(*args)
+            else:
+                progress_info, process_done = job[3:]
+                job_queue = JobQueue(queue, job_id)
+                try:
+                    if target == 'CalculateTiles':
+                        manager.calculatetiles(*args, progress_info, process_done, job_queue)
+                    elif target == 'TileDownload':
+                        manager.tiledownload(*args, progress_info, process_done, stop_signal, job_queue)
+                    else:
+                        manager.tilestitch(*args, progress_info, process_done, stop_signal, job_queue)
+                finally:
+                    result = (progress_info.extras(), dict(process_done))
+                    progress_info.close()
+        except Exception as e:
+            traceback.print_exc()
+        try:
+            conn.send((job_id, result))
+        except (EOFError, OSError):
+            break
+
+
 # if __name__ == '__main__':
 #     task = MultiprocessManager()
 #     task.new_process(args=
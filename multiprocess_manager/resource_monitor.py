@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import collections
+import os
+import threading
+import time
+import psutil
+
+
+class ResourceMonitor:
+    """
+    后台资源采样：按interval秒在独立线程中读取主进程、各任务进程及其子进程的CPU、内存、磁盘读写字节数和句柄数，
+    不阻塞调用方；cpu_percent以上次采样为基准，无需等待。采样结果保存在长度为history的环形缓冲中，供界面和指标接口读取
+    get_processes()返回{名称: pid}，每次采样时调用；子进程（如拼接进程池）每children_interval次采样重新查找一次
+    每个名称的采样为{'pid', 'processes', 'cpu', 'rss', 'read_bytes', 'write_bytes', 'read_rate', 'write_rate', 'handles'}，
+    cpu为百分比（多核可超过100），rss单位MB，读写速率单位字节/秒，'total'为全部进程之和
+    """
+    fields = ('processes', 'cpu', 'rss', 'read_bytes', 'write_bytes', 'read_rate', 'write_rate', 'handles')
+
+    def __init__(self, get_processes, interval=2, history=300, children_interval=5):
+        self.get_processes = get_processes
+        self.interval = interval
+        self.history = collections.deque(maxlen=history)
+        self.children_interval = children_interval
+        self.process_cache = {}
+        self.children = {}
+        self.last_io = {}
+        self.sample_count = 0
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join(timeout=self.interval + 1)
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                self.sample()
+            except Exception as e:
+                print(e)
+            self.stop_event.wait(self.interval)
+
+    def latest(self):
+        # 最近一次采样(时间, {名称: 采样})，尚未采样时返回None
+        with self.lock:
+            return self.history[-1] if self.history else None
+
+    def read_history(self, name='total', seconds=None):
+        # 某个名称的历史采样[(时间, 采样)]，seconds为只取最近的秒数
+        since = time.time() - seconds if seconds is not None else 0
+        with self.lock:
+            records = list(self.history)
+        return [(timestamp, samples[name]) for timestamp, samples in records if timestamp >= since and name in samples]
+
+    def get_process(self, pid):
+        # 缓存psutil.Process对象，cpu_percent需与上次调用使用同一对象
+        process = self.process_cache.get(pid)
+        if process is None:
+            process = self.process_cache[pid] = psutil.Process(pid)
+            process.cpu_percent(None)
+        return process
+
+    def find_children(self, pids):
+        # 一次遍历全部进程的父进程编号，查找各进程的子孙进程；单独采样的进程（如主进程下的任务进程）不计入其父进程
+        parents = collections.defaultdict(list)
+        for process in psutil.process_iter(['ppid']):
+            parents[process.info['ppid']].append(process.pid)
+        children = {}
+        for pid in pids:
+            stack, found = [pid], []
+            while stack:
+                for child in parents.get(stack.pop(), ()):
+                    if child in pids:
+                        continue
+                    found.append(child)
+                    stack.append(child)
+            children[pid] = found
+        return children
+
+    def read_process(self, pid):
+        process = self.get_process(pid)
+        with process.oneshot():
+            cpu = process.cpu_percent(None)
+            rss = process.memory_info().rss
+            try:
+                io = process.io_counters()
+                read_bytes, write_bytes = io.read_bytes, io.write_bytes
+            except (AttributeError, psutil.AccessDenied):
+                read_bytes, write_bytes = 0, 0
+            try:
+                handles = process.num_handles() if os.name == 'nt' else process.num_fds()
+            except (AttributeError, psutil.AccessDenied):
+                handles = 0
+        return cpu, rss, read_bytes, write_bytes, handles
+
+    def sample(self):
+        timestamp = time.time()
+        processes = {name: pid for name, pid in self.get_processes().items() if pid is not None and pid > 0}
+        if self.sample_count % self.children_interval == 0 or set(processes.values()) - set(self.children):
+            self.children = self.find_children(set(processes.values()))
+        self.sample_count = self.sample_count + 1
+        samples, alive = {}, set()
+        total = dict.fromkeys(self.fields, 0)
+        for name, pid in processes.items():
+            sample = dict.fromkeys(self.fields, 0)
+            sample['pid'] = pid
+            for member in [pid] + self.children.get(pid, []):
+                try:
+                    cpu, rss, read_bytes, write_bytes, handles = self.read_process(member)
+                except psutil.Error:
+                    continue
+                alive.add(member)
+                sample['processes'] += 1
+                sample['cpu'] += cpu
+                sample['rss'] += rss / 1024 / 1024
+                sample['read_bytes'] += read_bytes
+                sample['write_bytes'] += write_bytes
+                sample['handles'] += handles
+            last = self.last_io.get(name)
+            if last is not None and last[0] == pid and timestamp > last[1]:
+                elapsed = timestamp - last[1]
+                sample['read_rate'] = max(sample['read_bytes'] - last[2], 0) / elapsed
+                sample['write_rate'] = max(sample['write_bytes'] - last[3], 0) / elapsed
+            self.last_io[name] = (pid, timestamp, sample['read_bytes'], sample['write_bytes'])
+            samples[name] = sample
+            for key in self.fields:
+                total[key] += sample[key]
+        samples['total'] = total
+        # 已退出的进程不再缓存
+        for pid in set(self.process_cache) - alive:
+            del self.process_cache[pid]
+        for name in set(self.last_io) - set(processes):
+            del self.last_io[name]
+        with self.lock:
+            self.history.append((timestamp, samples))
+        return samples
@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import itertools
+import os
+import shutil
+from threading import Lock
+import psutil
+
+
+class TaskScheduler:
+    """
+    全局任务调度：各任务阶段启动前向调度器申请，按全局预算准入，预算不足时按(优先级, 申请顺序)排队
+    预算：
+    max_ee_requests：所有任务同时进行的EE请求数，计算阶段固定占1个，其余按优先级权重分给正在下载的任务，每个任务至少1个
+    max_stitch_jobs：同时进行的拼接阶段数
+    memory_budget：任务进程占用内存之和（MB），超过后不再准入新的阶段，为0时取物理内存的80%
+    min_free_disk：拼接准入时磁盘需保留的空间（MB），同一磁盘上正在拼接的任务按预估占用预留空间
+    同一类资源只准入排在最前的等待者，后申请的小任务不会越过先申请的任务
+    """
+    ee_targets = ('CalculateTiles', 'TileDownload')
+
+    def __init__(self, max_ee_requests=40, max_stitch_jobs=1, memory_budget=0, min_free_disk=1024, memory_usage=None):
+        self.max_ee_requests = max_ee_requests
+        self.max_stitch_jobs = max_stitch_jobs
+        self.memory_budget = memory_budget
+        self.min_free_disk = min_free_disk
+        self.memory_usage = memory_usage
+        self.running = {}
+        self.waiting = {}
+        self.arrivals = itertools.count()
+        self.lock = Lock()
+
+    def resource(self, target):
+        return 'ee' if target in self.ee_targets else 'stitch'
+
+    def admit(self, taskname, target, path=None, priority=1, disk_bytes=0):
+        # 返回True表示准入，任务阶段可立即启动；返回False时任务进入或留在等待队列
+        with self.lock:
+            if self.running.get(taskname, {}).get('target') == target:
+                return True
+            self.running.pop(taskname, None)
+            waiting = self.waiting.get(taskname)
+            if waiting is None or waiting['target'] != target:
+                waiting = {'target': target, 'priority': priority, 'arrival': next(self.arrivals), 'path': path, 'disk_bytes': disk_bytes,
+                           'reason': None}
+                self.waiting[taskname] = waiting
+            waiting['reason'] = self.blocking_reason(taskname, waiting)
+            if waiting['reason'] is not None:
+                return False
+            del self.waiting[taskname]
+            self.running[taskname] = waiting
+            return True
+
+    def finish(self, taskname):
+        # 阶段结束，只释放已准入的预算，保留排队位置
+        with self.lock:
+            self.running.pop(taskname, None)
+
+    def release(self, taskname):
+        # 任务暂停、删除或完成，同时退出等待队列
+        with self.lock:
+            self.running.pop(taskname, None)
+            self.waiting.pop(taskname, None)
+
+    def order(self):
+        return sorted(self.waiting.items(), key=lambda item: (-item[1]['priority'], item[1]['arrival']))
+
+    def blocking_reason(self, taskname, waiting):
+        resource = self.resource(waiting['target'])
+        for other, other_waiting in self.order():
+            if other == taskname:
+                break
+            if self.resource(other_waiting['target']) == resource:
+                return '等待前序任务'
+        memory_budget = self.memory_budget
+        if memory_budget == 0:
+            memory_budget = psutil.virtual_memory().total / 1024 / 1024 * 0.8
+        if memory_budget and self.running and self.memory_usage is not None and self.memory_usage() > memory_budget:
+            return '内存不足'
+        running = [stage for stage in self.running.values() if self.resource(stage['target']) == resource]
+        if resource == 'ee':
+            if len(running) >= self.max_ee_requests:
+                return '请求数已满'
+            return None
+        if len(running) >= self.max_stitch_jobs:
+            return '拼接数已满'
+        return self.disk_reason(waiting, running)
+
+    def disk_reason(self, waiting, running):
+        # 同一磁盘上没有其他拼接任务时直接准入，由拼接阶段自身报告磁盘空间不足
+        if not waiting['disk_bytes'] or waiting['path'] is None:
+            return None
+        try:
+            device = os.stat(waiting['path']).st_dev
+            reserved = sum(stage['disk_bytes'] for stage in running if stage['path'] is not None and os.stat(stage['path']).st_dev == device)
+            free = shutil.disk_usage(waiting['path']).free
+        except OSError:
+            return None
+        if reserved and free - reserved - self.min_free_disk * 1024 * 1024 < waiting['disk_bytes']:
+            return '磁盘空间不足'
+        return None
+
+    def ee_shares(self):
+        # 按优先级权重分配EE请求数，返回{任务名: 并发上限}，只包含正在下载的任务
+        with self.lock:
+            downloads = {taskname: stage['priority'] for taskname, stage in self.running.items() if stage['target'] == 'TileDownload'}
+            calculates = sum(1 for stage in self.running.values() if stage['target'] == 'CalculateTiles')
+            if not downloads:
+                return {}
+            budget = max(self.max_ee_requests - calculates, len(downloads))
+            weight = sum(downloads.values())
+            shares = {taskname: max(1, int(budget * priority / weight)) for taskname, priority in downloads.items()}
+            rest = budget - sum(shares.values())
+            for taskname in sorted(downloads, key=lambda name: -downloads[name]):
+                if rest <= 0:
+                    break
+                shares[taskname] = shares[taskname] + 1
+                rest = rest - 1
+            return shares
+
+    def queue_position(self, taskname):
+        # 返回(排队位置, 等待的阶段, 原因)，未排队时返回None
+        with self.lock:
+            for position, (other, waiting) in enumerate(self.order(), start=1):
+                if other == taskname:
+                    return position, waiting['target'], waiting['reason']
+            return None
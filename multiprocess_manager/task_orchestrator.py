@@ -0,0 +1,234 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import threading
+import time
+import traceback
+from multiprocessing import Pipe
+from multiprocessing.connection import wait
+
+stage_names = ('CalculateTiles', 'TileDownload', 'TileStitch')
+# 由各阶段的完成状态决定下一阶段
+next_stages = {(False, False, False): 'CalculateTiles', (True, False, False): 'TileDownload', (True, True, False): 'TileStitch'}
+
+
+class TaskOrchestrator:
+    """
+    事件驱动的任务状态机：常驻工作进程在阶段结束时经控制管道返回完成状态与异常，调度线程随即被唤醒并转入下一阶段，
+    不再由每个任务的定时器轮询；独立进程模式下等待进程退出。只有等待全局调度器准入或运行独立进程的任务按recheck_interval重新检查
+    状态转换时以事务写入TaskStore。on_event(taskname, event, data)在调度线程中回调，event为：
+    stage_started、stage_done、gpu_unavailable、task_complete、task_failed（阶段重试次数用尽）、task_error（阶段异常，stop_on_exception时任务停止）
+    任务字典包含taskname、ee_object、downloadpath、region、regionname、start_date、end_date、scale、bands、is_export_shp、priority、
+    proxies、ee_initialize、datainfo_url、enable_gpu、kernel_func、stream_to_geotiff、pyramid_levels和各阶段完成状态done
+    """
+    def __init__(self, manager, store, max_stage_try=3, stop_on_exception=False, on_event=None, recheck_interval=1, idle_interval=5):
+        self.manager = manager
+        self.store = store
+        self.max_stage_try = max_stage_try
+        self.stop_on_exception = stop_on_exception
+        self.on_event = on_event
+        self.recheck_interval = recheck_interval
+        self.idle_interval = idle_interval
+        self.tasks = {}
+        self.lock = threading.RLock()
+        self.wakeup_reader, self.wakeup_writer = Pipe(duplex=False)
+        self.wakeup_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.manager.store = store
+        if self.manager.pool is not None:
+            self.manager.pool.on_job_end = lambda job: self.notify()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def notify(self):
+        with self.wakeup_lock:
+            try:
+                self.wakeup_writer.send(None)
+            except (OSError, ValueError):
+                pass
+
+    def add_task(self, task):
+        task = dict(task)
+        taskname = task['taskname']
+        task.update(state='queued', stage=None, attempts={stage: 0 for stage in stage_names}, error=None)
+        with self.lock:
+            self.tasks[taskname] = task
+            self.manager.process_done_dict[taskname] = dict(task['done'])
+            self.store.save_done(taskname, task['done'], state='queued', stage=None, error=None)
+        self.notify()
+
+    def remove_task(self, taskname, state='paused'):
+        # 停止状态转换并释放调度预算，执行中的阶段由调用方通过closeone结束
+        with self.lock:
+            task = self.tasks.pop(taskname, None)
+            self.manager.release(taskname)
+            if task is not None:
+                self.store.save(taskname, state=state)
+        return task
+
+    def is_active(self, taskname):
+        return taskname in self.tasks
+
+    def read_progress(self, taskname):
+        try:
+            self.manager.drain_queue(taskname)
+            self.manager.read_progress(taskname)
+        except Exception as e:
+            pass
+        return self.manager.progress_info_dict.get(taskname)
+
+    def emit(self, taskname, event, data=None):
+        if self.on_event is not None:
+            try:
+                self.on_event(taskname, event, data)
+            except Exception as e:
+                traceback.print_exc()
+
+    def waitables(self):
+        # 执行中的阶段：工作进程的控制管道或独立进程的sentinel；返回(等待对象, 是否需要定时检查)
+        objects, is_recheck = [self.wakeup_reader], False
+        for taskname, task in self.tasks.items():
+            if task['state'] != 'running':
+                is_recheck = True
+                continue
+            job = self.manager.job_dict.get(taskname)
+            if job is not None:
+                if not job.finished:
+                    objects.append(job.worker.conn)
+                continue
+            process = self.manager.process_dict.get(taskname, ())
+            if len(process) > 1:
+                objects.append(process[1].sentinel)
+            # 独立进程退出前需读空进度队列
+            is_recheck = True
+        return objects, is_recheck
+
+    def run(self):
+        while not self.stop_event.is_set():
+            with self.lock:
+                objects, is_recheck = self.waitables()
+            try:
+                ready = wait(objects, timeout=self.recheck_interval if is_recheck else self.idle_interval)
+            except OSError:
+                ready = []
+            if self.wakeup_reader in ready:
+                while self.wakeup_reader.poll():
+                    self.wakeup_reader.recv()
+            if self.stop_event.is_set():
+                break
+            with self.lock:
+                for taskname in list(self.tasks):
+                    self.advance(taskname)
+
+    def advance(self, taskname):
+        task = self.tasks[taskname]
+        try:
+            status = self.manager.is_task_inprogress(taskname)
+            self.read_progress(taskname)
+            process_done = self.manager.process_done_dict[taskname]
+            try:
+                if process_done['process_ended']:
+                    self.manager.end_process(taskname)
+            except Exception as e:
+                pass
+            if status:
+                return
+            stage = task['stage']
+            if task['state'] == 'running':
+                task['state'] = 'ended'
+                self.end_stage(task, stage, process_done)
+                if taskname not in self.tasks:
+                    return
+            done = {name: bool(process_done.get(name)) for name in stage_names}
+            stage = next_stages.get(tuple(done.values()))
+            if stage is None:
+                self.end_task(task, 'complete')
+                self.emit(taskname, 'task_complete')
+                return
+            if task['attempts'][stage] >= self.max_stage_try:
+                task['error'] = task['error'] or f'{stage}失败'
+                self.end_task(task, 'failed')
+                self.emit(taskname, 'task_failed', stage)
+                return
+            if not self.manager.admit(taskname, stage, task['downloadpath'], task['priority'], task['stream_to_geotiff']):
+                task['state'] = 'queued'
+                return
+            self.manager.create_queue(taskname)
+            task['attempts'][stage] = task['attempts'][stage] + 1
+            task['stage'], task['state'] = stage, 'running'
+            self.manager.new_process(self.stage_args(task, stage))
+            self.store.save(taskname, state='running', stage=stage)
+            self.emit(taskname, 'stage_started', stage)
+        except Exception as e:
+            traceback.print_exc()
+            task['error'] = str(e)
+            self.end_task(task, 'failed')
+            self.emit(taskname, 'task_failed', task['stage'])
+
+    def end_stage(self, task, stage, process_done):
+        taskname = task['taskname']
+        progress = self.stage_progress(taskname, stage)
+        if process_done.get(stage):
+            task['done'][stage] = True
+            self.store.save_done(taskname, task['done'], error=None, **progress)
+            self.emit(taskname, 'stage_done', stage)
+            return
+        exception = process_done.get(f'{stage}_exception')
+        task['error'] = exception or task['error']
+        self.store.save(taskname, error=task['error'], **progress)
+        # GPU不可用时切换到CPU拼接
+        if 'Error when trying to use GPU' in str(process_done.get('gpu_exception')):
+            task['enable_gpu'] = False
+            self.emit(taskname, 'gpu_unavailable', process_done.get('gpu_exception'))
+        if exception is not None and self.stop_on_exception:
+            # 保留进度与完成状态字典，由界面读取异常信息
+            self.tasks.pop(taskname, None)
+            self.manager.release(taskname)
+            self.store.save(taskname, state='error')
+            self.emit(taskname, 'task_error', exception)
+
+    def stage_progress(self, taskname, stage):
+        info = self.manager.progress_info_dict.get(taskname, {})
+        try:
+            if stage == 'TileDownload':
+                return {'downloadprogress': round((info['download_success'] + info['download_fail']) / info['download_total'] * 100, 2)}
+            elif stage == 'TileStitch':
+                return {'stitchprogress': round(info['stitched_tiles'] / info['stitch_total'] * 100, 2),
+                        'cropprogress': round(info['croped_blocks'] / info['crop_total'] * 100, 2)}
+        except (KeyError, TypeError, ZeroDivisionError):
+            pass
+        return {}
+
+    def end_task(self, task, state):
+        taskname = task['taskname']
+        self.tasks.pop(taskname, None)
+        task['state'] = state
+        if state == 'complete':
+            self.store.save_done(taskname, task['done'], state=state, error=None, downloadprogress=100, stitchprogress=100, cropprogress=100,
+                                 finishtime=task.setdefault('finishtime', time.time()))
+        else:
+            self.store.save(taskname, state=state, error=task['error'])
+        self.manager.clear_dict(taskname)
+
+    @staticmethod
+    def stage_args(task, stage):
+        taskname = task['taskname']
+        if stage == 'CalculateTiles':
+            return (taskname, stage, task['proxies'], task['ee_object'], task['downloadpath'], task['region'], task['ee_initialize'],
+                    task['start_date'], task['end_date'], task['scale'], task['bands'])
+        elif stage == 'TileDownload':
+            return (taskname, stage, task['downloadpath'] + f'/{taskname}.nev', task['ee_object'], task['start_date'], task['end_date'],
+                    task['proxies'], task['ee_initialize'], task['scale'])
+        return (taskname, stage, task['downloadpath'], f'{taskname}.nev', task['ee_object'], task['region'], task['scale'], task['regionname'],
+                task['start_date'], task['end_date'], task['datainfo_url'], task['is_export_shp'], task['enable_gpu'],
+                task['kernel_func'] if task['enable_gpu'] else None, task['stream_to_geotiff'], task['pyramid_levels'])
+
+    def shutdown(self):
+        # 调度线程退出，未结束的任务记为暂停，执行中的阶段由调用方通过closeall结束
+        self.stop_event.set()
+        self.notify()
+        self.thread.join(timeout=5)
+        with self.lock:
+            for taskname in list(self.tasks):
+                self.remove_task(taskname)
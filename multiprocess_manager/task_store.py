@@ -0,0 +1,100 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import os
+import sqlite3
+import time
+from threading import Lock
+
+
+class TaskStore:
+    """
+    任务登记库：task表保存任务定义（数据集、区域、日期、下载路径等），task_state表保存各阶段完成状态、进度、错误，
+    状态转换时以事务写入SQLite，替代逐个解析、改写任务XML；任务列表按创建时间索引分页读取，加载耗时与历史任务数量无关
+    界面线程、调度线程共用一个连接，由锁保证串行访问；WAL模式下其他进程可同时读取
+    """
+    task_columns = ('datasetname', 'createtime', 'data_source_lv1', 'data_source_lv2', 'data_source_lv3', 'datasetregion', 'base_map',
+                    'datarangetype', 'adcode_picked_region_draw', 'picked_sn', 'picked_sh', 'picked_xn', 'data_scale', 'start_date', 'end_date',
+                    'bands', 'downloadpath', 'is_export_shp', 'priority')
+    columns = ('state', 'stage', 'is_CalculateTiles_done', 'is_TileDownload_done', 'is_TileStitch_done', 'downloadprogress', 'stitchprogress',
+               'cropprogress', 'finishtime', 'error', 'spec', 'updatetime')
+
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.connection = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.connection.row_factory = sqlite3.Row
+        self.lock = Lock()
+        with self.lock, self.connection:
+            self.connection.execute('pragma journal_mode=wal')
+            self.connection.execute('create table if not exists task_state (taskname text primary key, state text, stage text, '
+                                    'is_CalculateTiles_done integer default 0, is_TileDownload_done integer default 0, '
+                                    'is_TileStitch_done integer default 0, downloadprogress real, stitchprogress real, cropprogress real, '
+                                    'finishtime real, error text, spec text, updatetime real)')
+            self.connection.execute('create table if not exists task (taskname text primary key, datasetname text, createtime real, '
+                                    'data_source_lv1 text, data_source_lv2 text, data_source_lv3 text, datasetregion text, base_map text, '
+                                    'datarangetype integer, adcode_picked_region_draw text, picked_sn integer, picked_sh integer, '
+                                    'picked_xn integer, data_scale integer, start_date text, end_date text, bands text, downloadpath text, '
+                                    'is_export_shp integer default 1, priority integer default 1)')
+            self.connection.execute('create index if not exists task_createtime on task (createtime desc)')
+
+    def get(self, taskname):
+        with self.lock:
+            row = self.connection.execute('select * from task_state where taskname = ?', (taskname,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def all(self):
+        with self.lock:
+            rows = self.connection.execute('select * from task_state').fetchall()
+        return {row['taskname']: dict(row) for row in rows}
+
+    def save(self, taskname, **fields):
+        # 只更新给出的字段，任务不存在时新建
+        fields = {key: value for key, value in fields.items() if key in self.columns}
+        fields['updatetime'] = time.time()
+        keys = list(fields)
+        with self.lock, self.connection:
+            self.connection.execute(f'insert into task_state (taskname, {", ".join(keys)}) values (?, {", ".join("?" * len(keys))}) '
+                                    f'on conflict(taskname) do update set {", ".join(f"{key} = excluded.{key}" for key in keys)}',
+                                    (taskname, *fields.values()))
+
+    def save_done(self, taskname, done, **fields):
+        # done为{阶段: 是否完成}
+        self.save(taskname, **{f'is_{stage}_done': bool(value) for stage, value in done.items()}, **fields)
+
+    def add_task(self, taskname, **fields):
+        # 登记任务定义，同名任务的定义被覆盖，完成状态保留，覆盖任务时由调用方先delete
+        fields = {key: value for key, value in fields.items() if key in self.task_columns}
+        keys = list(fields)
+        with self.lock, self.connection:
+            self.connection.execute(f'insert into task (taskname, {", ".join(keys)}) values (?, {", ".join("?" * len(keys))}) '
+                                    f'on conflict(taskname) do update set {", ".join(f"{key} = excluded.{key}" for key in keys)}',
+                                    (taskname, *fields.values()))
+
+    def get_task(self, taskname):
+        # 任务定义与完成状态，未登记的任务返回None
+        with self.lock:
+            row = self.connection.execute('select * from task left join task_state using (taskname) where task.taskname = ?',
+                                          (taskname,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def list_tasks(self, limit, offset=0):
+        # 按创建时间由新到旧分页读取任务定义与完成状态
+        with self.lock:
+            rows = self.connection.execute('select * from task left join task_state using (taskname) order by task.createtime desc '
+                                           'limit ? offset ?', (limit, offset)).fetchall()
+        return [dict(row) for row in rows]
+
+    def count_tasks(self):
+        with self.lock:
+            return self.connection.execute('select count(*) from task').fetchone()[0]
+
+    def delete(self, taskname):
+        with self.lock, self.connection:
+            self.connection.execute('delete from task_state where taskname = ?', (taskname,))
+            self.connection.execute('delete from task where taskname = ?', (taskname,))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
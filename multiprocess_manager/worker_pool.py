@@ -0,0 +1,294 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import atexit
+import itertools
+import os
+import threading
+import time
+from multiprocessing import Process, Event, Queue, Pipe, resource_tracker
+import psutil
+
+
+class JobQueue:
+    """
+    工作进程内使用的进度队列包装：每条进度数据附带作业编号，常驻工作进程的队列在多个作业之间复用，
+    主进程据此丢弃上一个作业迟到的进度数据
+    """
+    def __init__(self, queue, job_id):
+        self.queue = queue
+        self.job_id = job_id
+
+    def put(self, data):
+        self.queue.put(tuple(data) + (self.job_id,))
+
+    def put_nowait(self, data):
+        self.queue.put_nowait(tuple(data) + (self.job_id,))
+
+
+class PoolJob:
+    """
+    提交到常驻工作进程的一个阶段作业，提供与multiprocessing.Process一致的pid、is_alive()，替换管理器中原有的进程句柄
+    作业结束时，工作进程通过控制管道返回最终的进度与完成状态，先于队列中的数据写入主进程的字典
+    """
+    def __init__(self, job_id, worker, target, progress_info, process_done, memory_limit=0, time_limit=0):
+        self.job_id = job_id
+        self.worker = worker
+        self.target = target
+        self.progress_info = progress_info
+        self.process_done = process_done
+        self.memory_limit = memory_limit
+        self.time_limit = time_limit
+        self.st_time = time.time()
+        self.stop_time = None
+        self.limit_exceeded = None
+        self.is_cancelled = False
+        self.finished = False
+        # 作业结束时的回调，由WorkerPool.on_job_end设置，用于唤醒等待阶段结束的调度线程
+        self.on_finish = None
+
+    @property
+    def pid(self):
+        return self.worker.pid
+
+    def is_alive(self):
+        if not self.finished:
+            self.worker.poll()
+        return not self.finished
+
+    def finish(self, result):
+        if result is not None:
+            extras, process_done = result
+            self.progress_info.update(extras)
+            self.process_done.update(process_done)
+        if self.limit_exceeded is not None:
+            self.process_done[self.target] = False
+            self.process_done[f'{self.target}_exception'] = self.limit_exceeded
+        self.process_done['process_ended'] = True
+        self.finished = True
+        if self.on_finish is not None:
+            self.on_finish(self)
+
+
+class PoolWorker:
+    """
+    常驻工作进程：进程内保持已导入的模块和已认证的EE会话，通过控制管道按顺序接收作业
+    每个工作进程拥有自己的停止信号与进度队列，二者只能在创建进程时继承，不能经管道传递
+    拼接阶段会创建进程池，工作进程不能设为daemon，由WorkerPool.shutdown()在退出时结束
+    """
+    def __init__(self, target, args):
+        self.conn, child_conn = Pipe()
+        self.stop_signal = Event()
+        self.queue = Queue()
+        self.process = Process(target=target, args=args + (child_conn, self.stop_signal, self.queue))
+        self.process.start()
+        child_conn.close()
+        self.job = None
+        self.is_reserved = False
+        self.is_recycle = False
+        self.lock = threading.Lock()
+
+    @property
+    def pid(self):
+        return self.process.pid
+
+    def is_idle(self):
+        return self.job is None and not self.is_reserved and not self.is_recycle and self.process.is_alive()
+
+    def end_job(self, job, result):
+        # 超限的作业、出错的作业、被取消但未确认已写入在途结果（is_drained）的作业结束后，工作进程标记为待回收
+        self.job = None
+        is_drained = result is not None and result[1].get('is_drained')
+        is_failed = result is None or result[1].get(f'{job.target}_exception') is not None
+        if job.limit_exceeded is not None or is_failed or ((job.is_cancelled or self.stop_signal.is_set()) and not is_drained):
+            self.is_recycle = True
+        job.finish(result)
+        return job
+
+    def send(self, message):
+        with self.lock:
+            self.conn.send(message)
+
+    def poll(self):
+        # 读取作业完成消息，工作进程退出时结束当前作业
+        with self.lock:
+            job = self.job
+            if job is None:
+                return None
+            try:
+                while self.conn.poll():
+                    job_id, result = self.conn.recv()
+                    if job_id == job.job_id:
+                        return self.end_job(job, result)
+            except (EOFError, OSError):
+                pass
+            if not self.process.is_alive():
+                return self.end_job(job, None)
+        return None
+
+    def terminate(self):
+        try:
+            self.process.terminate()
+            self.process.join(timeout=5)
+            if self.process.is_alive():
+                self.process.kill()
+                self.process.join()
+        except Exception as e:
+            print(e)
+        self.poll()
+        try:
+            self.conn.close()
+            self.queue.close()
+        except Exception as e:
+            pass
+
+
+class WorkerPool:
+    """
+    常驻工作进程池：各任务的计算、下载、拼接阶段提交到空闲的工作进程，不再为每个阶段重新启动进程、导入模块和初始化EE
+    全部工作进程忙碌时临时增加工作进程，作业结束后多于size的空闲进程退出
+    作业限制：超过内存（MB）或运行时间（秒）限制时先发出停止信号，grace_time秒内未结束则结束工作进程；
+    被取消、超限、出错的作业结束后回收所在的工作进程，避免残留线程和内存带入下一个作业
+    """
+    def __init__(self, size, target, args=(), memory_limit=0, time_limit=0, grace_time=5, interval=1):
+        self.size = size
+        self.target = target
+        self.args = args
+        self.memory_limit = memory_limit
+        self.time_limit = time_limit
+        self.grace_time = grace_time
+        self.interval = interval
+        self.job_ids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.on_job_end = None
+        if os.name == 'posix':
+            # 先启动resource_tracker再创建工作进程，使工作进程与主进程共用，共享内存进度块由主进程统一注销，不随工作进程回收被删除
+            resource_tracker.ensure_running()
+        self.workers = [PoolWorker(self.target, self.args) for _ in range(self.size)]
+        self.monitor_stop = threading.Event()
+        self.monitor_thread = threading.Thread(target=self.monitor, daemon=True)
+        self.monitor_thread.start()
+        # 先于multiprocessing等待非daemon子进程执行，避免主进程退出时等待常驻工作进程
+        atexit.register(self.shutdown)
+
+    def acquire(self):
+        # 取出一个空闲工作进程，并在提交作业前保留
+        with self.lock:
+            for worker in self.workers:
+                if worker.is_idle():
+                    worker.is_reserved = True
+                    return worker
+            worker = PoolWorker(self.target, self.args)
+            worker.is_reserved = True
+            self.workers.append(worker)
+            return worker
+
+    def submit(self, worker, target, args, state, progress_info, process_done, memory_limit=None, time_limit=None):
+        # state为发送到工作进程的(共享进度块, 完成状态)，progress_info、process_done为主进程中接收最终结果的字典
+        job = PoolJob(next(self.job_ids), worker, target, progress_info, process_done,
+                      self.memory_limit if memory_limit is None else memory_limit, self.time_limit if time_limit is None else time_limit)
+        job.on_finish = self.on_job_end
+        worker.stop_signal.clear()
+        with worker.lock:
+            worker.job = job
+            worker.is_reserved = False
+            worker.conn.send((job.job_id, target, args) + tuple(state))
+        return job
+
+    def warm_up(self, proxies, ee_initialize):
+        # 空闲工作进程提前完成EE认证，作业编号0的完成消息不对应任何作业
+        with self.lock:
+            for worker in self.workers:
+                if worker.is_idle():
+                    try:
+                        worker.send((0, 'Initialize', (ee_initialize, proxies)))
+                    except Exception as e:
+                        print(e)
+
+    def cancel(self, job, force=False):
+        # 工作进程已转入其他作业时不做处理
+        if job.worker.job is not job:
+            return
+        job.is_cancelled = True
+        if force:
+            self.replace(job.worker)
+        else:
+            job.worker.stop_signal.set()
+
+    def replace(self, worker):
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+        worker.terminate()
+        with self.lock:
+            if not self.monitor_stop.is_set() and len(self.workers) < self.size:
+                self.workers.append(PoolWorker(self.target, self.args))
+
+    def job_usage(self, job):
+        process = psutil.Process(job.pid)
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss = rss + child.memory_info().rss
+            except psutil.Error:
+                pass
+        return rss / 1024 / 1024, time.time() - job.st_time
+
+    def check_limits(self, worker):
+        job = worker.job
+        if job is None or job.finished:
+            return
+        if job.limit_exceeded is None and (job.memory_limit or job.time_limit):
+            try:
+                memory, elapsed = self.job_usage(job)
+            except psutil.Error:
+                return
+            if job.memory_limit and memory > job.memory_limit:
+                job.limit_exceeded = f'内存占用{memory:.0f}MB超过作业限制{job.memory_limit}MB'
+            elif job.time_limit and elapsed > job.time_limit:
+                job.limit_exceeded = f'运行时间{elapsed:.0f}秒超过作业限制{job.time_limit}秒'
+            if job.limit_exceeded is not None:
+                print(f'pid={job.pid} {job.target} {job.limit_exceeded}')
+                job.stop_time = time.time()
+                worker.stop_signal.set()
+        elif job.stop_time is not None and time.time() - job.stop_time > self.grace_time:
+            self.replace(worker)
+
+    def monitor(self):
+        while not self.monitor_stop.wait(self.interval):
+            with self.lock:
+                workers = list(self.workers)
+            for worker in workers:
+                try:
+                    worker.poll()
+                    if worker.job is None and not worker.is_reserved and (worker.is_recycle or not worker.process.is_alive()):
+                        self.replace(worker)
+                    else:
+                        self.check_limits(worker)
+                except Exception as e:
+                    print(e)
+            with self.lock:
+                idle_workers = [worker for worker in self.workers if worker.is_idle()]
+                retire_workers = idle_workers[:max(len(self.workers) - self.size, 0)]
+                for worker in retire_workers:
+                    self.workers.remove(worker)
+            for worker in retire_workers:
+                try:
+                    worker.send(None)
+                except Exception as e:
+                    pass
+                worker.terminate()
+
+    def shutdown(self):
+        self.monitor_stop.set()
+        with self.lock:
+            workers, self.workers = self.workers, []
+        for worker in workers:
+            try:
+                worker.send(None)
+            except Exception as e:
+                pass
+        for worker in workers:
+            worker.process.join(timeout=1)
+            worker.terminate()
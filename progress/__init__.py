@@ -0,0 +1,9 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+from ._tile_progress import TileProgress
+from ._stitch_checkpoint import StitchCheckpoint
+from ._shared_progress import SharedProgress
+from ._stage_metrics import StageMetrics
+from ._tracer import Tracer
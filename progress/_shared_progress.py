@@ -0,0 +1,148 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import numpy as np
+from threading import Lock
+from multiprocessing import shared_memory
+
+
+class SharedProgress:
+    """
+    共享内存进度块：每个任务一块固定布局的共享内存，保存计数器、时间和状态位，工作进程直接改写，主进程按需读取快照，
+    进度更新不再经过multiprocessing.Queue序列化整个字典。布局为[序号, 已设置字段掩码, 各字段]，
+    写入时序号先加1（奇数表示正在写入）、写完再加1，读取时序号为奇数或前后不一致则重读（seqlock）
+    不在布局中的键（如target、分区拼接数）保存在进程内字典中，由extras()取出后随队列发送
+    control_fields为主进程写入、工作进程只读的字段，位于各字段之后，有单独的掩码，不使用序号：进程内的锁不能在进程间互斥，
+    主进程与工作进程交错写入同一序号会丢失掩码位或使序号停留在奇数；每个字段只有一个写入进程，单个8字节的写入不会读到一半
+    """
+    int_fields = ('download_total', 'download_success', 'download_fail', 'stitch_total', 'stitched_tiles', 'crop_total', 'croped_blocks')
+    bool_fields = ('is_restart', 'is_task_complete', 'is_download_to_mem_complete', 'is_stitch_complete', 'is_cropping_complete',
+                   'is_update_sqlite_complete')
+    float_fields = ('st_time', 'ed_time', 'this_st_time')
+    # ee_request_limit为调度器下发给下载阶段的EE并发请求上限
+    control_fields = ('ee_request_limit',)
+    fields = int_fields + bool_fields + float_fields
+    slots = {key: i + 2 for i, key in enumerate(fields)}
+    control_mask = len(fields) + 2
+    control_slots = dict(zip(control_fields, range(control_mask + 1, control_mask + 1 + len(control_fields))))
+    length = control_mask + 1 + len(control_fields)
+    size = length * 8
+    max_retries = 1000
+
+    def __init__(self, name=None, extras=None):
+        is_create = name is None
+        # 子进程与主进程共用同一个resource_tracker，附加时的重复登记不影响主进程unlink时注销，无需在子进程中注销
+        self.shm = shared_memory.SharedMemory(name=name, create=is_create, size=self.size if is_create else 0)
+        self.ints = np.ndarray((self.length,), dtype=np.int64, buffer=self.shm.buf)
+        self.floats = np.ndarray((self.length,), dtype=np.float64, buffer=self.shm.buf)
+        if is_create:
+            self.ints[:] = 0
+        self.extra = dict(extras or {})
+        self.lock = Lock()
+
+    @classmethod
+    def create(cls, progress_info: dict):
+        shared = cls()
+        for key, value in progress_info.items():
+            shared[key] = value
+        return shared
+
+    def __getstate__(self):
+        return self.shm.name, self.extra
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+    def __getitem__(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            if key in self.control_slots:
+                return self.read_control(key)
+            return self.extra[key]
+        if not (int(self.ints[1]) >> slot) & 1:
+            raise KeyError(key)
+        return self.read_slot(key, slot)
+
+    def read_slot(self, key, slot):
+        if key in self.float_fields:
+            return float(self.floats[slot])
+        value = int(self.ints[slot])
+        return bool(value) if key in self.bool_fields else value
+
+    def read_control(self, key):
+        index = self.control_fields.index(key)
+        if not (int(self.ints[self.control_mask]) >> index) & 1:
+            raise KeyError(key)
+        return int(self.ints[self.control_slots[key]])
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        slot = self.slots.get(key)
+        if slot is None:
+            if key in self.control_slots:
+                self.write_control(key, value)
+            else:
+                self.extra[key] = value
+            return
+        with self.lock:
+            self.ints[0] += 1
+            if key in self.float_fields:
+                self.floats[slot] = value
+            else:
+                self.ints[slot] = value
+            self.ints[1] |= 1 << slot
+            self.ints[0] += 1
+
+    def write_control(self, key, value):
+        # 先写值再设置掩码位，读取方看到掩码位时值已写入
+        with self.lock:
+            self.ints[self.control_slots[key]] = value
+            self.ints[self.control_mask] |= 1 << self.control_fields.index(key)
+
+    def add(self, key, value):
+        # 计数器原子累加，由进程内锁保证多个线程的累加不丢失
+        slot = self.slots[key]
+        with self.lock:
+            self.ints[0] += 1
+            self.ints[slot] += value
+            self.ints[1] |= 1 << slot
+            self.ints[0] += 1
+
+    def snapshot(self):
+        # 读取一致的快照，只包含已设置的字段；写入进程在写入中途被终止时序号停留在奇数，重试有限次后直接读取
+        for _ in range(self.max_retries):
+            sequence = int(self.ints[0])
+            ints, floats = self.ints.copy(), self.floats.copy()
+            if sequence % 2 == 0 and int(self.ints[0]) == sequence:
+                break
+        mask = int(ints[1])
+        snapshot = {}
+        for key, slot in self.slots.items():
+            if (mask >> slot) & 1:
+                if key in self.float_fields:
+                    snapshot[key] = float(floats[slot])
+                else:
+                    snapshot[key] = bool(ints[slot]) if key in self.bool_fields else int(ints[slot])
+        for key in self.control_fields:
+            try:
+                snapshot[key] = self.read_control(key)
+            except KeyError:
+                pass
+        return snapshot
+
+    def extras(self):
+        return dict(self.extra)
+
+    def close(self):
+        self.ints = self.floats = None
+        self.shm.close()
+
+    def unlink(self):
+        self.close()
+        self.shm.unlink()
@@ -0,0 +1,48 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import bisect
+from threading import Lock
+
+
+class StageMetrics:
+    """
+    阶段指标：在工作进程内累计直方图、计数和瞬时值，snapshot()生成可序列化的字典，写入进度块的附加字段metrics，
+    随已有的进度队列按批次发送到主进程，不为单个瓦片增加进程间通信
+    计数与瞬时值按(名称, 标签)保存，标签为((键, 值), ...)；直方图的counts为各区间（不累计）的数量，最后一项为超出上限的数量
+    """
+    buckets = {
+        'tile_cost_seconds': (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60),
+        'sqlite_commit_seconds': (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5),
+    }
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self.gauges = {}
+        self.lock = Lock()
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                bounds = self.buckets[name]
+                histogram = self.histograms[name] = {'buckets': bounds, 'counts': [0] * (len(bounds) + 1), 'sum': 0.0, 'count': 0}
+            histogram['counts'][bisect.bisect_left(histogram['buckets'], value)] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    def add(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def snapshot(self):
+        with self.lock:
+            return {'histograms': {name: dict(histogram, counts=list(histogram['counts'])) for name, histogram in self.histograms.items()},
+                    'counters': dict(self.counters), 'gauges': dict(self.gauges)}
@@ -0,0 +1,35 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+
+class StitchCheckpoint:
+    """
+    拼接检查点：临时文件按瓦片行划分为条带，某个条带的瓦片全部写入并刷新到磁盘后，才在stitch_checkpoint表中记录该条带，
+    续传时跳过已记录的条带，未记录的条带整体重新拼接，不再逐瓦片维护stitch_status
+    """
+    @staticmethod
+    def create_table(cur):
+        cur.execute('create table if not exists stitch_checkpoint(tablename text, part_id int, z int, bands text, band_rows int, band_min_y int, '
+                    'tiles int)')
+        cur.execute('create index if not exists stitch_checkpoint_index on stitch_checkpoint (tablename, part_id, z, bands)')
+
+    @staticmethod
+    def reset(cur, table_name, part_id, z, bands):
+        cur.execute('delete from stitch_checkpoint where tablename = ? and part_id = ? and z = ? and bands is ?', (table_name, part_id, z, bands))
+
+    @staticmethod
+    def add_bands(cur, rows):
+        # rows: [(tablename, part_id, z, bands, band_rows, band_min_y, tiles)]
+        cur.executemany('insert into stitch_checkpoint (tablename, part_id, z, bands, band_rows, band_min_y, tiles) values (?, ?, ?, ?, ?, ?, ?)',
+                        rows)
+
+    @staticmethod
+    def completed_bands(cur, table_name, part_id, z, bands):
+        # 返回(条带行数, {已完成条带的起始瓦片行: 瓦片数})，条带划分以首次拼接时记录的行数为准
+        res = cur.execute('select band_rows, band_min_y, tiles from stitch_checkpoint where tablename = ? and part_id = ? and z = ? and bands is ?',
+                          (table_name, part_id, z, bands))
+        rows = res.fetchall()
+        if not rows:
+            return None, {}
+        return rows[0][0], {band_min_y: tiles for band_rows, band_min_y, tiles in rows}
@@ -0,0 +1,73 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+
+class TileProgress:
+    """
+    瓦片进度计数器：按(tablename, part_id, z, bands)在tile_progress表中保存total/success/fail/stitched，
+    计数由写入瓦片数据的同一事务增量更新，启动和续传时只读取计数表，无需对瓦片表count(*)
+    """
+    @staticmethod
+    def create_table(cur):
+        cur.execute('create table if not exists tile_progress(tablename text, part_id int, z int, bands text, width int, height int, total int, '
+                    'success int, fail int, stitched int, start_time float, end_time float)')
+        cur.execute('create index if not exists tile_progress_index on tile_progress (tablename, part_id, z, bands)')
+
+    @staticmethod
+    def init_total(cur, table_name):
+        # 仅在分区编号时执行一次，之后的计数全部为增量更新
+        cur.execute('delete from tile_progress where tablename = ?', (table_name,))
+        cur.execute(f'insert into tile_progress (tablename, part_id, z, bands, width, height, total, success, fail, stitched) '
+                    f'select ?, part_id, z, bands, max(width), max(height), count(1), 0, 0, 0 from "{table_name}" group by part_id, z, bands', (table_name,))
+
+    @staticmethod
+    def count_results(cur, table_name):
+        # 由结果表中已有的下载结果设置成功、失败计数，同一瓦片有成功记录时不计失败；用于旧版.nev升级
+        cur.execute(f'update tile_progress set success = r.success, fail = r.fail from (select part_id, z, bands, sum(ok) as success, '
+                    f'count(1) - sum(ok) as fail from (select part_id, z, bands, max(status = 1) as ok from "{table_name}_rs" where status in (1, -1) '
+                    f'group by part_id, z, bands, x, y) group by part_id, z, bands) as r '
+                    f'where tile_progress.tablename = ? and tile_progress.part_id = r.part_id and tile_progress.z = r.z and tile_progress.bands is r.bands',
+                    (table_name,))
+
+    @staticmethod
+    def add_download_results(cur, table_name, counters: dict):
+        # counters: {(part_id, z, bands): [success增量, fail增量]}
+        cur.executemany('update tile_progress set success = success + ?, fail = fail + ? where tablename = ? and part_id = ? and z = ? and bands is ?',
+                        [(success, fail, table_name, part_id, z, bands) for (part_id, z, bands), (success, fail) in counters.items()])
+
+    @staticmethod
+    def add_stitched(cur, table_name, counters: dict):
+        # counters: {(part_id, z, bands): stitched增量}
+        cur.executemany('update tile_progress set stitched = stitched + ? where tablename = ? and part_id = ? and z = ? and bands is ?',
+                        [(stitched, table_name, part_id, z, bands) for (part_id, z, bands), stitched in counters.items()])
+
+    @staticmethod
+    def reset_stitched(cur, table_name, part_id, z, bands):
+        cur.execute('update tile_progress set stitched = 0 where tablename = ? and part_id = ? and z = ? and bands is ?', (table_name, part_id, z, bands))
+
+    @staticmethod
+    def get_stitched(cur, table_name, part_id, z, bands):
+        res = cur.execute('select stitched from tile_progress where tablename = ? and part_id = ? and z = ? and bands is ?', (table_name, part_id, z, bands))
+        row = res.fetchone()
+        return row[0] if row is not None else 0
+
+    @staticmethod
+    def set_start_time(cur, table_name, start_time):
+        cur.execute('update tile_progress set start_time = ? where tablename = ? and start_time is null', (start_time, table_name))
+
+    @staticmethod
+    def set_end_time(cur, table_name, end_time):
+        cur.execute('update tile_progress set end_time = ? where tablename = ?', (end_time, table_name))
+
+    @staticmethod
+    def download_summary(cur):
+        res = cur.execute('select sum(total), sum(success), sum(fail), min(start_time), max(end_time) from tile_progress')
+        return res.fetchone()
+
+    @staticmethod
+    def stitch_tasks(cur):
+        # 拼接任务列表：(结果表名, part_id, z, width, height, bands, 待拼接瓦片数)
+        res = cur.execute("select tablename || '_rs', part_id, z, width, height, bands, success from tile_progress where success > 0 "
+                          "order by tablename, part_id, bands")
+        return res.fetchall()
@@ -0,0 +1,159 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import contextlib
+import json
+import os
+import random
+import threading
+import time
+from multiprocessing import util
+
+# 由主进程在启动工作进程前设置，工作进程及拼接进程池继承
+sample_rate_env = 'NEVASA_TRACE_SAMPLE_RATE'
+format_env = 'NEVASA_TRACE_FORMAT'
+null_span = contextlib.nullcontext()
+
+
+class Span:
+    def __init__(self, tracer, name, trace, args):
+        self.tracer = tracer
+        self.name = name
+        self.trace = trace
+        self.args = args
+        self.start = 0
+
+    def __enter__(self):
+        self.start = self.tracer.now()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        self.tracer.add_span(self.name, self.trace, self.start, **self.args)
+
+
+class Tracer:
+    """
+    热路径计时：按瓦片抽样记录各步骤的耗时区间（span），写入path目录下每个进程各自的文件，用于分析实际运行中时间花在哪里
+    sample()按sample_rate决定本瓦片是否记录，返回追踪编号，不记录时返回None；span(name, trace)在trace为None时返回空的上下文，
+    未启用（sample_rate为0）时每个瓦片只多一次属性比较，trace()用于条带、写文件等非逐瓦片的步骤，启用时总是记录
+    trace_format为chrome时写出Chrome trace（JSON数组，可由chrome://tracing或Perfetto打开，进程中断时缺少结尾的]仍可读取），
+    为otlp时每次写出一行OTLP/JSON（ExportTraceServiceRequest），可由OpenTelemetry Collector的文件接收器读取
+    时间取perf_counter_ns并按进程启动时的系统时间对齐，同一任务各进程的区间可合并查看
+    """
+    flush_size = 1000
+
+    def __init__(self, path, process_name, sample_rate=None, trace_format=None):
+        self.sample_rate = float(os.environ.get(sample_rate_env, 0) if sample_rate is None else sample_rate)
+        self.trace_format = (os.environ.get(format_env) or 'chrome') if trace_format is None else trace_format
+        self.process_name = process_name
+        self.pid = os.getpid()
+        self.offset = time.time_ns() - time.perf_counter_ns()
+        self.events = []
+        self.lock = threading.Lock()
+        self.file = None
+        self.path = None
+        self.finalizer = None
+        if self.sample_rate > 0:
+            os.makedirs(path, exist_ok=True)
+            suffix = 'json' if self.trace_format == 'chrome' else 'otlp.jsonl'
+            self.path = os.path.join(path, f'{process_name}_{self.pid}_{time.time_ns() // 1000000}.{suffix}')
+            # 拼接进程池等以os._exit退出的进程由multiprocessing的退出处理写出剩余区间
+            self.finalizer = util.Finalize(self, self.close, exitpriority=10)
+
+    @staticmethod
+    def configure(sample_rate, trace_format='chrome'):
+        # 在主进程创建工作进程前调用
+        os.environ[sample_rate_env] = str(sample_rate or 0)
+        os.environ[format_env] = trace_format
+
+    @property
+    def enabled(self):
+        return self.sample_rate > 0
+
+    def now(self):
+        return time.perf_counter_ns() + self.offset
+
+    def sample(self):
+        if self.sample_rate <= 0 or random.random() >= self.sample_rate:
+            return None
+        return '%032x' % random.getrandbits(128)
+
+    def trace(self):
+        if self.sample_rate <= 0:
+            return None
+        return '%032x' % random.getrandbits(128)
+
+    def span(self, name, trace, **args):
+        if trace is None:
+            return null_span
+        return Span(self, name, trace, args)
+
+    def add_span(self, name, trace, start, end=None, **args):
+        # start、end为now()的返回值（纳秒），用于跨线程的区间，如结果队列中的等待时间
+        if trace is None:
+            return
+        event = (name, trace, start, self.now() if end is None else end, threading.get_ident(), args)
+        with self.lock:
+            self.events.append(event)
+        if len(self.events) >= self.flush_size:
+            self.flush()
+
+    def chrome_lines(self, events):
+        for name, trace, start, end, thread_id, args in events:
+            yield json.dumps({'name': name, 'cat': self.process_name, 'ph': 'X', 'ts': start / 1000, 'dur': (end - start) / 1000, 'pid': self.pid,
+                              'tid': thread_id, 'args': dict(args, trace=trace)}, default=str) + ',\n'
+
+    @staticmethod
+    def otlp_value(value):
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def otlp_line(self, events):
+        spans = [{'traceId': trace, 'spanId': '%016x' % random.getrandbits(64), 'name': name, 'kind': 1, 'startTimeUnixNano': str(start),
+                  'endTimeUnixNano': str(end), 'attributes': [{'key': key, 'value': self.otlp_value(value)} for key, value in
+                                                              dict(args, **{'thread.id': thread_id}).items()]}
+                 for name, trace, start, end, thread_id, args in events]
+        resource = {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'nevasa'}},
+                                   {'key': 'process.pid', 'value': {'intValue': str(self.pid)}},
+                                   {'key': 'nevasa.process', 'value': {'stringValue': self.process_name}}]}
+        return json.dumps({'resourceSpans': [{'resource': resource, 'scopeSpans': [{'scope': {'name': 'nevasa'}, 'spans': spans}]}]}) + '\n'
+
+    def process_metadata(self):
+        return json.dumps({'name': 'process_name', 'ph': 'M', 'pid': self.pid, 'args': {'name': self.process_name}})
+
+    def flush(self):
+        with self.lock:
+            events, self.events = self.events, []
+            if self.path is None or (not events and self.file is not None):
+                return
+            if self.file is None:
+                self.file = open(self.path, 'w', encoding='utf-8')
+                if self.trace_format == 'chrome':
+                    self.file.write('[\n' + self.process_metadata() + ',\n')
+            if events:
+                if self.trace_format == 'chrome':
+                    self.file.writelines(self.chrome_lines(events))
+                else:
+                    self.file.write(self.otlp_line(events))
+            self.file.flush()
+
+    def close(self):
+        if self.path is None:
+            return
+        self.flush()
+        with self.lock:
+            if self.file is not None:
+                if self.trace_format == 'chrome':
+                    self.file.write(self.process_metadata() + ']\n')
+                self.file.close()
+                self.file = None
+            self.path = None
+        self.finalizer.cancel()
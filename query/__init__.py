@@ -0,0 +1,6 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+from ._tile_query import TileQuery
+from ._legacy_tables import LegacyTables
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import re
+from progress import TileProgress
+
+
+class LegacyTables:
+    """
+    旧版.nev升级：旧版按分区拆表（tiles_<z>_part_<n>及其_rs），结果表没有part_id列，也没有tile_progress计数表。
+    upgrade()将分区表合并为tiles_<z>并以part_id记录分区号后删除，为结果表补上part_id列，并按已有的下载结果初始化进度计数，
+    只在该层级的分区索引尚未创建时执行一次，下载和拼接阶段启动时均会调用，升级前进行中的任务可以继续下载或拼接
+    """
+    part_pattern = re.compile(r'(tiles_\d+)_part_(\d+)(_rs)?')
+    table_pattern = re.compile(r'tiles_\d+')
+
+    @staticmethod
+    def table_names(cur):
+        return [row[0] for row in cur.execute("select name from sqlite_master where type='table' and name like 'tiles_%'").fetchall()]
+
+    @staticmethod
+    def columns(cur, table_name):
+        return [column[1] for column in cur.execute(f'pragma table_info("{table_name}")').fetchall()]
+
+    @classmethod
+    def merge_parts(cls, cur):
+        # 分区表按层级合并，tiles_<z>_part_<n>的瓦片写入tiles_<z>，part_id取n；返回合并后的层级表名
+        merged = set()
+        for table_name in cls.table_names(cur):
+            match = cls.part_pattern.fullmatch(table_name)
+            if match is None:
+                continue
+            base_name, part_id, suffix = match.group(1), int(match.group(2)), match.group(3) or ''
+            target = base_name + suffix
+            columns = [column for column in cls.columns(cur, table_name) if column != 'part_id']
+            column_list = ', '.join(f'"{column}"' for column in columns)
+            cur.execute(f'create table if not exists "{target}" as select {column_list}, 0 as part_id from "{table_name}" where 1=2')
+            cur.execute(f'insert into "{target}" ({column_list}, part_id) select {column_list}, ? from "{table_name}"', (part_id,))
+            cur.execute(f'drop table "{table_name}"')
+            merged.add(base_name)
+        return merged
+
+    @classmethod
+    def upgrade(cls, cur):
+        # 返回升级的层级表名，调用方负责提交
+        upgraded = []
+        cls.merge_parts(cur)
+        table_names = set(cls.table_names(cur))
+        for table_name in sorted(table_names):
+            # 新建的层级表在分区编号时才创建结果表，已有结果表但没有分区索引的即为旧版表
+            if cls.table_pattern.fullmatch(table_name) is None or f'{table_name}_rs' not in table_names:
+                continue
+            index_res = cur.execute("select count(1) from sqlite_master where type='index' and name = ?", (f'{table_name}_part_index',))
+            if index_res.fetchone()[0] != 0:
+                continue
+            for name in (table_name, f'{table_name}_rs'):
+                if 'part_id' not in cls.columns(cur, name):
+                    # 旧版未拆分的表只有一个分区
+                    cur.execute(f'alter table "{name}" add column part_id integer not null default 0')
+            # 重试成功的瓦片删去此前的失败记录，续传时不再作为失败瓦片重新下载
+            cur.execute(f'delete from "{table_name}_rs" as f where status = -1 and exists (select 1 from "{table_name}_rs" as s where s.status = 1 '
+                        f'and s.x = f.x and s.y = f.y and s.z = f.z and s.bands is f.bands)')
+            TileProgress.create_table(cur)
+            TileProgress.init_total(cur, table_name)
+            TileProgress.count_results(cur, table_name)
+            cur.execute(f'create index if not exists "{table_name}_part_index" on "{table_name}" (part_id, x, y)')
+            cur.execute(f'create index if not exists "{table_name}_rs_part_index" on "{table_name}_rs" (part_id, x, y, z)')
+            upgraded.append(table_name)
+        return upgraded
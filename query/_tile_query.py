@@ -0,0 +1,54 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import re
+from functools import lru_cache
+
+
+class TileQuery:
+    """
+    瓦片表查询层：每类语句只保留一个带占位符的模板，取值全部通过参数绑定，表名只允许tiles_<z>和tiles_<z>_rs，
+    同一表的同类语句文本始终相同，可命中sqlite3连接的语句缓存，不再每次重新解析和生成执行计划
+    """
+    # sqlite3按连接缓存预编译语句，默认128条，按层级/结果表展开后的语句数量可能超出
+    cached_statements = 512
+    # 拼接时每次fetchmany读取的瓦片数
+    fetch_size = 128
+    table_pattern = re.compile(r'tiles_\d+(_rs)?')
+    statements = {
+        'tile_size': 'select width, height from {table} limit 1',
+        # 以exists按瓦片逐个比较，bands为NULL时(x, y, z, bands) in (...)恒不成立；已有成功记录的瓦片不再下载
+        'download_parameter': 'select x, y, z, bands, geometry, width, height, part_id, '
+                              'exists (select 1 from {rs_table} as r where r.part_id = t.part_id and r.x = t.x and r.y = t.y and r.z = t.z '
+                              'and r.bands is t.bands and r.status = -1) as is_retry from {table} as t '
+                              'where not exists (select 1 from {rs_table} as r where r.part_id = t.part_id and r.x = t.x and r.y = t.y and r.z = t.z '
+                              'and r.bands is t.bands and r.status = 1) order by part_id',
+        'insert_result': 'insert into {table} (x, y, z, image, dtype, shape, bands, status, width, height, error, cost, part_id) '
+                         'values (:x, :y, :z, :image, :dtype, :shape, :bands, :status, :width, :height, :error, :cost, :part_id)',
+        # 重试成功时与成功记录在同一事务中删除此前的失败记录，暂停后续传不会再次作为重试瓦片计数
+        'delete_failed': 'delete from {table} where part_id = :part_id and x = :x and y = :y and z = :z and bands is :bands and status = -1',
+        'tile_bounds': 'select max(x), max(y), min(x), min(y) from {table} where z = ? and part_id = ?',
+        'stitch_tiles': 'select image, x, y, z, shape, dtype from {table} where z = ? and part_id = ? and status = 1 and bands is ? '
+                        'and y between ? and ? order by y, x',
+        'export_tiles': 'select image, x, y, z, shape, dtype from {table} where z = ? and status = 1 and bands is ? order by y, x',
+    }
+
+    @classmethod
+    def table(cls, table_name):
+        if not isinstance(table_name, str) or cls.table_pattern.fullmatch(table_name) is None:
+            raise ValueError(f'Invalid tile table name: {table_name!r}')
+        return f'"{table_name}"'
+
+    @classmethod
+    @lru_cache(maxsize=None)
+    def sql(cls, name, table_name):
+        return cls.statements[name].format(table=cls.table(table_name), rs_table=cls.table(f'{table_name}_rs') if not table_name.endswith('_rs') else None)
+
+    @classmethod
+    def execute(cls, cur, name, table_name, parameters=()):
+        return cur.execute(cls.sql(name, table_name), parameters)
+
+    @classmethod
+    def executemany(cls, cur, name, table_name, seq_of_parameters):
+        return cur.executemany(cls.sql(name, table_name), seq_of_parameters)
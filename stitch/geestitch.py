@@ -13,28 +13,42 @@ import zipfile
 import cv2
 import os
 import rasterio
+import rasterio.shutil
+import rasterio.windows
 import numpy as np
 import geopandas as gpd
 import concurrent.futures
 import pycuda.driver as cudadrv
 import pycuda.gpuarray as gpuarray
+import shapely
+try:
+    import numba
+    # 裁剪内核在线程池中调用，TBB线程层从非主线程启动后会导致进程退出时挂起，优先使用OpenMP
+    numba.config.THREADING_LAYER_PRIORITY = ['omp', 'workqueue', 'tbb']
+except ImportError:
+    numba = None
 from dbutils.pooled_db import PooledDB
 from shapely.wkt import loads
 from threading import Lock
 from multiprocessing import Event, Queue
 from shapely import Polygon, MultiPolygon
+from rasterio.enums import Resampling
 from rasterio.features import geometry_mask
+from progress import TileProgress, StitchCheckpoint, SharedProgress, StageMetrics, Tracer
+from query import TileQuery, LegacyTables
 
 
 class GeeImageStitch:
     def __init__(self, taskname: str, path: str, sqlitename: str, ee_object: str, polygon: str, scale: int, region: str, start_date: str, end_date: str,   # NOQA
-                 datainfo_url: str, is_export_shp: bool, progress_info: dict, process_done, signal, queue, enable_gpu: bool, kernel_func):
+                 datainfo_url: str, is_export_shp: bool, progress_info: dict, process_done, signal, queue, enable_gpu: bool, kernel_func,
+                 stream_to_geotiff: bool = False, pyramid_levels: int = 0):
         self.exception = None
         self.signal = signal
         self.is_stitch_complete = False
         self.polygon = loads(polygon)
         self.ee_object = ee_object
         self.update_stitch_info = q.Queue()
+        self.stitch_info_batch_size = 5000
         self.task_list = []
         self.is_export_shp = is_export_shp
         self.taskname = taskname
@@ -47,7 +61,6 @@ class GeeImageStitch:
         self.thread_lock = Lock()
         self.database_conn_pool()
         self.progress_info = progress_info
-        self.stitch_info()
         self.savefile = os.path.join(self.tifsavepath, 'GeoTif')
         self.scale = scale
         self.region = region
@@ -55,17 +68,36 @@ class GeeImageStitch:
         self.end_date = end_date
         self.data_info_url = datainfo_url
         self.is_empty_image = False
+        # 分类数据（土地覆盖、水体）生成金字塔时不能插值
+        self.is_categorical = ee_object in ('Dynamic World', 'JRC Monthly Water History')
         self.get_channels_dtype()
         if enable_gpu and kernel_func is not None:
             self.enable_gpu = self.check_cuda()
         else:
             self.enable_gpu = False
         self.crop_threading_lock = threading.Lock()
+        self.stream_to_geotiff = stream_to_geotiff
+        # 额外输出的低层级数，由拼接结果降采样生成
+        self.pyramid_levels = pyramid_levels
+        self.stitch_workers = os.cpu_count() or 1
+        self.stitch_pool = None
+        self.crop_workers = os.cpu_count() or 1
+        self.crop_commit_blocks = 64
+        self.queue_lock = Lock()
+        self.last_queued = None
+        self.metrics = StageMetrics()
+        self.trace_path = os.path.join(path, 'trace')
+        self.tracer = Tracer(self.trace_path, f'{taskname}_stitch')
         os.environ['PROJ_LIB'] = os.path.join(os.getcwd(), 'rasterio', 'proj_data')
 
     def write_to_queue(self):
-        data = (self.progress_info, self.process_done, self.taskname)
-        self.queue.put(data)
+        # 计数和状态位已写入共享内存，队列只发送进程状态和非计数信息，且仅在内容变化时发送
+        with self.queue_lock:
+            self.progress_info['metrics'] = self.metrics.snapshot()
+            data = (self.progress_info.extras(), dict(self.process_done), self.taskname)
+            if data != self.last_queued:
+                self.last_queued = data
+                self.queue.put(data)
 
     def check_cuda(self):
         try:
@@ -83,7 +115,8 @@ class GeeImageStitch:
             creator=sqlite3,  # 使用sqlite3作为数据库连接
             maxconnections=30,  # 最多5个连接
             database=self.tilepath,
-            check_same_thread=False
+            check_same_thread=False,
+            cached_statements=TileQuery.cached_statements
         )
         self.database_session = engine
         return self.database_session
@@ -110,37 +143,21 @@ class GeeImageStitch:
         for ext in ['.shp', '.shx', '.dbf', '.prj', '.cpg']:
             os.remove(f"{shp_file}{ext}")
 
-    def stitch_info(self):
-        conn = self.database_session.connection()
-        cur = conn.cursor()
-        cur.execute('create table if not exists stitch_info (tablename text primary key, total int, success int, fail int, start_time float, end_time float)')
-        try:
-            cur.execute(
-                "insert into stitch_info SELECT replace(name,'_rs',''),0,0,0,null,null FROM sqlite_master WHERE type='table' and (name like 'tiles_%_rs' or name like 'tiles_%_part_%_rs')")
-            conn.commit()
-        except:
-            pass
-        res = cur.execute("SELECT name FROM sqlite_master WHERE type='table' and (name like 'tiles_%' or name like 'tiles_%_part_%') and name not like '%rs%'")
-        for table in res.fetchall():
-            cur.execute(f'update stitch_info set total = (select count(1) from {table[0]}) where tablename = "{table[0]}"')
-        conn.commit()
-        conn.close()
-
     def task_create(self):
         conn = self.database_session.connection()
         cur = conn.cursor()
         cur.execute("PRAGMA journal_mode=WAL;")
         try:
-            res = cur.execute("SELECT replace(name,'tiles_','') FROM sqlite_master WHERE type='table' and "
-                              "(name like 'tiles_%_rs' or name like 'tiles_%_part_%_rs')")
-            table_list = res.fetchall()
-            for table in table_list:
-                res = cur.execute(f'select distinct \'tiles_{table[0]}\',z,width,height,bands,count(*) from "tiles_{table[0]}" group by z,height,width,bands')
-                task = res.fetchall()
-                self.task_list.extend(task)
+            # 升级前已完成下载的.nev直接进入拼接时，同样先合并分区表并初始化进度计数
+            LegacyTables.upgrade(cur)
+            conn.commit()
+            # 拼接任务及待拼接瓦片数直接取自下载阶段维护的进度计数，无需扫描结果表
+            self.task_list.extend(TileProgress.stitch_tasks(cur))
+            StitchCheckpoint.create_table(cur)
+            conn.commit()
             stitch_total = 0
             for task in self.task_list:
-                table_name, zoom, tile_size_width, tile_size_height, bands, count = task
+                table_name, part_id, zoom, tile_size_width, tile_size_height, bands, count = task
                 stitch_total = stitch_total + count
             self.progress_info['stitch_total'] = stitch_total
             self.write_to_queue()
@@ -227,8 +244,7 @@ class GeeImageStitch:
                 self.progress_info['is_restart'] = True
                 self.write_to_queue()
             else:
-                with self.crop_threading_lock:
-                    self.progress_info['croped_blocks'] = self.progress_info['croped_blocks'] + croped_block
+                self.progress_info.add('croped_blocks', croped_block)
         conn = self.database_session.connection()
         cur = conn.cursor()
         cur.execute('create table if not exists crop_info(tablename text, bands text, x int, y int, x_end int, y_end int, cropped int,'
@@ -290,8 +306,7 @@ class GeeImageStitch:
                 self.write_to_queue()
                 self.create_crop_info(table_name, bands, map_image, map_height, map_width, block_size)
             else:
-                with self.crop_threading_lock:
-                    self.progress_info['croped_blocks'] = self.progress_info['croped_blocks'] + croped_block
+                self.progress_info.add('croped_blocks', croped_block)
         return block_list, ymin, ymax, xmin, xmax
 
     def apply_mask_and_crop_gpu(self, table_name, bands, map_image, transform_parameters, block_size):
@@ -305,6 +320,51 @@ class GeeImageStitch:
         cropped_image, top_left_geo, bottom_right_geo = image_crop.worker()
         return cropped_image, top_left_geo, bottom_right_geo
 
+    def classify_blocks(self, block_list, west, north, pixel_width, pixel_height):
+        # 返回每个块的(是否与多边形相交, 是否被多边形完全包含, 块的地理范围多边形)
+        if not block_list:
+            return []
+        shapely.prepare(self.polygon)
+        blocks = np.array([block[2:] for block in block_list], dtype=np.float64)
+        block_polygons = shapely.box(west + blocks[:, 0] * pixel_width, north - blocks[:, 3] * pixel_height, west + blocks[:, 2] * pixel_width,
+                                     north - blocks[:, 1] * pixel_height)
+        is_intersects = shapely.intersects(self.polygon, block_polygons)
+        is_contains = shapely.contains(self.polygon, block_polygons)
+        return list(zip(is_intersects.tolist(), is_contains.tolist(), block_polygons))
+
+    def apply_mask_and_crop_numba(self, table_name, bands, map_image, transform_parameters, block_size):
+        block_list, ymin, ymax, xmin, xmax = self.prepare_crop_param(table_name, bands, map_image, map_height=transform_parameters[5],
+                                                                     map_width=transform_parameters[4], block_size=block_size)
+        image_crop = NumbaImageCrop(block_list, self.database_session, self.crop_threading_lock, self.progress_info, self.write_to_queue, block_size,
+                                    map_image, transform_parameters, self.polygon, self.signal, (ymin, ymax, xmin, xmax), self.crop_commit_blocks,
+                                    self.tracer)
+        cropped_image, top_left_geo, bottom_right_geo = image_crop.worker()
+        if cropped_image is not None and top_left_geo == bottom_right_geo:
+            self.is_empty_image = True
+        return cropped_image, top_left_geo, bottom_right_geo
+
+    def mask_block(self, map_image, block, status):
+        # 对单个块应用掩膜，返回块内有效像素在整幅图像中的范围(ymin, ymax, xmin, xmax)，无有效像素时返回None
+        table_name, bands, x, y, x_end, y_end = block
+        with self.tracer.span('mask', self.tracer.sample(), x=x, y=y, intersects=bool(status[0]), contains=bool(status[1])):
+            is_intersects, is_contains, block_polygon = status
+            block_image = map_image[y:y_end, x:x_end]
+            if not is_intersects:
+                block_image[:] = 0
+                return None
+            if is_contains:
+                return y, y_end - 1, x, x_end - 1
+            block_transform = rasterio.transform.from_bounds(*block_polygon.bounds, x_end - x, y_end - y)
+            # 只用裁剪到当前块范围内的多边形生成掩膜
+            block_mask = geometry_mask([self.polygon.intersection(block_polygon)], out_shape=(y_end - y, x_end - x), transform=block_transform, invert=True)
+            np.copyto(block_image, 0, where=~block_mask[:, :, np.newaxis])
+            # 行、列方向any()归约得到掩膜范围，代替np.where
+            rows = block_mask.any(axis=1)
+            cols = block_mask.any(axis=0)
+            if not rows.any():
+                return None
+            return (y + np.argmax(rows), y + len(rows) - 1 - np.argmax(rows[::-1]), x + np.argmax(cols), x + len(cols) - 1 - np.argmax(cols[::-1]))
+
     def apply_mask_and_crop_cpu(self, table_name, bands, map_image, transform_parameters, block_size):
         conn = self.database_session.connection()
         cur = conn.cursor()
@@ -316,42 +376,33 @@ class GeeImageStitch:
         pixel_height = (north - south) / map_height  # 每个像素的纬度
         # Apply mask in blocks and find the bounding box of the mask
         block_list, ymin, ymax, xmin, xmax = self.prepare_crop_param(table_name, bands, map_image, map_height, map_width, block_size)
-        for table_name, bands, x, y, x_end, y_end in block_list:
-            if self.signal.is_set():
-                return None, None, None
-            else:
-                block_west = west + x * pixel_width
-                block_south = north - y_end * pixel_height
-                block_east = west + x_end * pixel_width
-                block_north = north - y * pixel_height
-                block_width = x_end - x
-                block_height = y_end - y
-                block_transform = rasterio.transform.from_bounds(block_west, block_south, block_east, block_north, block_width, block_height)
-                # Generate the mask for the current block
-                block_mask = geometry_mask([self.polygon], out_shape=(y_end - y, x_end - x), transform=block_transform, invert=True)
-                # Apply the block mask directly to the map_image (without storing the full mask)
-                map_image[y:y_end, x:x_end][~block_mask] = 0
-                # Update boundaries if there are any masked areas in the current block
-                if np.any(block_mask):
-                    y_coords, x_coords = np.where(block_mask)
-                    ymin = min(ymin, y + y_coords.min())
-                    ymax = max(ymax, y + y_coords.max())
-                    xmin = min(xmin, x + x_coords.min())
-                    xmax = max(xmax, x + x_coords.max())
-                with self.crop_threading_lock:
-                    self.progress_info['croped_blocks'] = self.progress_info['croped_blocks'] + 1
-                if bands is not None:
-                    cur.execute('UPDATE crop_info SET cropped = 1 WHERE tablename = ? AND bands = ? AND x = ? AND y = ? AND x_end = ? AND y_end = ?',
-                                (table_name, bands, x, y, x_end, y_end))
-                    cur.execute('update crop_bounds_info set ymin = ?, ymax = ?, xmin = ?, xmax = ? where tablename = ? and bands = ?',
-                                (int(ymin) if ymin != float('inf') else None, int(ymax), int(xmin) if xmin != float('inf') else None, int(xmax), table_name,
-                                 bands))
-                else:
-                    cur.execute('UPDATE crop_info SET cropped = 1 WHERE tablename = ? AND bands is null AND x = ? AND y = ? AND x_end = ? AND y_end = ?',
-                                (table_name, x, y, x_end, y_end))
-                    cur.execute('update crop_bounds_info set ymin = ?, ymax = ?, xmin = ?, xmax = ? where tablename = ? and bands is null',
-                                (int(ymin) if ymin != float('inf') else None, int(ymax), int(xmin) if xmin != float('inf') else None, int(xmax), table_name))
-                conn.commit()
+        # 预先对所有块做一次向量化分类：完全在多边形外的块直接置0，完全在内的块无需掩膜，只有与边界相交的块才栅格化
+        block_status = self.classify_blocks(block_list, west, north, pixel_width, pixel_height)
+        blocks = list(zip(block_list, block_status))
+        # 块掩膜（GDAL栅格化与NumPy赋值均释放GIL）由线程池并行执行，每个块返回自己的局部范围，由当前线程归约，无需加锁
+        # 每crop_commit_blocks个块在一个事务中批量写入crop_info
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.crop_workers) as executor:
+            for i in range(0, len(blocks), self.crop_commit_blocks):
+                if self.signal.is_set():
+                    conn.close()
+                    return None, None, None
+                chunk = blocks[i:i + self.crop_commit_blocks]
+                for block_bounds in executor.map(lambda block: self.mask_block(map_image, *block), chunk):
+                    if block_bounds is not None:
+                        block_ymin, block_ymax, block_xmin, block_xmax = block_bounds
+                        ymin, ymax, xmin, xmax = min(ymin, block_ymin), max(ymax, block_ymax), min(xmin, block_xmin), max(xmax, block_xmax)
+                # 掩膜结果先落盘，再提交该批块的裁剪记录，续传时跳过的块均已写入临时文件
+                trace = self.tracer.trace()
+                with self.tracer.span('memmap_flush', trace):
+                    map_image.flush()
+                cur.executemany('UPDATE crop_info SET cropped = 1 WHERE tablename = ? AND bands is ? AND x = ? AND y = ? AND x_end = ? AND y_end = ?',
+                                [block for block, status in chunk])
+                cur.execute('update crop_bounds_info set ymin = ?, ymax = ?, xmin = ?, xmax = ? where tablename = ? and bands is ?',
+                            (int(ymin) if ymin != float('inf') else None, int(ymax), int(xmin) if xmin != float('inf') else None, int(xmax), table_name,
+                             bands))
+                with self.tracer.span('sqlite_commit', trace, blocks=len(chunk)):
+                    conn.commit()
+                self.progress_info.add('croped_blocks', len(chunk))
                 self.write_to_queue()
         # Ensure valid boundaries
         if ymin == float('inf'):
@@ -360,69 +411,50 @@ class GeeImageStitch:
         if ymin < ymax and xmin < xmax:
             cropped_image = map_image[ymin:ymax, xmin:xmax]
         else:
-            cropped_image = np.zeros((512, 512, 3), dtype=map_image.dtype)
+            cropped_image = np.zeros((512, 512, map_image.shape[2]), dtype=map_image.dtype)
             self.is_empty_image = True
         # Calculate the geographic coordinates of the top-left and bottom-right corners
         top_left_geo = (ymin * transform.e + transform.f, xmin * transform.a + transform.c)
         bottom_right_geo = (ymax * transform.e + transform.f, xmax * transform.a + transform.c)
         conn.close()
-        print(ymin, ymax, xmin, xmax)
         return cropped_image, top_left_geo, bottom_right_geo
 
+    def get_output_name(self, part_id, bands):
+        # 分区编号为0表示该层级未分区，输出文件名不带分区后缀
+        part_suffix = '' if part_id == 0 else f'_{part_id}'
+        bands_suffix = '' if bands is None else f'_{bands}'
+        return part_suffix + bands_suffix
+
     def tiles_stitch(self, task: tuple, block_size=2048):
-        table_name, zoom, tile_size_width, tile_size_height, bands, count = task
+        table_name, part_id, zoom, tile_size_width, tile_size_height, bands, count = task
         ee_object = self.ee_object.replace(' ', '')
-        if 'part' in table_name and bands is not None:
-            temp_file = os.path.join(self.savefile, f'temp_{table_name.replace(f'tiles_{zoom}_part_', '').replace('_rs', '')}_{bands}')
-            geo_file = os.path.join(self.savefile,
-                                    f'{self.taskname}_{ee_object}_{table_name.replace(f'tiles_{zoom}_part_', '').replace('_rs', '')}_{bands}.tif')
-        elif 'part' in table_name and bands is None:
-            temp_file = os.path.join(self.savefile, f'temp_{table_name.replace(f'tiles_{zoom}_part_', '').replace('_rs', '')}')
-            geo_file = os.path.join(self.savefile, f'{self.taskname}_{ee_object}_{table_name.replace(f'tiles_{zoom}_part_', '').replace('_rs', '')}.tif')
-        elif 'part' not in table_name and bands is not None:
-            temp_file = os.path.join(self.savefile, f'temp_{bands}')
-            geo_file = os.path.join(self.savefile, f'{self.taskname}_{ee_object}_{bands}.tif')
-        else:
-            temp_file = os.path.join(self.savefile, f'temp')
-            geo_file = os.path.join(self.savefile, f'{self.taskname}_{ee_object}.tif')
+        part_name = f'{table_name}_part_{part_id}'
+        output_name = self.get_output_name(part_id, bands)
+        temp_file = os.path.join(self.savefile, f'temp{output_name}')
+        geo_file = os.path.join(self.savefile, f'{self.taskname}_{ee_object}{output_name}.tif')
         conn = self.database_session.connection()
         cur = conn.cursor()
         try:
-            res = cur.execute(f'select max(x),max(y),min(x),min(y) from (SELECT x,y FROM "{table_name}" where z = {zoom})')
+            res = TileQuery.execute(cur, 'tile_bounds', table_name, (zoom, part_id))
             max_x, max_y, min_x, min_y = res.fetchone()
             if os.path.exists(temp_file) and os.path.getsize(temp_file) != 0:
                 mode = 'r+'
                 self.stitch_mode = True
-                stitched_res = cur.execute(f'select success from stitch_info where tablename = "{table_name.replace('_rs', '')}"')
-                stitched = stitched_res.fetchone()[0]
-                if bands is None:
-                    res = cur.execute(
-                        f'SELECT image,x,y,z,shape,dtype FROM "{table_name}" WHERE z = ? AND status = 1 and stitch_status is null AND bands IS NULL',
-                        (zoom,)
-                    )
-                else:
-                    res = cur.execute(
-                        f'SELECT image,x,y,z,shape,dtype FROM "{table_name}" WHERE z = ? AND status = 1 and stitch_status is null AND bands = ?',
-                        (zoom, bands)
-                    )
+                stitched = TileProgress.get_stitched(cur, table_name.replace('_rs', ''), part_id, zoom, bands)
+                band_rows, completed_bands = StitchCheckpoint.completed_bands(cur, table_name, part_id, zoom, bands)
                 with self.thread_lock:
                     self.progress_info['stitched_tiles'] = stitched
-                    self.progress_info[f'{table_name}_stitched_tiles'] = stitched
+                    self.progress_info[f'{part_name}_stitched_tiles'] = stitched
                     self.write_to_queue()
             else:
                 mode = 'w+'
                 self.stitch_mode = False
-                if bands is None:
-                    res = cur.execute(
-                        f'SELECT image,x,y,z,shape,dtype FROM "{table_name}" WHERE z = ? AND status = 1 AND bands IS NULL',
-                        (zoom,)
-                    )
-                else:
-                    res = cur.execute(
-                        f'SELECT image,x,y,z,shape,dtype FROM "{table_name}" WHERE z = ? AND status = 1 AND bands = ?',
-                        (zoom, bands)
-                    )
+                # 重新拼接时清空该分区的检查点和计数
+                StitchCheckpoint.reset(cur, table_name, part_id, zoom, bands)
+                TileProgress.reset_stitched(cur, table_name.replace('_rs', ''), part_id, zoom, bands)
+                conn.commit()
                 stitched = 0
+                band_rows, completed_bands = None, {}
             # 假设有 num_tiles 个瓦片，根据实际情况修改
             num_tiles_x = max_x - min_x + 1
             num_tiles_y = max_y - min_y + 1
@@ -434,32 +466,32 @@ class GeeImageStitch:
             except:
                 pass
             map_image = np.memmap(filename=temp_file, dtype=self.dtype, mode=mode, shape=(map_height, map_width, self.channels))
-            # 从数据库遍历读取的每个瓦片的数据和位置信息，并将其放置到空白图像上
-            while True:
-                row = res.fetchone()
-                if not row or self.signal.is_set():  # 监听来自主进程的终止信号，如果有终止信号，安全关闭拼接线程组， 如果拼接完成，结束拼接循环，开始写入磁盘
-                    break
-                tile_data, x_position, y_position, z, shape, dtype = row
-                image_shape = tuple(map(int, shape.strip('()').split(',')))
-                image_dtype = np.dtype(dtype)  # 将 dtype 字符串转换回 np.dtype
-                tile_image = np.frombuffer(tile_data, dtype=image_dtype).reshape(image_shape)
-                if self.ee_object == 'Dynamic World':
-                    tile_image = np.flipud(tile_image)
-                # 将瓦片放置到空白图像的对应位置
-                start_x = (x_position - min_x) * tile_size_width
-                start_y = (y_position - min_y) * tile_size_height
-                # 确保放置位置在图像范围内
-                tile_width = min(tile_image.shape[1], map_width - start_x)
-                tile_height = min(tile_image.shape[0], map_height - start_y)
-                map_image[start_y:start_y + tile_height, start_x:start_x + tile_width] = tile_image[:tile_height, :tile_width]
-                stitched += 1
+            # 新建的临时文件先落盘，拼接进程再以r+模式映射同一文件
+            map_image.flush()
+            # 按瓦片行号把输出图像划分为互不重叠的水平条带，由进程池各自读库并写入自己的条带，续传时沿用首次拼接的条带划分
+            if band_rows is None:
+                band_rows = max(1, math.ceil(num_tiles_y / (self.stitch_workers * 4)))
+            band_futures = {}
+            for band_min_y in range(min_y, max_y + 1, band_rows):
+                if band_min_y in completed_bands:
+                    continue
+                band_parameter = (self.tilepath, table_name, zoom, part_id, bands, band_min_y, min(band_min_y + band_rows - 1, max_y), min_x, min_y,
+                                  tile_size_width, tile_size_height, temp_file, self.dtype.str, (map_height, map_width, self.channels),
+                                  self.ee_object == 'Dynamic World')
+                band_futures[self.stitch_pool.submit(stitch_row_band, band_parameter)] = band_min_y
+            for future in concurrent.futures.as_completed(band_futures):
+                placed_tiles = future.result()
+                # 条带被中断时不记录检查点，续传时整体重新拼接
+                if placed_tiles is None:
+                    continue
+                stitched += placed_tiles
+                self.metrics.add('memmap_bytes_written', placed_tiles * tile_size_width * tile_size_height * self.channels * self.dtype.itemsize)
                 with self.thread_lock:
-                    self.progress_info['stitched_tiles'] = self.progress_info['stitched_tiles'] + 1
-                    self.progress_info[f'{table_name}_stitched_tiles'] = stitched
+                    self.progress_info.add('stitched_tiles', placed_tiles)
+                    self.progress_info[f'{part_name}_stitched_tiles'] = stitched
                     self.write_to_queue()
-                self.update_stitch_info.put((x_position, y_position, z, table_name))
-                if stitched % 200 == 0:
-                    map_image.flush()
+                # 条带已由拼接进程刷新到磁盘，之后再提交检查点
+                self.update_stitch_info.put((table_name, part_id, zoom, bands, band_rows, band_futures[future], placed_tiles))
             if not self.signal.is_set():
                 # 将 WKT 字符串转换为掩膜
                 north, west = self.tile_to_latlon_top_left(min_x, min_y, zoom)
@@ -467,28 +499,43 @@ class GeeImageStitch:
                 # 生成变换矩阵
                 transform_parameters = (west, south, east, north, map_width, map_height)
                 # 应用掩膜并裁剪图像
-                if not self.enable_gpu:
-                    cropped_image, top_left_geo, bottom_right_geo = self.apply_mask_and_crop_cpu(table_name, bands, map_image, transform_parameters, block_size)
+                crop_device = 'GPU' if self.enable_gpu else ('Numba' if numba is not None else 'CPU')
+                with self.tracer.span('crop', self.tracer.trace(), part=part_name, bands=bands, device=crop_device):
+                    if not self.enable_gpu and numba is not None:
+                        # 无可用CUDA设备时，使用与GPU内核同一约定的Numba CPU内核
+                        cropped_image, top_left_geo, bottom_right_geo = self.apply_mask_and_crop_numba(part_name, bands, map_image, transform_parameters,
+                                                                                                       block_size)
+                    elif not self.enable_gpu:
+                        cropped_image, top_left_geo, bottom_right_geo = self.apply_mask_and_crop_cpu(part_name, bands, map_image, transform_parameters,
+                                                                                                     block_size)
+                    else:
+                        try:
+                            cropped_image, top_left_geo, bottom_right_geo = self.apply_mask_and_crop_gpu(part_name, bands, map_image, transform_parameters,
+                                                                                                         block_size)
+                        except:
+                            traceback.print_exc()
+                            raise GPUUnavailableError("Error when trying to use GPU")
+                if cropped_image is None:
+                    # 裁剪被中断：已裁剪的块落盘后关闭临时文件，续传时沿用
+                    map_image.flush()
+                    map_image._mmap.close()
                 else:
-                    try:
-                        cropped_image, top_left_geo, bottom_right_geo = self.apply_mask_and_crop_gpu(table_name, bands, map_image, transform_parameters, block_size)
-                    except:
-                        traceback.print_exc()
-                        raise GPUUnavailableError("Error when trying to use GPU")
-                if cropped_image is not None:
                     self.progress_info['is_cropping_complete'] = True
                     self.write_to_queue()
-                    print(f'已完成任务：{'GPU' if self.enable_gpu else 'CPU'}裁剪{self.taskname}')
-                    rs = cv2.imwrite(geo_file, cropped_image)
-                    print(f'tif写入结果：{'成功' if rs else '失败'}')
-                    self.to_geotiff(max_x=max_x, max_y=max_y, min_x=min_x, min_y=min_y, zoom=zoom, top_left_geo=top_left_geo, bottom_right_geo=bottom_right_geo,
-                                    map_image=cropped_image, table_name=table_name, bands=bands)
+                    print(f'已完成任务：{crop_device}裁剪{self.taskname}')
+                    transform = self.to_geotiff(max_x=max_x, max_y=max_y, min_x=min_x, min_y=min_y, zoom=zoom, top_left_geo=top_left_geo,
+                                                bottom_right_geo=bottom_right_geo, map_image=cropped_image, geo_file=geo_file, block_size=block_size)
+                    if self.pyramid_levels > 0 and not self.is_empty_image:
+                        # 临时文件删除前由其直接生成低层级输出
+                        height, width, count = cropped_image.shape
+                        self.to_pyramid(lambda y, y_end: cropped_image[y:y_end], width, height, count, cropped_image.dtype, transform, geo_file, zoom,
+                                        block_size)
                     # self.write_memo(top_left_geo, bottom_right_geo)
                     map_image._mmap.close()
                     os.remove(temp_file)
                     return str(zoom) + ': success'
-                else:
-                    return
+            else:
+                map_image._mmap.close()
         except Exception as e:
             print(e)
             self.exception = e
@@ -502,8 +549,8 @@ class GeeImageStitch:
         lat_deg = math.degrees(lat_rad)
         return lat_deg, lon_deg
 
-    def to_geotiff(self, max_x, max_y, min_x, min_y, zoom, map_image, table_name, bands, top_left_geo=None, bottom_right_geo=None):
-        ee_object = self.ee_object.replace(' ', '')
+    def to_geotiff(self, max_x, max_y, min_x, min_y, zoom, map_image, geo_file, top_left_geo=None, bottom_right_geo=None, block_size=2048):
+        # 以分块、压缩的BigTIFF写出并内嵌地理参考（不再生成tfw/prj），按行块从memmap流式读取，最后转换为带内部金字塔的COG
         if top_left_geo is None:
             top_left_lat, top_left_lon = self.tile_to_latlon_top_left(min_x, min_y, zoom)
         else:
@@ -512,72 +559,279 @@ class GeeImageStitch:
             bottom_right_lat, bottom_right_lon = self.tile_to_latlon_top_left(max_x + 1, max_y + 1, zoom)
         else:
             bottom_right_lat, bottom_right_lon = bottom_right_geo[0], bottom_right_geo[1]
-        if 'part' in table_name and bands is not None:
-            tfw_file = os.path.join(self.savefile,
-                                    f'{self.taskname}_{ee_object}_{table_name.replace(f'tiles_{zoom}_part_', '').replace('_rs', '')}_{bands}.tfw')
-            prj_file = os.path.join(self.savefile,
-                                    f'{self.taskname}_{ee_object}_{table_name.replace(f'tiles_{zoom}_part_', '').replace('_rs', '')}_{bands}.prj')
-        elif 'part' in table_name and bands is None:
-            tfw_file = os.path.join(self.savefile, f'{self.taskname}_{ee_object}_{table_name.replace(f'tiles_{zoom}_part_', '').replace('_rs', '')}.tfw')
-            prj_file = os.path.join(self.savefile + f'{self.taskname}_{ee_object}_{table_name.replace(f'tiles_{zoom}_part_', '').replace('_rs', '')}.prj')
-        elif 'part' not in table_name and bands is not None:
-            tfw_file = os.path.join(self.savefile, f'{self.taskname}_{ee_object}_{bands}.tfw')
-            prj_file = os.path.join(self.savefile, f'{self.taskname}_{ee_object}_{bands}.prj')
-        else:
-            tfw_file = os.path.join(self.savefile, f'{self.taskname}_{ee_object}.tfw')
-            prj_file = os.path.join(self.savefile, f'{self.taskname}_{ee_object}.prj')
-        # crs = CRS('EPSG:4326')
-        crs = 'GEOGCS["GCS_WGS_1984",DATUM["D_WGS84",SPHEROID["WGS84",6378137,298.257223563]],PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]]'
-        height = map_image.shape[0]
-        width = map_image.shape[1]
-        pixel_width = (bottom_right_lon - top_left_lon) / width
-        pixel_height = -(top_left_lat - bottom_right_lat) / height
-        row_rotation = 0
-        column_skew = 0
-        with open(tfw_file, 'w') as file:
-            # Write the seven lines of the TFW file
-            file.write(f"{pixel_width}\n")
-            file.write(f"{row_rotation}\n")
-            file.write(f"{column_skew}\n")
-            file.write(f"{pixel_height}\n")
-            file.write(f"{top_left_lon}\n")
-            file.write(f"{top_left_lat}\n")
-        with open(prj_file, 'w') as file:
-            file.write(crs)
+        height, width, count = map_image.shape
+        transform = rasterio.transform.from_bounds(top_left_lon, bottom_right_lat, bottom_right_lon, top_left_lat, width, height)
+        profile = self.get_geotiff_profile(width, height, count, map_image.dtype, transform)
+        self.write_cog(geo_file, profile, ((y, map_image[y:y + block_size]) for y in range(0, height, block_size)))
+        return transform
+
+    @staticmethod
+    def get_geotiff_profile(width, height, count, dtype, transform):
+        predictor = 3 if np.issubdtype(dtype, np.floating) else 2
+        return {'driver': 'GTiff', 'width': width, 'height': height, 'count': count, 'dtype': np.dtype(dtype).name, 'crs': 'EPSG:4326',
+                'transform': transform, 'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'zstd', 'predictor': predictor,
+                'BIGTIFF': 'IF_SAFER'}
+
+    @staticmethod
+    def get_band_order(count):
+        # 瓦片按BGR存储，写出时转换为RGB波段顺序
+        return [3, 2, 1] if count == 3 else list(range(1, count + 1))
+
+    def get_overview_resampling(self):
+        # 分类数据取众数，避免出现原图中不存在的类别；连续数据取均值
+        return Resampling.mode if self.is_categorical else Resampling.average
+
+    def write_cog(self, geo_file, profile, blocks):
+        # blocks依次给出(起始行, 行块)，先写入分块GTiff并生成内部金字塔，再转换为COG
+        band_order = self.get_band_order(profile['count'])
+        temp_tif = f'{geo_file}.tmp'
+        trace = self.tracer.trace()
+        with self.tracer.span('geotiff_write', trace, file=os.path.basename(geo_file), width=profile['width'], height=profile['height']):
+            with rasterio.open(temp_tif, 'w', **profile) as dst:
+                for y, block in blocks:
+                    dst.write(np.ascontiguousarray(np.moveaxis(block, -1, 0)), indexes=band_order,
+                              window=rasterio.windows.Window(0, y, profile['width'], block.shape[0]))
+                factors = self.get_overview_factors(profile['width'], profile['height'])
+                if factors:
+                    with self.tracer.span('build_overviews', trace):
+                        dst.build_overviews(factors, self.get_overview_resampling())
+            with self.tracer.span('cog_copy', trace):
+                rasterio.shutil.copy(temp_tif, geo_file, driver='COG', COMPRESS='ZSTD', PREDICTOR='YES', BIGTIFF='IF_SAFER',
+                                     OVERVIEWS='FORCE_USE_EXISTING', BLOCKSIZE=512)
+        os.remove(temp_tif)
+
+    def to_pyramid(self, read_rows, width, height, count, dtype, transform, geo_file, zoom, block_size=2048, max_block_bytes=32 * 1024 * 1024):
+        # 由拼接结果生成pyramid_levels个较低层级的GeoTIFF（{文件名}_z{层级}.tif），不再访问网络
+        # 每一级直接由原图按2^k×2^k窗口归约（分类数据取众数，连续数据取均值），行块由线程池并行归约，按顺序写出
+        # read_rows(起始行, 结束行)返回原图对应行的(行数, 宽, 波段)数组
+        row_bytes = width * count * np.dtype(dtype).itemsize
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.crop_workers) as executor:
+            for level in range(1, self.pyramid_levels + 1):
+                factor = 2 ** level
+                level_width, level_height = width // factor, height // factor
+                if level_width == 0 or level_height == 0 or zoom - level < 0:
+                    break
+                if self.signal.is_set():
+                    return
+                # 行块为factor的整数倍，同时限制单个行块的内存占用
+                rows = max(1, min(block_size, max_block_bytes // row_bytes) // factor) * factor
+                profile = self.get_geotiff_profile(level_width, level_height, count, dtype, transform * rasterio.Affine.scale(factor))
+
+                def reduced_blocks():
+                    for y in range(0, level_height * factor, rows * self.crop_workers):
+                        batch_end = min(y + rows * self.crop_workers, level_height * factor)
+                        futures = [executor.submit(reduce_rows, read_rows(row, min(row + rows, batch_end)), factor, self.is_categorical)
+                                   for row in range(y, batch_end, rows)]
+                        for row, future in zip(range(y, batch_end, rows), futures):
+                            yield row // factor, future.result()
+
+                level_file = f'{os.path.splitext(geo_file)[0]}_z{zoom - level}.tif'
+                self.write_cog(level_file, profile, reduced_blocks())
+                print(f'已生成第{zoom - level}级：{level_file}')
+
+    @staticmethod
+    def get_overview_factors(width, height):
+        factors = []
+        factor = 2
+        while max(width, height) // factor >= 256:
+            factors.append(factor)
+            factor *= 2
+        return factors
+
+    def tiles_stitch_streaming(self, task: tuple, block_size=2048, max_band_bytes=256 * 1024 * 1024):
+        # 流式拼接：不创建整幅临时memmap，按瓦片行条带读取瓦片，逐块裁剪后直接写入分块GeoTIFF，与多边形不相交的块不写入（稀疏）
+        # 该模式不保留中间结果，中断后该分区从头拼接
+        table_name, part_id, zoom, tile_size_width, tile_size_height, bands, count = task
+        ee_object = self.ee_object.replace(' ', '')
+        part_name = f'{table_name}_part_{part_id}'
+        geo_file = os.path.join(self.savefile, f'{self.taskname}_{ee_object}{self.get_output_name(part_id, bands)}.tif')
+        # 先写入临时文件，概览与金字塔生成后再改名，中断或出错时不在最终文件名下留下不完整的GeoTIFF
+        temp_geo_file = geo_file + '.tmp'
+        conn = self.database_session.connection()
+        cur = conn.cursor()
+        try:
+            res = TileQuery.execute(cur, 'tile_bounds', table_name, (zoom, part_id))
+            max_x, max_y, min_x, min_y = res.fetchone()
+            TileProgress.reset_stitched(cur, table_name.replace('_rs', ''), part_id, zoom, bands)
+            conn.commit()
+            shapely.prepare(self.polygon)
+            map_width = (max_x - min_x + 1) * tile_size_width
+            map_height = (max_y - min_y + 1) * tile_size_height
+            north, west = self.tile_to_latlon_top_left(min_x, min_y, zoom)
+            south, east = self.tile_to_latlon_top_left(max_x + 1, max_y + 1, zoom)
+            transform = rasterio.transform.from_bounds(west, south, east, north, map_width, map_height)
+            # 输出范围只取多边形外包矩形覆盖的像素
+            poly_west, poly_south, poly_east, poly_north = self.polygon.bounds
+            col_start = max(0, math.floor((poly_west - west) / transform.a))
+            col_end = min(map_width, math.ceil((poly_east - west) / transform.a))
+            row_start = max(0, math.floor((poly_north - north) / transform.e))
+            row_end = min(map_height, math.ceil((poly_south - north) / transform.e))
+            try:
+                os.mkdir(self.savefile)
+            except:
+                pass
+            if col_start >= col_end or row_start >= row_end:
+                self.is_empty_image = True
+                self.to_geotiff(max_x=max_x, max_y=max_y, min_x=min_x, min_y=min_y, zoom=zoom, geo_file=geo_file,
+                                map_image=np.zeros((512, 512, self.channels), dtype=self.dtype))
+                return str(zoom) + ': success'
+            out_width, out_height = col_end - col_start, row_end - row_start
+            out_transform = rasterio.windows.transform(rasterio.windows.Window(col_start, row_start, out_width, out_height), transform)
+            band_order = self.get_band_order(self.channels)
+            profile = self.get_geotiff_profile(out_width, out_height, self.channels, self.dtype, out_transform)
+            profile['SPARSE_OK'] = True
+            # 条带高度为整数个瓦片行，同时限制单个条带的内存占用
+            row_bytes = out_width * self.channels * self.dtype.itemsize * tile_size_height
+            band_tiles = max(1, min(block_size // tile_size_height, max_band_bytes // row_bytes))
+            block_count = math.ceil(out_height / (band_tiles * tile_size_height)) * math.ceil(out_width / block_size)
+            with self.thread_lock:
+                self.progress_info['crop_total'] = block_count if self.progress_info['crop_total'] == 1 else self.progress_info['crop_total'] + block_count
+            stitched = 0
+            with rasterio.open(temp_geo_file, 'w', **profile) as dst:
+                first_tile_y = min_y + row_start // tile_size_height
+                last_tile_y = min_y + (row_end - 1) // tile_size_height
+                for band_min_y in range(first_tile_y, last_tile_y + 1, band_tiles):
+                    if self.signal.is_set():
+                        return
+                    band_max_y = min(band_min_y + band_tiles - 1, last_tile_y)
+                    # 条带在输出图像中的行范围
+                    band_row_start = max(row_start, (band_min_y - min_y) * tile_size_height)
+                    band_row_end = min(row_end, (band_max_y - min_y + 1) * tile_size_height)
+                    band_image = np.zeros((band_row_end - band_row_start, out_width, self.channels), dtype=self.dtype)
+                    res = TileQuery.execute(cur, 'stitch_tiles', table_name, (zoom, part_id, bands, band_min_y, band_max_y))
+                    band_stitched = 0
+                    for x_position, y_position, tiles in iter_tile_runs(res, self.ee_object == 'Dynamic World', self.tracer):
+                        # 瓦片在整幅图像中的位置，裁剪到当前条带和输出范围内
+                        with self.tracer.span('stitch_placement', self.tracer.sample(), x=x_position, y=y_position, tiles=len(tiles)):
+                            place_tile_run(band_image, tiles, (y_position - min_y) * tile_size_height, (x_position - min_x) * tile_size_width,
+                                           tile_size_height, tile_size_width, band_row_start, col_start)
+                        band_stitched += len(tiles)
+                    stitched += band_stitched
+                    # 流式拼接不保留中间结果，只累计拼接计数，不记录检查点
+                    self.update_stitch_info.put((table_name, part_id, zoom, bands, None, band_min_y, band_stitched))
+                    with self.thread_lock:
+                        self.progress_info.add('stitched_tiles', band_stitched)
+                        self.progress_info[f'{part_name}_stitched_tiles'] = stitched
+                        self.write_to_queue()
+                    for x in range(0, out_width, block_size):
+                        x_end = min(x + block_size, out_width)
+                        window = rasterio.windows.Window(x, band_row_start - row_start, x_end - x, band_row_end - band_row_start)
+                        block_transform = rasterio.windows.transform(window, out_transform)
+                        block_bounds = rasterio.windows.bounds(window, out_transform)
+                        block_polygon = shapely.box(*block_bounds)
+                        if self.polygon.intersects(block_polygon):
+                            trace = self.tracer.sample()
+                            block_image = band_image[:, x:x_end]
+                            if not self.polygon.contains(block_polygon):
+                                # 只用裁剪到当前块的多边形生成掩膜
+                                with self.tracer.span('mask', trace, x=x, y=band_row_start):
+                                    block_mask = geometry_mask([self.polygon.intersection(block_polygon)], out_shape=block_image.shape[:2],
+                                                               transform=block_transform, invert=True)
+                                    np.copyto(block_image, 0, where=~block_mask[:, :, np.newaxis])
+                            with self.tracer.span('geotiff_block_write', trace, x=x, y=band_row_start):
+                                dst.write(np.ascontiguousarray(np.moveaxis(block_image, -1, 0)), indexes=band_order, window=window)
+                        self.progress_info.add('croped_blocks', 1)
+                    self.write_to_queue()
+                factors = self.get_overview_factors(out_width, out_height)
+                if factors:
+                    with self.tracer.span('build_overviews', self.tracer.trace()):
+                        dst.build_overviews(factors, self.get_overview_resampling())
+            if self.pyramid_levels > 0:
+                # 流式拼接没有临时memmap，低层级由刚写出的GeoTIFF按行块读回生成
+                with rasterio.open(temp_geo_file) as src:
+                    self.to_pyramid(lambda y, y_end: np.moveaxis(src.read(band_order, window=rasterio.windows.Window(0, y, out_width, y_end - y)), 0, -1),
+                                    out_width, out_height, self.channels, self.dtype, out_transform, geo_file, zoom, block_size)
+                if self.signal.is_set():
+                    return
+            os.replace(temp_geo_file, geo_file)
+            # 输出范围外的瓦片行无需读取，计入拼接进度
+            with self.thread_lock:
+                self.progress_info.add('stitched_tiles', max(0, count - stitched))
+                self.progress_info[f'{part_name}_stitched_tiles'] = max(count, stitched)
+            if count > stitched:
+                self.update_stitch_info.put((table_name, part_id, zoom, bands, None, None, count - stitched))
+            self.progress_info['is_cropping_complete'] = True
+            self.write_to_queue()
+            return str(zoom) + ': success'
+        except Exception as e:
+            print(e)
+            self.exception = e
+        finally:
+            conn.close()
+            if os.path.exists(temp_geo_file):
+                os.remove(temp_geo_file)
 
     def update_sqlite_stitch_info(self):
         conn = self.database_session.connection()
         cur = conn.cursor()
         while not (self.is_stitch_complete and self.update_stitch_info.empty()):
+            # 队列为空时阻塞等待，超时后重新检查拼接是否已完成
             try:
-                stitched = self.progress_info['stitched_tiles']
-                x, y, z, table_name = self.update_stitch_info.get(block=False, timeout=1)
-                stitch_status_sql = f'update "{table_name}" set stitch_status = 1 where (x,y,z) = ({x},{y},{z})'
-                stitch_info_sql = f'update stitch_info set success = {stitched} where tablename = "{table_name.replace('_rs', '')}"'
-                cur.execute(stitch_status_sql)
-                cur.execute(stitch_info_sql)
-                conn.commit()
+                items = [self.update_stitch_info.get(timeout=1)]
+            except q.Empty:
+                continue
+            # 一次取出队列中已完成的条带，同一事务提交
+            while len(items) < self.stitch_info_batch_size:
+                try:
+                    items.append(self.update_stitch_info.get_nowait())
+                except q.Empty:
+                    break
+            # 每个条带一条检查点，与拼接计数在同一事务中提交
+            checkpoint_rows = []
+            stitched_counters = {}
+            for table_name, part_id, z, bands, band_rows, band_min_y, tiles in items:
+                if band_rows is not None:
+                    checkpoint_rows.append((table_name, part_id, z, bands, band_rows, band_min_y, tiles))
+                counters = stitched_counters.setdefault(table_name.replace('_rs', ''), {})
+                counters[(part_id, z, bands)] = counters.get((part_id, z, bands), 0) + tiles
+            try:
+                StitchCheckpoint.add_bands(cur, checkpoint_rows)
+                for table_name, counters in stitched_counters.items():
+                    TileProgress.add_stitched(cur, table_name, counters)
+                commit_time = time.time()
+                with self.tracer.span('sqlite_commit', self.tracer.trace(), bands=len(items)):
+                    conn.commit()
+                self.metrics.observe('sqlite_commit_seconds', time.time() - commit_time)
+                self.metrics.set('checkpoint_queue_depth', self.update_stitch_info.qsize())
             except Exception as e:
-                pass
+                print(e)
+                conn.rollback()
         self.progress_info['is_update_sqlite_complete'] = True
         self.write_to_queue()
         conn.close()
 
     def multiworker(self):
         self.task_create()
+        # 拼接进程池由所有拼接线程共享，进程数与CPU核数一致
+        self.stitch_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.stitch_workers, initializer=init_band_worker,
+                                                                   initargs=(self.signal, self.trace_path, f'{self.taskname}_stitch_band'))
         to_sqlite_results = []
         to_sqlite_thread = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         to_sqlite_result = to_sqlite_thread.submit(self.update_sqlite_stitch_info)
         to_sqlite_results.append(to_sqlite_result)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-            # 提交多个任务给线程池执行拼接任务
-            self.futures = [executor.submit(self.tiles_stitch, stitch_task, ) for stitch_task in self.task_list]
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+                # 提交多个任务给线程池执行拼接任务
+                stitch_function = self.tiles_stitch_streaming if self.stream_to_geotiff else self.tiles_stitch
+                self.futures = [executor.submit(stitch_function, stitch_task, ) for stitch_task in self.task_list]
+        finally:
+            self.stitch_pool.shutdown()
+            # 出错时同样结束检查点写入线程，已完成条带的检查点提交、数据库连接关闭后再抛出异常，否则写入线程不会退出，作业无法结束
+            self.is_stitch_complete = True
+            concurrent.futures.wait(to_sqlite_results)
+            to_sqlite_thread.shutdown()
         if self.exception is not None:
+            self.tracer.close()
             raise self.exception
-        self.is_stitch_complete = True
+        if self.signal.is_set():
+            # 停止时拼接进程已刷新各自的条带，检查点已全部提交，告知主进程可以安全结束
+            self.tracer.close()
+            self.process_done['is_drained'] = True
+            self.write_to_queue()
+            return
         if self.is_export_shp:
             self.export_shp()
-        concurrent.futures.wait(to_sqlite_results)
+        self.tracer.close()
         self.progress_info['is_stitch_complete'] = True
         self.write_to_queue()
 
@@ -626,17 +880,19 @@ class CudaImageCrop:
         vertex_counts = []  # 存储每个多边形的顶点数
         current_offset = 0  # 当前已处理顶点数（用于计算偏移量）
         if isinstance(geom, Polygon):
-            coords = np.array(geom.exterior.coords, dtype=np.float64)
-            all_coords.append(coords)
-            offsets.append(current_offset)
-            vertex_counts.append(len(coords))
+            polygons = [geom]
         elif isinstance(geom, MultiPolygon):
-            for poly in geom.geoms:
-                coords = np.array(poly.exterior.coords, dtype=np.float64)
+            polygons = geom.geoms
+        else:
+            polygons = []
+        for poly in polygons:
+            # 外环与每个内环（洞）各作为一个环，按奇偶规则填充时洞内像素被排除
+            for ring in [poly.exterior, *poly.interiors]:
+                coords = np.array(ring.coords, dtype=np.float64)
                 all_coords.append(coords)
                 offsets.append(current_offset)
                 vertex_counts.append(len(coords))
-                current_offset += len(coords)  # 更新偏移量为下一个多边形的起始位置
+                current_offset += len(coords)  # 更新偏移量为下一个环的起始位置
         # 将所有多边形的坐标连接成一个二维数组
         poly_coords = np.vstack(all_coords) if all_coords else np.empty((0, 2), dtype=np.float64)
         poly_offsets = np.array(offsets, dtype=np.int32)
@@ -729,8 +985,7 @@ class CudaImageCrop:
     def _record_process(self, table_name, bands, x, y, x_end, y_end, ymin, ymax, xmin, xmax):
         conn = self.database_conn
         cur = conn.cursor()
-        with self.crop_threading_lock:
-            self.progress_info['croped_blocks'] = self.progress_info['croped_blocks'] + 1
+        self.progress_info.add('croped_blocks', 1)
         if bands is not None:
             cur.execute('UPDATE crop_info SET cropped = 1 WHERE tablename = ? AND bands = ? AND x = ? AND y = ? AND x_end = ? AND y_end = ?',
                         (table_name, bands, x, y, x_end, y_end))
@@ -797,11 +1052,277 @@ class CudaImageCrop:
         return padded
 
 
+if numba is not None:
+    @numba.njit(parallel=True, cache=True)
+    def process_image_kernel_cpu(image, params, extremum, poly_coords, poly_offsets, poly_vertex_counts):
+        # 与process_image_kernel相同的约定：image为按行展开的块数据，params为[c, a, b, f, d, e, 多边形数, 块起始行, 块起始列, 块高, 块宽, 波段数]，
+        # 多边形外的像素置0，extremum按[ymin, ymax, xmin, xmax]记录多边形内像素在整幅图像中的范围
+        c, a, f, e = params[0], params[1], params[3], params[5]
+        n_polygon, y0, x0 = int(params[6]), int(params[7]), int(params[8])
+        height, width, n_bands = int(params[9]), int(params[10]), int(params[11])
+        row_xmin = np.full(height, width, dtype=np.int32)
+        row_xmax = np.full(height, -1, dtype=np.int32)
+        for row in numba.prange(height):
+            # 扫描线取像素中心所在纬度，逐环求与边的交点，交点之间的像素按奇偶规则翻转，洞内像素被外环和内环各翻转一次
+            lat = f + (row + 0.5) * e
+            inside = np.zeros(width, dtype=np.bool_)
+            for p in range(n_polygon):
+                offset, count = poly_offsets[p], poly_vertex_counts[p]
+                crossings = np.empty(count, dtype=np.float64)
+                n_crossings = 0
+                for k in range(count - 1):
+                    lon1, lat1 = poly_coords[2 * (offset + k)], poly_coords[2 * (offset + k) + 1]
+                    lon2, lat2 = poly_coords[2 * (offset + k + 1)], poly_coords[2 * (offset + k + 1) + 1]
+                    if (lat1 > lat) != (lat2 > lat):
+                        crossings[n_crossings] = lon1 + (lat - lat1) * (lon2 - lon1) / (lat2 - lat1)
+                        n_crossings += 1
+                crossings = np.sort(crossings[:n_crossings])
+                for k in range(0, n_crossings - 1, 2):
+                    # 像素中心落在[交点左, 交点右)内的列
+                    col_start = max(0, int(np.ceil((crossings[k] - c) / a - 0.5)))
+                    col_end = min(width, int(np.ceil((crossings[k + 1] - c) / a - 0.5)))
+                    for col in range(col_start, col_end):
+                        inside[col] = not inside[col]
+            for col in range(width):
+                if inside[col]:
+                    if col < row_xmin[row]:
+                        row_xmin[row] = col
+                    row_xmax[row] = col
+                else:
+                    base = (row * width + col) * n_bands
+                    for band in range(n_bands):
+                        image[base + band] = 0
+        for row in range(height):
+            if row_xmax[row] >= 0:
+                extremum[0] = min(extremum[0], y0 + row)
+                extremum[1] = max(extremum[1], y0 + row)
+                extremum[2] = min(extremum[2], x0 + row_xmin[row])
+                extremum[3] = max(extremum[3], x0 + row_xmax[row])
+else:
+    process_image_kernel_cpu = None
+# workqueue线程层不支持并发调用，多个分区同时裁剪时串行执行内核（内核本身已按行并行）
+numba_kernel_lock = Lock()
+
+
+class NumbaImageCrop:
+    def __init__(self, block_list, database_conn, crop_threading_lock, progress_info, write_to_queue, block_size, map_image, transform_parameters, polygon,
+                 signal, extremum, commit_blocks, tracer):
+        self.block_list = block_list
+        self.database_conn = database_conn
+        self.crop_threading_lock = crop_threading_lock
+        self.progress_info = progress_info
+        self.write_to_queue = write_to_queue
+        self.block_size = block_size
+        self.map_image = map_image
+        self.transform_parameters = transform_parameters
+        self.polygon = polygon
+        self.signal = signal
+        self.extremum = extremum
+        self.commit_blocks = commit_blocks
+        self.tracer = tracer
+
+    def worker(self):
+        west, south, east, north, map_width, map_height = self.transform_parameters
+        transform = rasterio.transform.from_bounds(west, south, east, north, map_width, map_height)
+        pixel_width = (east - west) / map_width  # 每个像素的经度
+        pixel_height = (north - south) / map_height  # 每个像素的纬度
+        poly_coords, poly_offsets, poly_vertex_counts = CudaImageCrop.extract_coords(self.polygon)
+        n_bands = 1 if self.map_image.ndim == 2 else self.map_image.shape[2]
+        int32_max = np.iinfo(np.int32).max
+        ymin, ymax, xmin, xmax = self.extremum
+        # 续传时crop_bounds_info中的范围可能为空
+        extremum = np.array([int32_max if ymin in (None, float('inf')) else ymin, ymax or 0, int32_max if xmin in (None, float('inf')) else xmin,
+                             xmax or 0], dtype=np.int32)
+        conn = self.database_conn.connection()
+        cur = conn.cursor()
+        try:
+            for i in range(0, len(self.block_list), self.commit_blocks):
+                if self.signal.is_set():
+                    return None, None, None
+                chunk = self.block_list[i:i + self.commit_blocks]
+                for table_name, bands, x, y, x_end, y_end in chunk:
+                    block_transform = rasterio.transform.from_bounds(west + x * pixel_width, north - y_end * pixel_height, west + x_end * pixel_width,
+                                                                     north - y * pixel_height, x_end - x, y_end - y)
+                    params = np.array([block_transform.c, block_transform.a, block_transform.b, block_transform.f, block_transform.d, block_transform.e,
+                                       float(len(poly_offsets)), float(y), float(x), float(y_end - y), float(x_end - x), float(n_bands)], dtype=np.float64)
+                    block_image = np.ascontiguousarray(self.map_image[y:y_end, x:x_end])
+                    image = block_image.reshape(-1)
+                    with self.tracer.span('mask', self.tracer.sample(), x=x, y=y):
+                        with numba_kernel_lock:
+                            process_image_kernel_cpu(image, params, extremum, poly_coords, poly_offsets, poly_vertex_counts)
+                    self.map_image[y:y_end, x:x_end] = block_image
+                ymin, ymax, xmin, xmax = extremum.tolist()
+                trace = self.tracer.trace()
+                with self.tracer.span('memmap_flush', trace):
+                    self.map_image.flush()
+                cur.executemany('UPDATE crop_info SET cropped = 1 WHERE tablename = ? AND bands is ? AND x = ? AND y = ? AND x_end = ? AND y_end = ?', chunk)
+                cur.execute('update crop_bounds_info set ymin = ?, ymax = ?, xmin = ?, xmax = ? where tablename = ? and bands is ?',
+                            (ymin if ymin != int32_max else None, ymax, xmin if xmin != int32_max else None, xmax, chunk[0][0], chunk[0][1]))
+                with self.tracer.span('sqlite_commit', trace, blocks=len(chunk)):
+                    conn.commit()
+                self.progress_info.add('croped_blocks', len(chunk))
+                self.write_to_queue()
+        finally:
+            conn.close()
+        ymin, ymax, xmin, xmax = extremum.tolist()
+        if ymin == int32_max:
+            ymin, xmin, ymax, xmax = 0, 0, 0, 0
+        if ymin < ymax and xmin < xmax:
+            cropped_image = self.map_image[ymin:ymax, xmin:xmax]
+        else:
+            cropped_image = np.zeros((512, 512, n_bands), dtype=self.map_image.dtype)
+        top_left_geo = (ymin * transform.e + transform.f, xmin * transform.a + transform.c)
+        bottom_right_geo = (ymax * transform.e + transform.f, xmax * transform.a + transform.c)
+        return cropped_image, top_left_geo, bottom_right_geo
+
+
+def reduce_rows(rows, factor, is_categorical):
+    # 将(h, w, c)的行块按factor×factor窗口降采样，不足一个窗口的右侧和底部像素舍去
+    height, width, count = rows.shape[0] // factor, rows.shape[1] // factor, rows.shape[2]
+    windows = rows[:height * factor, :width * factor].reshape(height, factor, width, factor, count)
+    if not is_categorical:
+        reduced = windows.mean(axis=(1, 3))
+        return (np.rint(reduced) if np.issubdtype(rows.dtype, np.integer) else reduced).astype(rows.dtype)
+    pixels = np.ascontiguousarray(windows.transpose(0, 2, 1, 3, 4)).reshape(height * width, factor * factor, count)
+    return window_mode(pixels).reshape(height, width, count)
+
+
+def window_mode(pixels):
+    # pixels为(m, n, c)，对每个窗口的n个像素取众数，整个像素（全部波段）作为一个值比较，不会组合出原图中不存在的颜色
+    pixels = np.ascontiguousarray(pixels)
+    m, n, count = pixels.shape
+    pixel_bytes = count * pixels.dtype.itemsize
+    if pixel_bytes > 8:
+        # 像素无法打包为一个整数时逐波段取众数
+        return np.stack([window_mode(pixels[:, :, band:band + 1])[:, 0] for band in range(count)], axis=-1)
+    packed = np.zeros((m, n, 8), dtype=np.uint8)
+    packed[:, :, :pixel_bytes] = pixels.view(np.uint8).reshape(m, n, pixel_bytes)
+    keys = packed.view(np.uint64)[:, :, 0]
+    order = np.argsort(keys, axis=1, kind='stable')
+    sorted_keys = np.take_along_axis(keys, order, axis=1)
+    # 排序后相同值连续，index - 所在连续段起点即为该位置的段内序号，最大值所在位置即为众数
+    is_start = np.ones(sorted_keys.shape, dtype=bool)
+    is_start[:, 1:] = sorted_keys[:, 1:] != sorted_keys[:, :-1]
+    index = np.arange(n)
+    run_length = index - np.maximum.accumulate(np.where(is_start, index, 0), axis=1)
+    best = np.take_along_axis(order, run_length.argmax(axis=1)[:, np.newaxis], axis=1)[:, 0]
+    return pixels[np.arange(m), best]
+
+
 class GPUUnavailableError(Exception):
     """在尝试使用 GPU 时发生错误"""
     pass
 
 
+band_worker_signal = None
+band_worker_tracer = Tracer(None, 'stitch_band', sample_rate=0)
+
+
+def init_band_worker(signal, trace_path=None, process_name='stitch_band'):
+    global band_worker_signal, band_worker_tracer
+    band_worker_signal = signal
+    if trace_path is not None:
+        band_worker_tracer = Tracer(trace_path, process_name)
+
+
+def iter_tile_runs(res, is_flip=False, tracer=None):
+    # 按(y, x)顺序以fetchmany批量读取瓦片，同一行中x连续且形状、类型相同的瓦片合并为一个(n, h, w, ...)数组，返回(起始x, y, 瓦片数组)
+    # 形状字符串和dtype对每种取值只解析一次；传入tracer时按抽样记录每段瓦片的解码耗时
+    formats = {}
+    if tracer is None:
+        tracer = band_worker_tracer
+    while True:
+        rows = res.fetchmany(TileQuery.fetch_size)
+        if not rows:
+            return
+        run, run_format = [], None
+        for tile_data, x_position, y_position, z, shape, dtype in rows:
+            tile_format = formats.get((shape, dtype))
+            if tile_format is None:
+                tile_format = formats[(shape, dtype)] = (tuple(map(int, shape.strip('()').split(','))), np.dtype(dtype))
+            if run and (tile_format is not run_format or y_position != run[-1][2] or x_position != run[-1][1] + 1):
+                with tracer.span('tile_decode', tracer.sample(), tiles=len(run)):
+                    tiles = tile_run(run, run_format, is_flip)
+                yield tiles
+                run = []
+            run.append((tile_data, x_position, y_position))
+            run_format = tile_format
+        if run:
+            with tracer.span('tile_decode', tracer.sample(), tiles=len(run)):
+                tiles = tile_run(run, run_format, is_flip)
+            yield tiles
+
+
+def tile_run(run, tile_format, is_flip):
+    image_shape, dtype = tile_format
+    tiles = np.frombuffer(b''.join(tile_data for tile_data, x_position, y_position in run), dtype=dtype).reshape((len(run),) + image_shape)
+    if is_flip:
+        tiles = tiles[:, ::-1]
+    return run[0][1], run[0][2], tiles
+
+
+def place_block(target, block, start_y, start_x, row_start=0, col_start=0):
+    # block放在整幅图像的(start_y, start_x)处，target对应整幅图像中以(row_start, col_start)为左上角的区域，超出target的部分被截去
+    y0, y1 = max(start_y, row_start), min(start_y + block.shape[0], row_start + target.shape[0])
+    x0, x1 = max(start_x, col_start), min(start_x + block.shape[1], col_start + target.shape[1])
+    if y0 < y1 and x0 < x1:
+        target[y0 - row_start:y1 - row_start, x0 - col_start:x1 - col_start] = block[y0 - start_y:y1 - start_y, x0 - start_x:x1 - start_x]
+
+
+def place_tile_run(target, tiles, start_y, start_x, tile_size_height, tile_size_width, row_start=0, col_start=0):
+    # tiles为同一行上相邻的n个瓦片，瓦片k放在start_x + k * tile_size_width处；下载时的缓冲使瓦片比tile_size大，
+    # 与逐个放置相同，重叠部分由后放置的瓦片覆盖：段内每个瓦片只保留前tile_size_width列，最后一个瓦片完整放置
+    n, height, width = tiles.shape[:3]
+    if width < tile_size_width:
+        for k in range(n):
+            place_block(target, tiles[k], start_y, start_x + k * tile_size_width, row_start, col_start)
+        return
+    body_width = n * tile_size_width
+    y0, x0 = start_y - row_start, start_x - col_start
+    if y0 >= 0 and x0 >= 0 and y0 + height <= target.shape[0] and x0 + body_width <= target.shape[1]:
+        # 整段瓦片都在范围内：把目标区域视为(h, n, w, ...)，一次赋值放置全部瓦片
+        region = target[y0:y0 + height, x0:x0 + body_width]
+        region.reshape((height, n, tile_size_width) + tiles.shape[3:])[...] = tiles[:, :, :tile_size_width].swapaxes(0, 1)
+    else:
+        body = tiles[:, :, :tile_size_width].swapaxes(0, 1).reshape((height, body_width) + tiles.shape[3:])
+        place_block(target, body, start_y, start_x, row_start, col_start)
+    if width > tile_size_width:
+        place_block(target, tiles[-1, :, tile_size_width:], start_y, start_x + body_width, row_start, col_start)
+
+
+def stitch_row_band(parameter: tuple):
+    # 在拼接进程中执行：以只读连接读取一个条带内的全部瓦片，写入同一临时文件的对应行并刷新到磁盘，返回放置的瓦片数，被中断时返回None
+    (tilepath, table_name, zoom, part_id, bands, band_min_y, band_max_y, min_x, min_y, tile_size_width, tile_size_height, temp_file, dtype, map_shape,
+     is_flip) = parameter
+    tracer = band_worker_tracer
+    band_trace, band_start = tracer.trace(), tracer.now()
+    map_image = np.memmap(filename=temp_file, dtype=np.dtype(dtype), mode='r+', shape=map_shape)
+    # 只写入本条带的行：带缓冲的瓦片比tile_size高，条带最后一行瓦片超出的部分属于下一条带，由下一条带的瓦片写入
+    row_start = (band_min_y - min_y) * tile_size_height
+    band_image = map_image[row_start:min((band_max_y - min_y + 1) * tile_size_height, map_shape[0])]
+    conn = sqlite3.connect(f'file:{tilepath}?mode=ro', uri=True, cached_statements=TileQuery.cached_statements)
+    placed_tiles = 0
+    try:
+        res = TileQuery.execute(conn.cursor(), 'stitch_tiles', table_name, (zoom, part_id, bands, band_min_y, band_max_y))
+        for x_position, y_position, tiles in iter_tile_runs(res, is_flip, tracer):
+            if band_worker_signal is not None and band_worker_signal.is_set():
+                return None
+            # 将瓦片放置到空白图像的对应位置，确保放置位置在图像范围内
+            with tracer.span('stitch_placement', tracer.sample(), x=x_position, y=y_position, tiles=len(tiles)):
+                place_tile_run(band_image, tiles, (y_position - min_y) * tile_size_height, (x_position - min_x) * tile_size_width,
+                               tile_size_height, tile_size_width, row_start)
+            placed_tiles += len(tiles)
+        # 显式刷新（msync）后才返回，主进程据此提交该条带的检查点
+        with tracer.span('memmap_flush', band_trace):
+            map_image.flush()
+    finally:
+        conn.close()
+        del band_image, map_image
+        tracer.add_span('stitch_band', band_trace, band_start, table=table_name, band_min_y=band_min_y, band_max_y=band_max_y, tiles=placed_tiles)
+        tracer.flush()
+    return placed_tiles
+
+
 def start(argsa):
     b = GeeImageStitch(*argsa)
     b.multiworker()
@@ -817,8 +1338,8 @@ if __name__ == '__main__':
     taskname: str, path: str, sqlitename: str, ee_object: str, polygon: str, scale: int, region: str, start_date: str, end_date: str,
     datainfo_url: str, is_export_shp: bool, progress_info: dict, process_done, signal, queue, gpu_setting: bool
     """
-    progress_info_dict = {'stitched_tiles': 0, 'target': 'stitch', 'st_time': 0, 'ed_time': 0, 'this_st_time': 0, 'stitch_list': [], 'crop_total': 1,
-                          'croped_blocks': 0, 'is_stitch_complete': False, 'is_cropping_complete': False, 'update_sqlite_complete': False}
+    progress_info_dict = SharedProgress.create({'stitched_tiles': 0, 'target': 'stitch', 'st_time': 0, 'ed_time': 0, 'this_st_time': 0, 'stitch_list': [], 'crop_total': 1,
+                          'croped_blocks': 0, 'is_stitch_complete': False, 'is_cropping_complete': False, 'update_sqlite_complete': False})
     gpu_setting = True
     args = ('Dongcheng_01', 'd:\\datadownload\\Dongcheng_01', 'Dongcheng_01.nev', 'Dynamic World', polygon, 10, '北京市', '2023-11-01', '2024-11-01',
             'https://127.0.0.1', True, progress_info_dict, {}, Event(), Queue(), gpu_setting, kernel_func)
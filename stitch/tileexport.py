@@ -0,0 +1,331 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import struct
+import concurrent.futures
+import cv2
+import numpy as np
+from progress import TileProgress
+from query import TileQuery
+from stitch.geestitch import GeeImageStitch, iter_tile_runs, reduce_rows
+
+
+class TileExporter:
+    """
+    瓦片导出：直接由.nev中tiles_*_rs表的瓦片（Web墨卡托x/y/z）生成MBTiles、PMTiles或XYZ目录（PNG/WebP），无需拼接和重新切片。
+    下载层级的瓦片由线程池并行编码，更低的层级由每4个子瓦片合并后2×2归约得到（分类数据取众数，连续数据取均值），逐级生成，不再访问网络
+    输出类型由文件扩展名决定：.mbtiles、.pmtiles，其余视为XYZ目录
+    """
+    tile_formats = {'png': ('.png', 2), 'webp': ('.webp', 4)}  # 扩展名, PMTiles瓦片类型
+
+    def __init__(self, tilepath: str, output: str, ee_object: str, tile_format='png', min_zoom=None, bands=None, signal=None, workers=os.cpu_count(),
+                 batch_size=256):
+        if tile_format not in self.tile_formats:
+            raise ValueError(f'Unsupported tile format: {tile_format!r}')
+        self.tilepath = tilepath
+        self.output = output
+        self.ee_object = ee_object
+        self.tile_format = tile_format
+        self.min_zoom = min_zoom
+        self.bands = bands
+        self.signal = signal
+        self.workers = workers
+        self.batch_size = batch_size
+        self.is_flip = ee_object == 'Dynamic World'
+        self.is_categorical = ee_object in ('Dynamic World', 'JRC Monthly Water History')
+        # 分类数据使用无损WebP，避免类别颜色被有损压缩改变
+        if tile_format == 'png':
+            self.encode_params = [cv2.IMWRITE_PNG_COMPRESSION, 6]
+        else:
+            self.encode_params = [cv2.IMWRITE_WEBP_QUALITY, 101 if self.is_categorical else 90]
+        self.tile_bounds = None  # 下载层级瓦片编号范围[min_x, min_y, max_x, max_y]
+        self.zoom = None
+
+    def export(self):
+        conn = sqlite3.connect(f'file:{self.tilepath}?mode=ro', uri=True, cached_statements=TileQuery.cached_statements)
+        try:
+            tasks = [task for task in TileProgress.stitch_tasks(conn.cursor()) if task[5] == self.bands]
+            if not tasks:
+                raise ValueError(f'No downloaded tiles for bands {self.bands!r}')
+            table_name, zoom, tile_size_width, tile_size_height = tasks[0][0], tasks[0][2], tasks[0][3], tasks[0][4]
+            self.zoom = zoom
+            min_zoom = zoom if self.min_zoom is None else max(0, min(self.min_zoom, zoom))
+            writer = self.open_writer()
+            # 每一级的原始瓦片暂存于临时库，作为下一级合并的输入
+            levels_file = f'{self.output}.levels.tmp'
+            if os.path.exists(levels_file):
+                os.remove(levels_file)
+            levels = sqlite3.connect(levels_file) if min_zoom < zoom else None
+            exported = 0
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+                    res = TileQuery.execute(conn.cursor(), 'export_tiles', table_name, (zoom, self.bands))
+                    tiles = self.iter_tiles(res, self.is_flip, tile_size_width, tile_size_height)
+                    exported += self.write_level(executor, writer, zoom, tiles, levels if min_zoom < zoom else None, False)
+                    for z in range(zoom - 1, min_zoom - 1, -1):
+                        if self.signal is not None and self.signal.is_set():
+                            break
+                        # 写入顺序即(y, x)顺序，按rowid读取即可
+                        children = self.iter_tiles(levels.execute(f'select image, x, y, z, shape, dtype from level_{z + 1} order by rowid'), False)
+                        exported += self.write_level(executor, writer, z, self.merge_children(children), levels if z > min_zoom else None, True)
+                        levels.execute(f'drop table level_{z + 1}')
+                writer.close(self.get_metadata(min_zoom, zoom))
+            finally:
+                if levels is not None:
+                    levels.close()
+                    os.remove(levels_file)
+            return exported
+        finally:
+            conn.close()
+
+    @staticmethod
+    def iter_tiles(res, is_flip, tile_size_width=None, tile_size_height=None):
+        # 下载的瓦片带有缓冲，比tile_size大，与拼接时相同只保留左上角tile_size范围；合并生成的父瓦片不需要截取
+        for x_position, y_position, tiles in iter_tile_runs(res, is_flip):
+            for i, tile in enumerate(tiles[:, :tile_size_height, :tile_size_width]):
+                yield x_position + i, y_position, tile if tile.ndim == 3 else tile[:, :, np.newaxis]
+
+    @staticmethod
+    def merge_children(children):
+        # 子瓦片按(y, x)有序，每处理完一个父瓦片行即输出该行的父瓦片(x, y, 2h×2w画布)
+        parents, parent_y = {}, None
+        for x_position, y_position, tile in children:
+            if y_position // 2 != parent_y and parents:
+                yield from ((parent_x, parent_y, canvas) for parent_x, canvas in sorted(parents.items()))
+                parents = {}
+            parent_y = y_position // 2
+            height, width = tile.shape[:2]
+            canvas = parents.get(x_position // 2)
+            if canvas is None:
+                canvas = parents[x_position // 2] = np.zeros((height * 2, width * 2, tile.shape[2]), dtype=tile.dtype)
+            row, col = (y_position % 2) * height, (x_position % 2) * width
+            canvas[row:row + height, col:col + width] = tile
+        yield from ((parent_x, parent_y, canvas) for parent_x, canvas in sorted(parents.items()))
+
+    def encode_tile(self, tile, is_parent):
+        if is_parent:
+            tile = reduce_rows(tile, 2, self.is_categorical)
+        if tile.dtype != np.uint8 and not (self.tile_format == 'png' and tile.dtype == np.uint16):
+            raise ValueError(f'{tile.dtype} tiles cannot be encoded as {self.tile_format}')
+        # 瓦片按BGR存储，与OpenCV编码约定一致
+        is_success, data = cv2.imencode(self.tile_formats[self.tile_format][0], tile, self.encode_params)
+        if not is_success:
+            raise ValueError(f'Failed to encode tile as {self.tile_format}')
+        return tile, data.tobytes()
+
+    def write_level(self, executor, writer, zoom, tiles, levels, is_parent):
+        # 每batch_size个瓦片并行编码一次，按顺序写出，需要继续合并时同时写入临时库
+        count = 0
+        batch = []
+        for item in tiles:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                count += self.write_batch(executor, writer, zoom, batch, levels, is_parent)
+                batch = []
+                if self.signal is not None and self.signal.is_set():
+                    return count
+        if batch:
+            count += self.write_batch(executor, writer, zoom, batch, levels, is_parent)
+        return count
+
+    def write_batch(self, executor, writer, zoom, batch, levels, is_parent):
+        results = list(executor.map(lambda item: self.encode_tile(item[2], is_parent), batch))
+        writer.write_many([(zoom, x_position, y_position, data) for (x_position, y_position, _), (tile, data) in zip(batch, results)])
+        if levels is not None:
+            levels.execute(f'create table if not exists level_{zoom}(image blob, x int, y int, z int, shape text, dtype text)')
+            levels.executemany(f'insert into level_{zoom} (image, x, y, z, shape, dtype) values (?, ?, ?, ?, ?, ?)',
+                               [(tile.tobytes(), x_position, y_position, zoom, str(tile.shape), tile.dtype.str)
+                                for (x_position, y_position, _), (tile, data) in zip(batch, results)])
+            levels.commit()
+        if not is_parent:
+            xs = [x_position for x_position, y_position, _ in batch]
+            ys = [y_position for x_position, y_position, _ in batch]
+            if self.tile_bounds is None:
+                self.tile_bounds = [min(xs), min(ys), max(xs), max(ys)]
+            else:
+                self.tile_bounds = [min(self.tile_bounds[0], min(xs)), min(self.tile_bounds[1], min(ys)), max(self.tile_bounds[2], max(xs)),
+                                    max(self.tile_bounds[3], max(ys))]
+        return len(batch)
+
+    def open_writer(self):
+        extension = os.path.splitext(self.output)[1].lower()
+        if extension == '.mbtiles':
+            return MBTilesWriter(self.output)
+        elif extension == '.pmtiles':
+            return PMTilesWriter(self.output, self.tile_formats[self.tile_format][1])
+        return XYZWriter(self.output, self.tile_formats[self.tile_format][0])
+
+    def get_metadata(self, min_zoom, max_zoom):
+        min_x, min_y, max_x, max_y = self.tile_bounds
+        north, west = GeeImageStitch.tile_to_latlon_top_left(min_x, min_y, self.zoom)
+        south, east = GeeImageStitch.tile_to_latlon_top_left(max_x + 1, max_y + 1, self.zoom)
+        return {'name': os.path.splitext(os.path.basename(self.output))[0], 'format': self.tile_format, 'type': 'overlay', 'minzoom': min_zoom,
+                'maxzoom': max_zoom, 'bounds': [west, south, east, north], 'center': [(west + east) / 2, (south + north) / 2, min_zoom],
+                'description': self.ee_object}
+
+
+class MBTilesWriter:
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('create table metadata (name text, value text)')
+        self.conn.execute('create table tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)')
+        self.conn.execute('create unique index tile_index on tiles (zoom_level, tile_column, tile_row)')
+
+    def write_many(self, tiles):
+        # MBTiles的行号为TMS方向（自南向北）
+        self.conn.executemany('insert or replace into tiles (zoom_level, tile_column, tile_row, tile_data) values (?, ?, ?, ?)',
+                              [(z, x, (1 << z) - 1 - y, data) for z, x, y, data in tiles])
+        self.conn.commit()
+
+    def close(self, metadata):
+        rows = [(key, ','.join(map(str, value)) if isinstance(value, list) else str(value)) for key, value in metadata.items()]
+        self.conn.executemany('insert into metadata (name, value) values (?, ?)', rows)
+        self.conn.commit()
+        self.conn.close()
+
+
+class XYZWriter:
+    def __init__(self, path, extension):
+        self.path = path
+        self.extension = extension
+
+    def write_many(self, tiles):
+        for z, x, y, data in tiles:
+            tile_dir = os.path.join(self.path, str(z), str(x))
+            os.makedirs(tile_dir, exist_ok=True)
+            with open(os.path.join(tile_dir, f'{y}{self.extension}'), 'wb') as file:
+                file.write(data)
+
+    def close(self, metadata):
+        with open(os.path.join(self.path, 'metadata.json'), 'w', encoding='utf-8') as file:
+            json.dump(metadata, file, ensure_ascii=False)
+
+
+class PMTilesWriter:
+    """
+    PMTiles v3单文件写出：瓦片数据先顺序写入临时文件（相同内容只写一次），结束时按希尔伯特曲线瓦片编号生成目录，
+    根目录超过16KB时拆分为叶目录，最终依次写出文件头、根目录、元数据、叶目录和瓦片数据
+    """
+    header_size = 127
+    max_root_size = 16384 - 127
+
+    def __init__(self, path, tile_type):
+        self.path = path
+        self.tile_type = tile_type
+        self.data_file = f'{path}.data.tmp'
+        self.data = open(self.data_file, 'wb')
+        self.offset = 0
+        self.contents = {}
+        self.entries = []
+        self.addressed_tiles = 0
+
+    @staticmethod
+    def zxy_to_tile_id(z, x, y):
+        tile_id = ((1 << (2 * z)) - 1) // 3
+        size = 1 << (z - 1) if z > 0 else 0
+        while size > 0:
+            rx = 1 if x & size else 0
+            ry = 1 if y & size else 0
+            tile_id += size * size * ((3 * rx) ^ ry)
+            if ry == 0:
+                if rx == 1:
+                    x, y = size - 1 - x, size - 1 - y
+                x, y = y, x
+            size //= 2
+        return tile_id
+
+    def write_many(self, tiles):
+        for z, x, y, data in tiles:
+            digest = hashlib.md5(data).digest()
+            content = self.contents.get(digest)
+            if content is None:
+                content = self.contents[digest] = (self.offset, len(data))
+                self.data.write(data)
+                self.offset += len(data)
+            self.entries.append((self.zxy_to_tile_id(z, x, y), content[0], content[1]))
+            self.addressed_tiles += 1
+
+    @staticmethod
+    def write_varint(buffer, value):
+        while value >= 0x80:
+            buffer.append((value & 0x7f) | 0x80)
+            value >>= 7
+        buffer.append(value)
+
+    @classmethod
+    def serialize_directory(cls, entries):
+        # entries: [(tile_id, offset, length, run_length)]，各字段按列写入varint，目录以gzip压缩
+        buffer = bytearray()
+        cls.write_varint(buffer, len(entries))
+        last_id = 0
+        for tile_id, offset, length, run_length in entries:
+            cls.write_varint(buffer, tile_id - last_id)
+            last_id = tile_id
+        for tile_id, offset, length, run_length in entries:
+            cls.write_varint(buffer, run_length)
+        for tile_id, offset, length, run_length in entries:
+            cls.write_varint(buffer, length)
+        for i, (tile_id, offset, length, run_length) in enumerate(entries):
+            # 与上一条目数据连续时记为0
+            if i > 0 and offset == entries[i - 1][1] + entries[i - 1][2]:
+                cls.write_varint(buffer, 0)
+            else:
+                cls.write_varint(buffer, offset + 1)
+        return gzip.compress(bytes(buffer))
+
+    def build_directories(self, entries):
+        root = self.serialize_directory(entries)
+        if len(root) <= self.max_root_size:
+            return root, b''
+        leaf_size = 4096
+        while True:
+            root_entries, leaves = [], bytearray()
+            for i in range(0, len(entries), leaf_size):
+                leaf = self.serialize_directory(entries[i:i + leaf_size])
+                # run_length为0的根目录条目指向叶目录
+                root_entries.append((entries[i][0], len(leaves), len(leaf), 0))
+                leaves += leaf
+            root = self.serialize_directory(root_entries)
+            if len(root) <= self.max_root_size:
+                return root, bytes(leaves)
+            leaf_size *= 2
+
+    def close(self, metadata):
+        self.data.close()
+        # 按瓦片编号排序，编号连续且内容相同的瓦片合并为一个条目
+        entries = []
+        for tile_id, offset, length in sorted(self.entries):
+            if entries and entries[-1][0] + entries[-1][3] == tile_id and entries[-1][1] == offset:
+                entries[-1] = (entries[-1][0], offset, length, entries[-1][3] + 1)
+            else:
+                entries.append((tile_id, offset, length, 1))
+        root, leaves = self.build_directories(entries)
+        metadata_bytes = gzip.compress(json.dumps(metadata, ensure_ascii=False).encode('utf-8'))
+        root_offset = self.header_size
+        metadata_offset = root_offset + len(root)
+        leaves_offset = metadata_offset + len(metadata_bytes)
+        data_offset = leaves_offset + len(leaves)
+        west, south, east, north = metadata['bounds']
+        center_lon, center_lat, center_zoom = metadata['center']
+        header = b'PMTiles' + struct.pack('<B11Q', 3, root_offset, len(root), metadata_offset, len(metadata_bytes), leaves_offset, len(leaves),
+                                          data_offset, self.offset, self.addressed_tiles, len(entries), len(self.contents))
+        # clustered=0（数据未按瓦片编号排列）、内部压缩gzip=2、瓦片压缩none=1
+        header += struct.pack('<BBBBBB4iBii', 0, 2, 1, self.tile_type, metadata['minzoom'], metadata['maxzoom'], *[round(value * 10000000) for value in
+                              (west, south, east, north)], center_zoom, round(center_lon * 10000000), round(center_lat * 10000000))
+        with open(self.path, 'wb') as file:
+            file.write(header)
+            file.write(root)
+            file.write(metadata_bytes)
+            file.write(leaves)
+            with open(self.data_file, 'rb') as data:
+                shutil.copyfileobj(data, file)
+        os.remove(self.data_file)
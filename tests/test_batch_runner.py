@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import pytest
+
+# 批量运行依赖完整的运行环境（EE、拼接所需的CUDA等），缺少依赖时跳过
+batch_runner = pytest.importorskip('multiprocess_manager.batch_runner')
+
+region = 'POLYGON((116.3 39.9, 116.4 39.9, 116.4 40.0, 116.3 40.0, 116.3 39.9))'
+
+
+def spec(tmp_path, dataset):
+    return {'dataset': dataset, 'wkt': region, 'start_date': '2024-01-01', 'end_date': '2024-02-01', 'scale': 10, 'output': str(tmp_path)}
+
+
+def test_documented_dataset_id_is_mapped(tmp_path):
+    # README与命令行帮助中的示例数据集
+    runner = batch_runner.BatchRunner([spec(tmp_path, 'GOOGLE/DYNAMICWORLD/V1')], {}, tmp_path / 'batch_status.json')
+    try:
+        record = runner.records[0]
+        assert record['dataset'] == 'Dynamic World'
+        assert record['taskname'].startswith('Dynamic_World_')
+        assert runner.orchestrator_task(record)['ee_object'] == 'Dynamic World'
+    finally:
+        runner.store.close()
+
+
+def test_dataset_name_is_accepted(tmp_path):
+    runner = batch_runner.BatchRunner([spec(tmp_path, 'CFSV2')], {}, tmp_path / 'batch_status.json')
+    try:
+        assert runner.records[0]['dataset'] == 'CFSV2'
+    finally:
+        runner.store.close()
+
+
+def test_unknown_dataset_is_rejected(tmp_path):
+    with pytest.raises(ValueError, match='不支持的数据集'):
+        batch_runner.BatchRunner([spec(tmp_path, 'COPERNICUS/S2_SR')], {}, tmp_path / 'batch_status.json')
@@ -0,0 +1,38 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import numpy as np
+import pytest
+import rasterio
+from rasterio.features import geometry_mask
+from shapely.geometry import MultiPolygon, Polygon
+
+# 拼接模块依赖完整的运行环境（rasterio、CUDA等），缺少依赖时跳过
+geestitch = pytest.importorskip('stitch.geestitch')
+if geestitch.process_image_kernel_cpu is None:
+    pytest.skip('numba未安装', allow_module_level=True)
+
+size = 40
+holed = Polygon([(3, 3), (30, 3), (30, 30), (3, 30)], [[(8, 8), (20, 8), (20, 20), (8, 20)], [(22.2, 22.2), (28.7, 22.2), (25.3, 27.9)]])
+polygons = [holed, MultiPolygon([holed, Polygon([(32.1, 31.8), (38.3, 33.1), (37.2, 38.3)], [[(34, 34.2), (36.1, 34.6), (35.4, 36.8)]])])]
+
+
+@pytest.mark.parametrize('polygon', polygons)
+def test_numba_kernel_excludes_holes(polygon):
+    # 与CPU路径的geometry_mask（像素中心在多边形内）结果一致，洞内像素置0
+    transform = rasterio.transform.from_bounds(0, 0, size, size, size, size)
+    image = np.ones((size, size, 2), dtype=np.uint8)
+    params = np.array([transform.c, transform.a, transform.b, transform.f, transform.d, transform.e, 0, 0, 0, size, size, 2], dtype=np.float64)
+    poly_coords, poly_offsets, poly_vertex_counts = geestitch.CudaImageCrop.extract_coords(polygon)
+    params[6] = len(poly_offsets)
+    int32_max = np.iinfo(np.int32).max
+    extremum = np.array([int32_max, 0, int32_max, 0], dtype=np.int32)
+    geestitch.process_image_kernel_cpu(image.reshape(-1), params, extremum, poly_coords, poly_offsets, poly_vertex_counts)
+    expected = geometry_mask([polygon], out_shape=(size, size), transform=transform, invert=True)
+    # 第一行为北边界，第25行的像素中心纬度为14.5，位于洞内
+    assert expected[25, 5] and not expected[25, 12]
+    assert np.array_equal(image[:, :, 0].astype(bool), expected)
+    assert np.array_equal(image[:, :, 1], image[:, :, 0])
+    rows, cols = np.where(expected)
+    assert extremum.tolist() == [rows.min(), rows.max(), cols.min(), cols.max()]
@@ -0,0 +1,68 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import sqlite3
+from progress import TileProgress
+from query import TileQuery
+
+
+def new_database():
+    # 分区编号后的布局，bands为NULL（下载全部波段）
+    conn = sqlite3.connect(':memory:')
+    conn.execute('create table tiles_12 (x int, y int, z int, bands text, geometry text, width int, height int, part_id int)')
+    conn.execute('create table tiles_12_rs (x int, y int, z int, image blob, dtype text, shape text, bands text, status int, width int, height int, '
+                 'error text, cost real, part_id int)')
+    conn.executemany('insert into tiles_12 values (?, ?, 12, null, null, 256, 256, 0)', [(x, 0) for x in range(4)])
+    cur = conn.cursor()
+    TileProgress.create_table(cur)
+    TileProgress.init_total(cur, 'tiles_12')
+    conn.commit()
+    return conn
+
+
+def run(conn, statuses):
+    # 按to_sqlite的批次写入方式写入一轮下载结果：statuses为{x: status}，未列出的瓦片视为暂停前未下载
+    cur = conn.cursor()
+    download_result, retried_result, counters = [], [], {}
+    for x, y, z, bands, geometry, width, height, part_id, is_retry in TileQuery.execute(cur, 'download_parameter', 'tiles_12').fetchall():
+        if x not in statuses:
+            continue
+        status = statuses[x]
+        download_result.append({'x': x, 'y': y, 'z': z, 'image': None, 'dtype': 'uint8', 'shape': None, 'bands': bands, 'status': status,
+                                'width': width, 'height': height, 'error': None, 'cost': 0.1, 'part_id': part_id})
+        counter = counters.setdefault((part_id, z, bands), [0, 0])
+        if status == 1:
+            counter[0] += 1
+            if is_retry:
+                counter[1] -= 1
+                retried_result.append({'part_id': part_id, 'x': x, 'y': y, 'z': z, 'bands': bands})
+        elif not is_retry:
+            counter[1] += 1
+    TileQuery.executemany(cur, 'insert_result', 'tiles_12_rs', download_result)
+    TileQuery.executemany(cur, 'delete_failed', 'tiles_12_rs', retried_result)
+    TileProgress.add_download_results(cur, 'tiles_12', counters)
+    conn.commit()
+
+
+def pending(conn):
+    rows = TileQuery.execute(conn.cursor(), 'download_parameter', 'tiles_12').fetchall()
+    return sorted((row[0], row[8]) for row in rows)
+
+
+def test_retry_success_survives_pause_and_resume():
+    conn = new_database()
+    cur = conn.cursor()
+    # 第一轮：0成功，1、2失败，3未下载即暂停
+    run(conn, {0: 1, 1: -1, 2: -1})
+    assert pending(conn) == [(1, 1), (2, 1), (3, 0)]
+    # 第一次续传：1重试成功，2再次失败，随即暂停
+    run(conn, {1: 1, 2: -1})
+    assert pending(conn) == [(2, 1), (3, 0)]
+    assert cur.execute('select count(1) from tiles_12_rs where x = 1 and status = -1').fetchone()[0] == 0
+    assert TileProgress.download_summary(cur)[:3] == (4, 2, 1)
+    # 第二次续传：已重试成功的1不再被选中，计数不重复修正
+    run(conn, {1: 1, 2: 1, 3: 1})
+    assert pending(conn) == []
+    assert TileProgress.download_summary(cur)[:3] == (4, 4, 0)
+    assert cur.execute('select count(1) from tiles_12_rs where status = -1').fetchone()[0] == 0
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import sqlite3
+from progress import TileProgress
+from query import LegacyTables, TileQuery
+
+columns = ('x INTEGER, y INTEGER, z INTEGER, geometry TEXT, image BLOB, dtype TEXT, shape TEXT, bands TEXT, raster TEXT, status INTEGER, '
+           'stitch_status INTEGER, width INTEGER, height INTEGER, error TEXT, cost REAL')
+
+
+def tile(x, y, z, status=None):
+    return x, y, z, 'POLYGON EMPTY', b'\x00' if status == 1 else None, 'uint8', '(1, 1, 1)', 'b1', None, status, None, 256, 256, None, None
+
+
+def legacy_database():
+    # 旧版布局：tiles_10未拆分，tiles_15按x拆为两个分区表，每个表各有结果表
+    conn = sqlite3.connect(':memory:')
+    for table_name in ('tiles_10', 'tiles_10_rs', 'tiles_15_part_1', 'tiles_15_part_1_rs', 'tiles_15_part_2', 'tiles_15_part_2_rs'):
+        conn.execute(f'create table "{table_name}" ({columns})')
+    conn.executemany('insert into tiles_10 values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', [tile(x, 0, 10) for x in range(3)])
+    conn.executemany('insert into tiles_10_rs values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', [tile(0, 0, 10, 1), tile(1, 0, 10, -1)])
+    conn.executemany('insert into tiles_15_part_1 values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', [tile(x, y, 15) for x in range(2) for y in range(2)])
+    conn.executemany('insert into tiles_15_part_2 values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', [tile(x, y, 15) for x in range(2, 4) for y in range(2)])
+    # 分区1中(1, 1)先失败后重试成功，失败记录尚未去重
+    conn.executemany('insert into tiles_15_part_1_rs values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)',
+                     [tile(0, 0, 15, 1), tile(1, 1, 15, -1), tile(1, 1, 15, 1), tile(0, 1, 15, -1)])
+    conn.executemany('insert into tiles_15_part_2_rs values (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)', [tile(2, 0, 15, 1)])
+    conn.commit()
+    return conn
+
+
+def progress(cur):
+    return {(row[0], row[1], row[2]): row[3:] for row in cur.execute('select tablename, part_id, z, total, success, fail from tile_progress')}
+
+
+def test_upgrade_merges_part_tables():
+    conn = legacy_database()
+    cur = conn.cursor()
+    assert LegacyTables.upgrade(cur) == ['tiles_10', 'tiles_15']
+    conn.commit()
+    names = set(LegacyTables.table_names(cur))
+    assert names == {'tiles_10', 'tiles_10_rs', 'tiles_15', 'tiles_15_rs'}
+    parts = cur.execute('select part_id, count(1) from tiles_15 group by part_id order by part_id').fetchall()
+    assert parts == [(1, 4), (2, 4)]
+    assert cur.execute('select part_id from tiles_15_rs where x = 2').fetchall() == [(2,)]
+    assert progress(cur) == {('tiles_10', 0, 10): (3, 1, 1), ('tiles_15', 1, 15): (4, 2, 1), ('tiles_15', 2, 15): (4, 1, 0)}
+    # 分区索引已存在，再次升级不做任何修改
+    assert LegacyTables.upgrade(cur) == []
+
+
+def test_upgraded_tables_resume_and_stitch():
+    conn = legacy_database()
+    cur = conn.cursor()
+    LegacyTables.upgrade(cur)
+    conn.commit()
+    # 续传只取未下载或失败的瓦片，表名均可通过查询层校验
+    rows = TileQuery.execute(cur, 'download_parameter', 'tiles_15').fetchall()
+    assert sorted((x, y, part_id, is_retry) for x, y, z, bands, geometry, width, height, part_id, is_retry in rows) == \
+        [(0, 1, 1, 1), (1, 0, 1, 0), (2, 1, 2, 0), (3, 0, 2, 0), (3, 1, 2, 0)]
+    tasks = TileProgress.stitch_tasks(cur)
+    assert [(task[0], task[1], task[2], task[6]) for task in tasks] == [('tiles_10_rs', 0, 10, 1), ('tiles_15_rs', 1, 15, 2), ('tiles_15_rs', 2, 15, 1)]
+    bounds = TileQuery.execute(cur, 'tile_bounds', 'tiles_15_rs', (15, 1)).fetchone()
+    assert bounds == (1, 1, 0, 0)
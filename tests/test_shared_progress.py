@@ -0,0 +1,39 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+from multiprocessing import Process
+from progress import SharedProgress
+
+
+def count_tiles(shared_progress, n):
+    for _ in range(n):
+        shared_progress.add('download_success', 1)
+    shared_progress.close()
+
+
+def test_budget_written_by_main_while_worker_counts():
+    shared_progress = SharedProgress.create({'download_total': 10, 'download_success': 0})
+    try:
+        worker = Process(target=count_tiles, args=(shared_progress, 20000))
+        worker.start()
+        limit = 0
+        while worker.is_alive():
+            limit = limit % 8 + 1
+            shared_progress['ee_request_limit'] = limit
+        worker.join()
+        # 工作进程的计数区序号不受主进程写入影响，结束时为偶数
+        assert int(shared_progress.ints[0]) % 2 == 0
+        assert shared_progress.snapshot() == {'download_total': 10, 'download_success': 20000, 'ee_request_limit': limit}
+        assert shared_progress.get('ee_request_limit') == limit
+    finally:
+        shared_progress.unlink()
+
+
+def test_budget_unset_until_written():
+    shared_progress = SharedProgress.create({'download_total': 1})
+    try:
+        assert shared_progress.get('ee_request_limit') is None
+        assert 'ee_request_limit' not in shared_progress.snapshot()
+    finally:
+        shared_progress.unlink()
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import os
+import sqlite3
+import numpy as np
+import pytest
+from progress import TileProgress
+
+# 导出依赖拼接模块与OpenCV，缺少依赖时跳过
+tileexport = pytest.importorskip('stitch.tileexport')
+cv2 = pytest.importorskip('cv2')
+
+tile_size = 4
+
+
+def buffered_database(path):
+    # 下载的瓦片带2像素缓冲：存储为(h+2, w+2)，瓦片大小记录为(w, h)
+    rng = np.random.default_rng(0)
+    images = {(x, y): rng.integers(1, 255, (tile_size + 2, tile_size + 2, 3), dtype=np.uint8) for x in range(10, 12) for y in range(20, 22)}
+    conn = sqlite3.connect(path)
+    conn.execute('create table tiles_12 (x int, y int, z int, bands text, width int, height int, part_id int)')
+    conn.execute('create table tiles_12_rs (x int, y int, z int, image blob, dtype text, shape text, bands text, status int, part_id int)')
+    conn.executemany('insert into tiles_12 values (?, ?, 12, null, ?, ?, 0)', [(x, y, tile_size, tile_size) for x, y in images])
+    conn.executemany('insert into tiles_12_rs values (?, ?, 12, ?, ?, ?, null, 1, 0)',
+                     [(x, y, image.tobytes(), image.dtype.str, str(image.shape)) for (x, y), image in images.items()])
+    cur = conn.cursor()
+    TileProgress.create_table(cur)
+    TileProgress.init_total(cur, 'tiles_12')
+    TileProgress.add_download_results(cur, 'tiles_12', {(0, 12, None): [len(images), 0]})
+    conn.commit()
+    conn.close()
+    return images
+
+
+def test_exported_tiles_drop_download_buffer(tmp_path):
+    images = buffered_database(str(tmp_path / 't.nev'))
+    output = str(tmp_path / 'xyz')
+    exported = tileexport.TileExporter(str(tmp_path / 't.nev'), output, 'CFSV2', min_zoom=11, workers=2).export()
+    assert exported == len(images) + 1
+    for (x, y), image in images.items():
+        tile = cv2.imread(os.path.join(output, '12', str(x), f'{y}.png'), cv2.IMREAD_UNCHANGED)
+        assert np.array_equal(tile, image[:tile_size, :tile_size])
+    # 4个子瓦片合并后归约为一个tile_size大小的父瓦片
+    parent = cv2.imread(os.path.join(output, '11', '5', '10.png'), cv2.IMREAD_UNCHANGED)
+    assert parent.shape == (tile_size, tile_size, 3)
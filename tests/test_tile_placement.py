@@ -0,0 +1,91 @@
+#!/usr/bin/python3
+# Author: B_Snowflake
+# Date: 2026/10/19
+
+import sqlite3
+import numpy as np
+import pytest
+
+# 拼接模块依赖完整的运行环境（rasterio、CUDA等），缺少依赖时跳过
+geestitch = pytest.importorskip('stitch.geestitch')
+
+tile_size = 4
+# 下载时每个瓦片带2像素缓冲
+tile_shape = (tile_size + 2, tile_size + 2, 1)
+# 每行中存在的瓦片x编号，缺失的瓦片把一行分为多段
+grid = {0: [0, 1, 2, 4], 1: [1, 2, 3, 4], 2: [0, 2, 3]}
+map_shape = (len(grid) * tile_size, 5 * tile_size, 1)
+
+
+def tiles():
+    rng = np.random.default_rng(0)
+    return {(x, y): rng.integers(1, 255, tile_shape, dtype=np.uint8) for y, xs in grid.items() for x in xs}
+
+
+def place_one_by_one(images, band_rows=None):
+    # 逐个放置瓦片，超出图像的部分截去，后放置的瓦片覆盖重叠部分；指定band_rows时瓦片不超出所在条带
+    map_image = np.zeros(map_shape, dtype=np.uint8)
+    for (x, y), image in sorted(images.items(), key=lambda item: (item[0][1], item[0][0])):
+        start_x, start_y = x * tile_size, y * tile_size
+        end_y = map_shape[0] if band_rows is None else (y // band_rows + 1) * band_rows * tile_size
+        width, height = min(image.shape[1], map_shape[1] - start_x), min(image.shape[0], min(map_shape[0], end_y) - start_y)
+        map_image[start_y:start_y + height, start_x:start_x + width] = image[:height, :width]
+    return map_image
+
+
+def runs(images):
+    for y, xs in grid.items():
+        run = [xs[0]]
+        for x in xs[1:] + [None]:
+            if x is not None and x == run[-1] + 1:
+                run.append(x)
+                continue
+            yield run[0], y, np.stack([images[(x_position, y)] for x_position in run])
+            run = [x]
+
+
+def test_buffered_runs_match_one_by_one_placement():
+    images = tiles()
+    map_image = np.zeros(map_shape, dtype=np.uint8)
+    for x, y, run in runs(images):
+        geestitch.place_tile_run(map_image, run, y * tile_size, x * tile_size, tile_size, tile_size)
+    assert np.array_equal(map_image, place_one_by_one(images))
+
+
+def test_buffered_runs_clipped_to_window():
+    images = tiles()
+    row_start, col_start = 3, 5
+    window = np.zeros((6, 9, 1), dtype=np.uint8)
+    for x, y, run in runs(images):
+        geestitch.place_tile_run(window, run, y * tile_size, x * tile_size, tile_size, tile_size, row_start, col_start)
+    assert np.array_equal(window, place_one_by_one(images)[row_start:row_start + 6, col_start:col_start + 9])
+
+
+def test_three_tile_run_spacing():
+    run = np.stack([np.full(tile_shape, k + 1, dtype=np.uint8) for k in range(3)])
+    map_image = np.zeros((tile_size, 3 * tile_size, 1), dtype=np.uint8)
+    geestitch.place_tile_run(map_image, run, 0, 0, tile_size, tile_size)
+    assert map_image[0, :, 0].tolist() == [1, 1, 1, 1, 2, 2, 2, 2, 3, 3, 3, 3]
+
+
+def band_database(path, images):
+    conn = sqlite3.connect(path)
+    conn.execute('create table tiles_12_rs (x int, y int, z int, image blob, dtype text, shape text, bands text, status int, part_id int)')
+    conn.executemany('insert into tiles_12_rs values (?, ?, 12, ?, ?, ?, null, 1, 0)',
+                     [(x, y, image.tobytes(), image.dtype.str, str(image.shape)) for (x, y), image in images.items()])
+    conn.commit()
+    conn.close()
+
+
+@pytest.mark.parametrize('order', [(0, 1, 2), (2, 1, 0)])
+def test_row_bands_write_only_their_rows(tmp_path, order):
+    # 各条带由不同的拼接进程写入，完成顺序不影响结果；条带最后一行瓦片的缓冲行不写入下一条带
+    images = tiles()
+    band_database(str(tmp_path / 't.nev'), images)
+    temp_file = str(tmp_path / 'map.tmp')
+    np.memmap(temp_file, dtype=np.uint8, mode='w+', shape=map_shape).flush()
+    for band_y in order:
+        geestitch.stitch_row_band((str(tmp_path / 't.nev'), 'tiles_12_rs', 12, 0, None, band_y, band_y, 0, 0, tile_size, tile_size, temp_file,
+                                   np.dtype(np.uint8).str, map_shape, False))
+    map_image = np.array(np.memmap(temp_file, dtype=np.uint8, mode='r', shape=map_shape))
+    assert np.array_equal(map_image, place_one_by_one(images, band_rows=1))